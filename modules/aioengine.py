@@ -0,0 +1,189 @@
+import asyncio, signal, time, paho.mqtt.client as mqtt
+from concurrent.futures import ThreadPoolExecutor
+from modules.utilities import log
+from modules.scheduler import DebounceScheduler
+
+# A debounce scheduler whose pending calls are timed by an asyncio event
+# loop rather than by a dedicated thread. Due calls are run in the engine's
+# executor
+class AsyncioDebounceScheduler(DebounceScheduler):
+    # Pending calls may be changed from any thread
+    def wakeup(self):
+        self.loop.call_soon_threadsafe(self.reschedule)
+
+    # Set up a timer that expires at the earliest deadline
+    def reschedule(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        with self.condition:
+            deadline = self.next_deadline()
+        if deadline is not None and not self.stopped:
+            self.timer = self.loop.call_later(max(deadline - time.monotonic(), 0), self.run_due)
+
+    def run_due(self):
+        self.timer = None
+        with self.condition:
+            due = self.pop_entries(until=time.monotonic())
+        if due:
+            self.loop.run_in_executor(self.executor, self.run_entries, due)
+        self.reschedule()
+
+    def start(self):
+        self.reschedule()
+
+    # May be called from any thread: the timer is cancelled by the loop
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.wakeup()
+
+    def __init__(self, loop, executor, idle_time, max_delay=None):
+        self.loop = loop
+        self.executor = executor
+        self.timer = None
+        super().__init__(idle_time, max_delay)
+
+# An engine that drives polling, MQTT network I/O and deferred thermostat
+# updates from a single asyncio event loop, instead of running a separate
+# thread for each of them. The MQTT client's socket is watched directly by
+# the event loop (so paho's network thread is not started), and all the
+# calls to the Netatmo API are run one at a time by a single worker thread,
+# which serializes them in the same way as NetatmoToken's lock does
+class AsyncioEngine:
+    # Hook the MQTT client's socket into the event loop, following the
+    # external event loop integration pattern supported by paho-mqtt.
+    # Must be run by the event loop thread
+    def attach_mqtt_socket(self, sock):
+        if sock.fileno() < 0:
+            # Already closed in the meantime
+            return
+        self.loop.add_reader(sock, self.mqttc.loop_read)
+        if self.mqttc.want_write():
+            self.loop.add_writer(sock, self.mqttc.loop_write)
+
+    # Watch the MQTT client's socket for writing, as long as it is open.
+    # Must be run by the event loop thread
+    def watch_mqtt_writes(self, sock):
+        if sock.fileno() >= 0:
+            self.loop.add_writer(sock, self.mqttc.loop_write)
+
+    # Stop watching a socket (given by its file descriptor, as the socket
+    # is closed right after paho has signaled it) for both reading and
+    # writing, so that no registration survives into the next connection.
+    # Must be run by the event loop thread
+    def detach_mqtt_socket(self, fd):
+        self.loop.remove_writer(fd)
+        self.loop.remove_reader(fd)
+
+    # Run function(*args) in the event loop thread: right away if called
+    # from it (so that a socket is detached before paho closes it), as
+    # soon as possible otherwise
+    def in_loop(self, function, *args):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    # Sockets are opened and closed by paho in whatever thread reconnects
+    # (the default executor) and messages may be published from other
+    # threads (e.g., by the worker running API calls), so the event loop
+    # must only be modified from its own thread
+    def setup_mqtt_callbacks(self):
+        self.mqttc.on_socket_open = lambda client, userdata, sock: self.in_loop(self.attach_mqtt_socket, sock)
+        self.mqttc.on_socket_close = lambda client, userdata, sock: self.in_loop(self.detach_mqtt_socket, sock.fileno())
+        self.mqttc.on_socket_register_write = lambda client, userdata, sock: self.in_loop(self.watch_mqtt_writes, sock)
+        self.mqttc.on_socket_unregister_write = lambda client, userdata, sock: self.in_loop(self.loop.remove_writer, sock.fileno())
+
+    # Periodically run the MQTT client's housekeeping (keepalive pings,
+    # retries) and reconnect to the broker if the connection is lost
+    async def mqtt_misc_loop(self):
+        while True:
+            if self.mqttc.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                log.warning("Connection to the MQTT broker lost. Reconnecting")
+                try:
+                    await self.loop.run_in_executor(None, self.mqttc.reconnect)
+                except Exception as e:
+                    log.error("Failed to reconnect to the MQTT broker: %s" % repr(e))
+                    await asyncio.sleep(5)
+            await asyncio.sleep(1)
+
+    # Run polling cycles as scheduled by the Netatmo poll scheduler. The wait
+    # is interrupted whenever the scheduler signals activity
+    async def poll_loop(self):
+        scheduler = self.netatmo.poll_scheduler
+        first_iteration = True
+        while True:
+            if not first_iteration:
+                while True:
+                    delay = scheduler.next_poll_delay()
+                    if delay <= 0:
+                        break
+                    log.debug("Waiting %.1f seconds before next poll" % delay)
+                    self.wake.clear()
+                    try:
+                        await asyncio.wait_for(self.wake.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            first_iteration = False
+            scheduler.mark_polled()
+            await self.loop.run_in_executor(self.executor, self.poll_function)
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        self.netatmo.poll_scheduler.add_wake_listener(lambda: self.loop.call_soon_threadsafe(self.wake.set))
+        # Replace the thread-based scheduler of thermostat updates
+        threaded_scheduler = self.netatmo.scheduler
+        threaded_scheduler.stop()
+        self.netatmo.scheduler = AsyncioDebounceScheduler(self.loop, self.executor, threaded_scheduler.idle_time, threaded_scheduler.max_delay)
+        self.netatmo.scheduler.start()
+        # Pending calls are not carried over to the new scheduler
+        self.netatmo.schedule_token_refresh()
+
+        # The MQTT client is already connected at this point
+        self.setup_mqtt_callbacks()
+        self.attach_mqtt_socket(self.mqttc.socket())
+
+        stop = asyncio.Event()
+        for s in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(s, stop.set)
+
+        tasks = [
+            asyncio.create_task(self.mqtt_misc_loop()),
+            asyncio.create_task(self.poll_loop())
+        ]
+        await stop.wait()
+        log.info("Stopping asyncio engine")
+        for t in tasks:
+            t.cancel()
+        if self.stop_function is not None:
+            # Expected to stop the scheduler and send any pending
+            # thermostat updates
+            await self.loop.run_in_executor(self.executor, self.stop_function)
+        else:
+            self.netatmo.scheduler.stop()
+            await self.loop.run_in_executor(self.executor, self.netatmo.flush_thermostat_updates)
+        self.mqttc.disconnect()
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        finally:
+            self.executor.shutdown(wait=False)
+
+    def __init__(self, netatmo, mqttc, poll_function, stop_function=None):
+        self.netatmo = netatmo
+        self.mqttc = mqttc
+        self.poll_function = poll_function
+        # Invoked (in the worker thread) before disconnecting from the broker,
+        # in place of stopping the scheduler and flushing pending updates
+        self.stop_function = stop_function
+        # A single worker runs all the (blocking) Netatmo API calls
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='netatmo')
+        self.loop = None
+        self.wake = None
@@ -0,0 +1,62 @@
+import json
+from modules.utilities import log, settings
+
+# JSON encoding and decoding, backed by the fastest available library.
+# The backend can be chosen with the json_backend setting: 'orjson',
+# 'ujson', 'stdlib' or 'auto' (the default), which picks the first
+# library that can be imported in that order. All backends accept both
+# str and bytes documents, raise ValueError on invalid documents, and
+# return str from dumps()
+
+def stdlib_dumps(obj, sort_keys=False):
+    return json.dumps(obj, sort_keys=sort_keys)
+
+def orjson_backend():
+    import orjson
+    def dumps(obj, sort_keys=False):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode("utf-8")
+    return orjson.loads, dumps
+
+def ujson_backend():
+    import ujson
+    def dumps(obj, sort_keys=False):
+        return ujson.dumps(obj, sort_keys=sort_keys, ensure_ascii=False)
+    return ujson.loads, dumps
+
+def stdlib_backend():
+    return json.loads, stdlib_dumps
+
+BACKENDS = {
+    'orjson': orjson_backend,
+    'ujson': ujson_backend,
+    'stdlib': stdlib_backend
+}
+
+# Select the JSON backend. If the requested library cannot be
+# imported, the next one in order of preference is used
+def select_backend(name='auto'):
+    global loads, dumps, backend
+    candidates = list(BACKENDS) if name == 'auto' else [name] + [b for b in BACKENDS if b != name]
+    for candidate in candidates:
+        try:
+            loads, dumps = BACKENDS[candidate]()
+        except ImportError:
+            if candidate == name:
+                log.warning("JSON backend %s not available" % name)
+            continue
+        backend = candidate
+        log.debug("Using JSON backend: %s" % backend)
+        return
+
+# A document to be serialized only if (and when) it is actually
+# formatted, e.g. as an argument of a log message:
+#   log.debug("Document: %s", Lazy(document))
+class Lazy:
+    def __str__(self):
+        return dumps(self.obj)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+loads, dumps, backend = json.loads, stdlib_dumps, 'stdlib'
+select_backend(settings.get('json_backend', 'auto'))
@@ -0,0 +1,99 @@
+import time
+from collections import deque
+from threading import Thread, Condition
+from modules.utilities import log
+
+# What to do when a command is received while the queue is full:
+# discard the oldest queued command or the newly received one
+DROP_OLDEST = "oldest"
+DROP_NEWEST = "newest"
+
+# Bounded queue of received MQTT commands, which are executed one at a
+# time by a dedicated worker thread. Commands are received on the thread
+# of the MQTT client (either paho's network thread or the asyncio event
+# loop): handing them over to the worker ensures that no calls to the
+# Netatmo API, waits for locks or sleeps ever delay MQTT network I/O.
+# Commands that are discarded because the queue is full are handed to
+# on_drop, so that the sender can be notified
+class CommandQueue:
+    # Queue a command. Return False if the command has been discarded
+    def put(self, topic, payload, userdata=None):
+        accepted = True
+        dropped = None
+        with self.condition:
+            if self.stopped:
+                log.warning("Command queue stopped: discarding command %s on topic %s" % (payload, topic))
+                return False
+            if len(self.queue) >= self.max_size:
+                self.dropped_count += 1
+                if self.drop_policy == DROP_NEWEST:
+                    accepted = False
+                    dropped = (topic, payload, userdata)
+                else:
+                    dropped = self.queue.popleft()[1:]
+            if accepted:
+                self.queue.append((time.monotonic(), topic, payload, userdata))
+                self.condition.notify()
+        if dropped is not None:
+            log.warning("Command queue full (%i commands): discarding command %s on topic %s" % (self.max_size, dropped[1], dropped[0]))
+            self.notify_drop(*dropped)
+        return accepted
+
+    def notify_drop(self, topic, payload, userdata):
+        try:
+            self.on_drop(topic, payload, userdata)
+        except Exception as e:
+            log.error("Exception raised while reporting discarded command: %s" % repr(e))
+
+    def depth(self):
+        with self.condition:
+            return len(self.queue)
+
+    # Body of the worker thread
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                queued_at, topic, payload, userdata = self.queue.popleft()
+                self.busy = True
+            log.debug("Executing command %s on topic %s (queued for %.3f seconds)", payload, topic, time.monotonic() - queued_at)
+            try:
+                self.handler(topic, payload, userdata)
+            except Exception as e:
+                log.error("Exception raised while executing command %s on topic %s: %s" % (payload, topic, repr(e)))
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def start(self):
+        self.thread = Thread(target=self.run, name='commands', daemon=True)
+        self.thread.start()
+
+    # Stop accepting commands and wait (up to timeout seconds) for the
+    # queued ones to be executed
+    def stop(self, timeout=10):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+            deadline = time.monotonic() + timeout
+            while (self.queue or self.busy) and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            if self.queue:
+                log.warning("%i queued commands not executed before quitting" % len(self.queue))
+
+    def __init__(self, handler, on_drop, max_size=100, drop_policy=DROP_OLDEST):
+        # Invoked as handler(topic, payload, userdata) for each command,
+        # and as on_drop(topic, payload, userdata) for discarded ones
+        self.handler = handler
+        self.on_drop = on_drop
+        self.max_size = max_size
+        self.drop_policy = drop_policy
+        self.condition = Condition()
+        self.queue = deque()
+        self.busy = False
+        self.stopped = False
+        self.thread = None
+        self.dropped_count = 0
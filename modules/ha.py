@@ -0,0 +1,222 @@
+import threading, time
+from collections import deque
+from threading import Lock, Event
+from modules.utilities import log
+from modules import codec
+
+STANDBY = "standby"
+CLAIMING = "claiming"
+LEADER = "leader"
+
+# Leader election among several instances of smarther2mqtt connected to
+# the same MQTT broker, so that only one of them (the leader) polls the
+# Netatmo cloud and sends thermostat updates.
+# The leader holds a lease, namely a retained message on the lease topic
+# that carries its instance id and an epoch (a counter that is incremented
+# at every change of leader), and renews it periodically. Each instance
+# also announces its presence on <lease topic>/<instance id>, with a Last
+# Will that marks it offline as soon as it disconnects unexpectedly.
+# A standby claims the lease when it has not been renewed for lease_duration
+# seconds or when the leader goes offline. Among concurrent claims, the one
+# with the highest epoch and (for equal epochs) the lowest instance id wins:
+# a claim only becomes effective after it has been echoed by the broker and
+# has remained unchallenged for a short settle time.
+# The leader also publishes a retained handover message with its pending
+# thermostat updates and the last known status of the rooms, which is handed
+# to the next leader along with any commands that the standby has received
+# after the last handover message (and may therefore have been lost)
+class LeaderElection:
+    def presence_topic(self, instance_id):
+        return self.lease_topic + '/' + instance_id
+
+    # Topic and payload of the Last Will, to be set before connecting
+    def will(self):
+        return (self.presence_topic(self.instance_id), "offline")
+
+    def is_leader(self):
+        return self.state == LEADER
+
+    # To be invoked upon every (re)connection to the broker
+    def on_connect(self):
+        self.mqttc.publish(self.presence_topic(self.instance_id), payload="online", qos=1, retain=True)
+        self.mqttc.subscribe([(self.lease_topic, 1), (self.lease_topic + '/+', 1), (self.handover_topic, 1)])
+        self.connected_at = time.monotonic()
+
+    def setup_mqtt_callbacks(self):
+        self.mqttc.message_callback_add(self.lease_topic, lambda client, userdata, message: self.handle_lease(message.payload))
+        self.mqttc.message_callback_add(self.lease_topic + '/+', lambda client, userdata, message: self.handle_presence(message.topic, message.payload))
+        self.mqttc.message_callback_add(self.handover_topic, lambda client, userdata, message: self.handle_handover(message.payload))
+
+    # Return True if lease a supersedes lease b
+    def supersedes(self, a, b):
+        return b is None or a['epoch'] > b['epoch'] or (a['epoch'] == b['epoch'] and a['instance'] <= b['instance'])
+
+    def handle_lease(self, payload):
+        try:
+            lease = codec.loads(payload) if payload else None
+        except ValueError:
+            log.warning("Ignoring invalid lease message: %s" % payload)
+            return
+        deposed = False
+        with self.lock:
+            if lease is not None and not self.supersedes(lease, self.lease):
+                log.debug("Ignoring outdated lease of instance %s (epoch %i)" % (lease['instance'], lease['epoch']))
+                return
+            self.lease = lease
+            self.lease_received_at = time.monotonic()
+            if lease is None:
+                log.debug("Lease released")
+            elif lease['instance'] == self.instance_id:
+                if self.state == CLAIMING and self.claim_confirmed_at is None:
+                    self.claim_confirmed_at = self.lease_received_at
+            elif self.state != STANDBY:
+                log.info("Instance %s has taken over (epoch %i): switching to standby" % (lease['instance'], lease['epoch']))
+                deposed = self.state == LEADER
+                self.state = STANDBY
+        if deposed:
+            self.on_deposed()
+        self.wake.set()
+
+    def handle_presence(self, topic, payload):
+        instance_id = topic.rsplit('/', 1)[1]
+        if payload != b"offline" or instance_id == self.instance_id:
+            return
+        with self.lock:
+            if self.lease is not None and self.lease['instance'] == instance_id:
+                log.info("Leader %s has gone offline" % instance_id)
+                # Consider the lease expired right away
+                self.lease_received_at = None
+        self.wake.set()
+
+    def handle_handover(self, payload):
+        try:
+            handover = codec.loads(payload) if payload else None
+        except ValueError:
+            log.warning("Ignoring invalid handover message: %s" % payload)
+            return
+        with self.lock:
+            self.handover = handover
+            self.handover_received_at = time.monotonic()
+
+    # Keep a received command that a standby does not act upon, in case
+    # the leader fails before handling it
+    def record_command(self, topic, payload):
+        now = time.monotonic()
+        with self.lock:
+            while self.commands and self.commands[0][0] < now - 3 * self.lease_duration:
+                self.commands.popleft()
+            self.commands.append((now, topic, payload))
+
+    # Publish the data to be handed over to the next leader, if changed
+    def publish_handover(self, data):
+        if not self.is_leader():
+            return
+        with self.lock:
+            payload = codec.dumps({'instance': self.instance_id, 'epoch': self.lease['epoch'], **data}, sort_keys=True)
+            if payload == self.last_handover:
+                return
+            self.last_handover = payload
+        self.mqttc.publish(self.handover_topic, payload=payload, qos=1, retain=True)
+
+    def publish_lease(self, epoch):
+        self.mqttc.publish(self.lease_topic, payload=codec.dumps({'instance': self.instance_id, 'epoch': epoch}), qos=1, retain=True)
+        self.last_renewal = time.monotonic()
+
+    # Perform the state transitions that are due at the current time.
+    # Return the callback to be invoked (outside the lock), if any
+    def tick(self):
+        now = time.monotonic()
+        with self.lock:
+            lease_expired = self.lease_received_at is None or now - self.lease_received_at > self.lease_duration
+            if self.state == LEADER:
+                if lease_expired:
+                    # Own renewals are not coming back from the broker
+                    log.warning("Lease could not be renewed: switching to standby")
+                    self.state = STANDBY
+                    return self.on_deposed
+                if now - self.last_renewal >= self.lease_duration / 3:
+                    self.publish_lease(self.lease['epoch'])
+            elif self.state == CLAIMING:
+                if self.claim_confirmed_at is not None and now - self.claim_confirmed_at >= self.settle_time:
+                    log.info("Instance %s is now the leader (epoch %i)" % (self.instance_id, self.lease['epoch']))
+                    self.state = LEADER
+                    handover = self.handover
+                    commands = [(topic, payload) for t, topic, payload in self.commands if self.handover_received_at is None or t > self.handover_received_at]
+                    self.commands.clear()
+                    return lambda: self.on_elected(handover, commands)
+                if now - self.claim_started_at > self.lease_duration:
+                    log.warning("Claim of the lease has not been confirmed by the broker: trying again")
+                    self.state = STANDBY
+            elif self.connected_at is not None and now - self.connected_at >= self.settle_time:
+                if self.lease is None or lease_expired:
+                    epoch = (self.lease['epoch'] if self.lease else 0) + 1
+                    log.info("No valid lease found: claiming leadership (epoch %i)" % epoch)
+                    self.state = CLAIMING
+                    self.claim_started_at = now
+                    self.claim_confirmed_at = None
+                    self.publish_lease(epoch)
+        return None
+
+    def run(self):
+        while not self.stopped:
+            callback = self.tick()
+            if callback is not None:
+                try:
+                    callback()
+                except Exception as e:
+                    log.error("Exception raised while changing leadership state: %s" % repr(e))
+            self.wake.wait(self.tick_interval)
+            self.wake.clear()
+
+    def start(self, mqttc):
+        self.mqttc = mqttc
+        self.setup_mqtt_callbacks()
+        self.thread = threading.Thread(target=self.run, name='election', daemon=True)
+        self.thread.start()
+
+    # Stop taking part in the election. A leader releases its lease, so
+    # that a standby can take over right away
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+        messages = []
+        if self.is_leader():
+            log.info("Releasing leadership")
+            self.state = STANDBY
+            messages.append(self.mqttc.publish(self.lease_topic, payload=None, qos=1, retain=True))
+        messages.append(self.mqttc.publish(self.presence_topic(self.instance_id), payload="offline", qos=1, retain=True))
+        try:
+            for m in messages:
+                m.wait_for_publish(2)
+        except (RuntimeError, ValueError) as e:
+            log.warning("Failed to notify other instances before quitting: %s" % repr(e))
+
+    def __init__(self, instance_id, lease_topic, handover_topic, lease_duration, on_elected, on_deposed):
+        # The MQTT client is set upon start, as the Last Will must
+        # be known before connecting to the broker
+        self.mqttc = None
+        self.thread = None
+        self.instance_id = instance_id
+        self.lease_topic = lease_topic
+        self.handover_topic = handover_topic
+        self.lease_duration = lease_duration
+        # Invoked as on_elected(handover, commands) upon becoming the
+        # leader, and as on_deposed() upon losing leadership
+        self.on_elected = on_elected
+        self.on_deposed = on_deposed
+        self.settle_time = min(2, lease_duration / 5)
+        self.tick_interval = min(1, lease_duration / 10)
+        self.lock = Lock()
+        self.wake = Event()
+        self.stopped = False
+        self.state = STANDBY
+        self.lease = None
+        self.lease_received_at = None
+        self.last_renewal = 0
+        self.connected_at = None
+        self.claim_started_at = None
+        self.claim_confirmed_at = None
+        self.handover = None
+        self.handover_received_at = None
+        self.last_handover = None
+        self.commands = deque()
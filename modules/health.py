@@ -0,0 +1,94 @@
+import threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+from modules.utilities import log
+from modules import codec
+
+LIVENESS = "liveness"
+READINESS = "readiness"
+
+# Health of smarther2mqtt, as a set of named checks. Each check is a
+# function that returns a tuple (ok, details), where details is a
+# dictionary that is reported as it is. Liveness checks tell whether the
+# process is still working at all (e.g., its threads are running), while
+# readiness checks also tell whether it is doing its job (e.g., the status
+# of the rooms is fresh and can be published). Checks are meant to only
+# look at values that are already at hand: they must never perform any
+# network I/O nor wait for anything, so that probes can be answered
+# in a matter of microseconds
+class HealthMonitor:
+    # Add a check, which is part of liveness checks (and, therefore,
+    # of readiness checks too) or of readiness checks only
+    def add_check(self, name, function, kind=READINESS):
+        self.checks[name] = (function, kind)
+
+    # Record that something (e.g., a successful poll) has just happened
+    def beat(self, name):
+        self.beats[name] = time.monotonic()
+
+    # Return the time elapsed since the last beat with the given
+    # name, or None if it has never happened
+    def age(self, name):
+        last = self.beats.get(name)
+        return None if last is None else time.monotonic() - last
+
+    # Run the checks of the given kind. Return a tuple (ok, report)
+    def run_checks(self, kind):
+        report = {}
+        healthy = True
+        for name, (function, check_kind) in list(self.checks.items()):
+            if kind == LIVENESS and check_kind != LIVENESS:
+                continue
+            try:
+                ok, details = function()
+            except Exception as e:
+                ok, details = False, {'error': repr(e)}
+            report[name] = dict(details, ok=ok)
+            healthy = healthy and ok
+        return healthy, {'status': "ok" if healthy else "fail", 'uptime': round(time.monotonic() - self.started_at, 1), 'checks': report}
+
+    def __init__(self):
+        self.checks = {}
+        self.beats = {}
+        self.started_at = time.monotonic()
+
+def HealthHTTPRequestHandler(monitor):
+    class HTTPRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path in ("/health", "/live"):
+                healthy, report = monitor.run_checks(LIVENESS)
+            elif path == "/ready":
+                healthy, report = monitor.run_checks(READINESS)
+            else:
+                self.send_error(404)
+                return
+            body = codec.dumps(report).encode("utf-8")
+            self.send_response(200 if healthy else 503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Probes are frequent: they are not worth a log message each
+            pass
+
+    return HTTPRequestHandler
+
+# Run a long-lived web server that answers liveness probes on /health
+# (or /live) and readiness probes on /ready with HTTP status 200 or 503
+# and a JSON report of all the checks, in a separate (daemon) thread.
+# As the endpoint is enabled by default, failing to listen on the given
+# port (e.g., as it is used by another instance on the same host) is not
+# fatal: None is returned
+def start_health_server(ipaddress, port, monitor):
+    try:
+        server = ThreadingHTTPServer((ipaddress, port), HealthHTTPRequestHandler(monitor))
+    except OSError as e:
+        log.error("Unable to expose health checks on http://%s:%i: %s. Continuing without health endpoint" % (ipaddress, port, e.strerror))
+        return None
+    log.info("Exposing health checks on http://%s:%i/health and /ready" % (ipaddress, port))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='health', daemon=True).start()
+    return server
@@ -0,0 +1,229 @@
+import math, mmap, os, struct
+from threading import Lock
+from modules.utilities import log, mode_NA_to_user
+
+# Setpoint modes, as reported by the Netatmo cloud, encoded as 1-based
+# indexes in the history (0 means unknown)
+MODES = ('home', 'manual', 'max', 'hg', 'schedule', 'away', 'off')
+
+# Downsampling tiers: name and resolution in seconds (0 means that every
+# sample is kept as it is)
+TIERS = (('raw', 0), ('5m', 300), ('1h', 3600))
+
+# Default number of samples kept by each tier: 24 hours of raw samples
+# at the default polling interval, a week of 5-minute averages and a
+# year of hourly averages
+DEFAULT_CAPACITIES = {'raw': 5760, '5m': 2016, '1h': 8760}
+
+# A sample: timestamp (seconds since the epoch), measured temperature,
+# humidity, setpoint temperature (NaN when unknown) and encoded mode
+RECORD = struct.Struct('<Ifffb3x')
+
+# State of a ring: index of the next record to be written, number of
+# records, then the samples accumulated for the current bucket of a
+# downsampled tier (start of the bucket, number of samples, sum and
+# number of known values of temperature, humidity and setpoint, last mode)
+RING_HEADER = struct.Struct('<IIIIdddIIIb3x')
+
+FILE_MAGIC = b'S2MHIST1'
+FILE_HEADER = struct.Struct('<8sIIII')
+ROOM_ID = struct.Struct('<64s')
+
+def encode_mode(mode):
+    return MODES.index(mode) + 1 if mode in MODES else 0
+
+# Decode a mode into its user-facing name (as published on the mode topic)
+def decode_mode(value):
+    if not 0 < value <= len(MODES):
+        return None
+    return mode_NA_to_user.get(MODES[value - 1], MODES[value - 1])
+
+def to_float(value):
+    return float('nan') if value is None else float(value)
+
+# Return None in place of NaN, which has no JSON representation
+def from_float(value):
+    return None if math.isnan(value) else round(value, 2)
+
+# Fixed-size ring of samples of a room, stored at a given offset of
+# a buffer (i.e., a memory-mapped file) along with its state
+class HistoryRing:
+    def header(self):
+        return list(RING_HEADER.unpack_from(self.buffer, self.offset))
+
+    def set_header(self, header):
+        RING_HEADER.pack_into(self.buffer, self.offset, *header)
+
+    def append(self, header, record):
+        RECORD.pack_into(self.buffer, self.records_offset + header[0] * RECORD.size, *record)
+        header[0] = (header[0] + 1) % self.capacity
+        header[1] = min(header[1] + 1, self.capacity)
+
+    # Add a sample. Downsampled tiers accumulate the samples of the current
+    # bucket, and store their average when the first sample of the next
+    # bucket is added
+    def add(self, timestamp, temperature, humidity, setpoint, mode):
+        header = self.header()
+        if self.resolution == 0:
+            self.append(header, (timestamp, temperature, humidity, setpoint, mode))
+            self.set_header(header)
+            return
+        bucket = timestamp - timestamp % self.resolution
+        if header[3] > 0 and header[2] != bucket:
+            self.append(header, (header[2],
+                                 header[4] / header[7] if header[7] else math.nan,
+                                 header[5] / header[8] if header[8] else math.nan,
+                                 header[6] / header[9] if header[9] else math.nan,
+                                 header[10]))
+            header[3:11] = [0, 0.0, 0.0, 0.0, 0, 0, 0, 0]
+        header[2] = bucket
+        header[3] += 1
+        for i, value in enumerate((temperature, humidity, setpoint)):
+            if not math.isnan(value):
+                header[4 + i] += value
+                header[7 + i] += 1
+        if mode:
+            header[10] = mode
+        self.set_header(header)
+
+    # Return the records with start <= timestamp <= end, oldest first
+    def records(self, start, end):
+        head, count = self.header()[:2]
+        first = (head - count) % self.capacity
+        segments = [(first, min(first + count, self.capacity))]
+        if first + count > self.capacity:
+            segments.append((0, head))
+        result = []
+        for a, b in segments:
+            data = self.buffer[self.records_offset + a * RECORD.size:self.records_offset + b * RECORD.size]
+            result.extend(r for r in RECORD.iter_unpack(data) if start <= r[0] <= end)
+        return result
+
+    # Return the timestamp of the oldest record, or None if empty
+    def oldest(self):
+        head, count = self.header()[:2]
+        if count == 0:
+            return None
+        return RECORD.unpack_from(self.buffer, self.records_offset + ((head - count) % self.capacity) * RECORD.size)[0]
+
+    def clear(self):
+        self.set_header([0, 0, 0, 0, 0.0, 0.0, 0.0, 0, 0, 0, 0])
+
+    def __init__(self, buffer, offset, capacity, resolution):
+        self.buffer = buffer
+        self.offset = offset
+        self.records_offset = offset + RING_HEADER.size
+        self.capacity = capacity
+        self.resolution = resolution
+
+    @staticmethod
+    def size(capacity):
+        return RING_HEADER.size + capacity * RECORD.size
+
+# History of the status of the rooms, kept in a ring per room and per tier
+# (raw samples, 5-minute and hourly averages). Memory usage is fixed, as
+# determined by the capacity of the tiers, and all the rings live in a
+# memory-mapped file, so that the history survives restarts. If the file
+# does not match the configured rooms or capacities, it is reinitialized
+class HistoryBuffer:
+    # Record the status of a room at the given time (seconds since the epoch)
+    def record(self, room_id, timestamp, temperature, humidity, setpoint, mode):
+        rings = self.rings.get(room_id)
+        if rings is None:
+            return
+        sample = (int(timestamp), to_float(temperature), to_float(humidity), to_float(setpoint), encode_mode(mode))
+        with self.lock:
+            for ring in rings.values():
+                ring.add(*sample)
+
+    # Pick the finest tier that still covers the given start time or,
+    # if none does, the finest one among those that go back the furthest
+    def auto_tier(self, room_id, start):
+        candidates = []
+        with self.lock:
+            for i, (name, resolution) in enumerate(TIERS):
+                oldest = self.rings[room_id][name].oldest()
+                if oldest is None:
+                    continue
+                if oldest <= start:
+                    return name
+                candidates.append((oldest, i, name))
+        return min(candidates)[2] if candidates else TIERS[0][0]
+
+    # Return the samples of a room between start and end (seconds since
+    # the epoch, both included) as columns, ready to be serialized
+    def query(self, room_id, tier, start, end):
+        if room_id not in self.rings:
+            raise ValueError("unknown room %s" % room_id)
+        if tier == 'auto':
+            tier = self.auto_tier(room_id, start)
+        if tier not in self.rings[room_id]:
+            raise ValueError("unknown tier %s" % tier)
+        with self.lock:
+            records = self.rings[room_id][tier].records(start, end)
+        return {
+            'room': room_id,
+            'tier': tier,
+            'resolution': dict(TIERS)[tier],
+            'time': [r[0] for r in records],
+            'temperature': [from_float(r[1]) for r in records],
+            'humidity': [from_float(r[2]) for r in records],
+            'setpoint': [from_float(r[3]) for r in records],
+            'mode': [decode_mode(r[4]) for r in records]
+        }
+
+    # Write the changes to the file
+    def flush(self):
+        with self.lock:
+            try:
+                self.buffer.flush()
+            except (OSError, ValueError) as e:
+                log.warning("Error while attempting to save history to file \"%s\": %s" % (self.path, repr(e)))
+
+    def header(self):
+        return FILE_HEADER.pack(FILE_MAGIC, len(self.room_ids), *(self.capacities[name] for name, resolution in TIERS)) + \
+            b''.join(ROOM_ID.pack(room_id.encode("utf-8")) for room_id in self.room_ids)
+
+    # Map the history file into memory, creating it (or reinitializing
+    # it) as needed. Fall back to anonymous memory if the file cannot be
+    # used, so that the history is still kept while running
+    def open(self, size):
+        header = self.header()
+        try:
+            exists = os.path.isfile(self.path)
+            f = open(self.path, mode="r+b" if exists else "w+b")
+            with f:
+                valid = exists and os.path.getsize(self.path) == size and f.read(len(header)) == header
+                if not valid:
+                    if exists:
+                        log.info("History file \"%s\" does not match the configured rooms or capacities: reinitializing it" % self.path)
+                    f.truncate(0)
+                    f.truncate(size)
+                buffer = mmap.mmap(f.fileno(), size)
+        except (OSError, ValueError) as e:
+            log.warning("Unable to use history file \"%s\": %s. History will not be persisted" % (self.path, repr(e)))
+            buffer, valid = mmap.mmap(-1, size), False
+        if not valid:
+            buffer[:len(header)] = header
+        return buffer, valid
+
+    def __init__(self, path, room_ids, capacities=None):
+        self.path = path
+        self.lock = Lock()
+        self.room_ids = sorted(room_ids)
+        self.capacities = dict(DEFAULT_CAPACITIES, **(capacities or {}))
+        rooms_size = sum(HistoryRing.size(self.capacities[name]) for name, resolution in TIERS)
+        data_offset = FILE_HEADER.size + len(self.room_ids) * ROOM_ID.size
+        self.buffer, loaded = self.open(data_offset + len(self.room_ids) * rooms_size)
+        # Rings of each room, by tier
+        self.rings = {}
+        offset = data_offset
+        for room_id in self.room_ids:
+            self.rings[room_id] = {}
+            for name, resolution in TIERS:
+                ring = HistoryRing(self.buffer, offset, self.capacities[name], resolution)
+                if not loaded:
+                    ring.clear()
+                self.rings[room_id][name] = ring
+                offset += HistoryRing.size(self.capacities[name])
+        log.debug("History of %i rooms mapped from \"%s\" (%i bytes, %s)" % (len(self.room_ids), self.path, len(self.buffer), "loaded" if loaded else "initialized"))
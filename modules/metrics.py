@@ -0,0 +1,173 @@
+import bisect, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock
+from modules.utilities import log
+
+# Minimal collection of metrics, exposed over HTTP in the Prometheus text
+# exposition format. Metrics are cheap to update (a lock, a bisection and
+# a couple of additions), so that they can be collected all the time.
+# Each metric can have a single label, whose name is set upon creation
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def format_labels(label_name, label_value, extra=""):
+    labels = []
+    if label_name is not None:
+        labels.append('%s="%s"' % (label_name, label_value))
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+class Counter:
+    def inc(self, amount=1, label=None):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self.lock:
+            for label, value in self.values.items():
+                lines.append("%s%s %s" % (self.name, format_labels(self.label_name, label), value))
+        return lines
+
+    def __init__(self, name, help, label_name=None):
+        self.name = name
+        self.help = help
+        self.label_name = label_name
+        self.lock = Lock()
+        self.values = {}
+
+class Histogram:
+    def observe(self, value, label=None):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if label not in self.counts:
+                self.counts[label] = [0] * (len(self.buckets) + 1)
+                self.sums[label] = 0
+            self.counts[label][i] += 1
+            self.sums[label] += value
+
+    # Return an object to be used in a "with" statement, which
+    # observes the time spent in the enclosed block of code
+    def time(self, label=None):
+        return HistogramTimer(self, label)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for label, counts in self.counts.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %i" % (self.name, format_labels(self.label_name, label, 'le="%s"' % bound), cumulative))
+                lines.append("%s_sum%s %f" % (self.name, format_labels(self.label_name, label), self.sums[label]))
+                lines.append("%s_count%s %i" % (self.name, format_labels(self.label_name, label), cumulative))
+        return lines
+
+    def __init__(self, name, help, label_name=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_name = label_name
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        self.counts = {}
+        self.sums = {}
+
+class HistogramTimer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start, self.label)
+
+    def __init__(self, histogram, label):
+        self.histogram = histogram
+        self.label = label
+
+# A metric whose value is only computed (by invoking a function)
+# when metrics are exposed. This suits values that are already
+# tracked somewhere else and have no cost in the hot path
+class FunctionMetric:
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        try:
+            lines.append("%s %s" % (self.name, self.function()))
+        except Exception as e:
+            log.debug("Failed to collect metric %s: %s" % (self.name, repr(e)))
+        return lines
+
+    def __init__(self, name, help, function, type="gauge"):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.type = type
+
+class MetricsRegistry:
+    def add(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label_name=None):
+        return self.add(Counter(name, help, label_name))
+
+    def histogram(self, name, help, label_name=None, buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, label_name, buckets))
+
+    def function(self, name, help, function, type="gauge"):
+        return self.add(FunctionMetric(name, help, function, type))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for m in metrics:
+            lines += m.render()
+        return "\n".join(lines) + "\n"
+
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = {}
+
+registry = MetricsRegistry()
+
+# Metrics collected in the hot paths
+api_latency = registry.histogram("smarther2mqtt_api_request_seconds", "Latency of requests to the Netatmo API", "endpoint")
+api_response_size = registry.histogram("smarther2mqtt_api_response_bytes", "Size of the bodies of responses from the Netatmo API", "endpoint", (256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072))
+json_decode_time = registry.histogram("smarther2mqtt_json_decode_seconds", "Time spent decoding JSON responses", "document", (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+token_refreshes = registry.counter("smarther2mqtt_token_refreshes_total", "Number of OAuth token refreshes", "trigger")
+poll_cycle_duration = registry.histogram("smarther2mqtt_poll_cycle_seconds", "Duration of polling cycles")
+poll_jitter = registry.histogram("smarther2mqtt_poll_jitter_seconds", "Delay of polling cycles with respect to their schedule")
+api_retries = registry.counter("smarther2mqtt_api_retries_total", "Retries of failed calls to the Netatmo API", "failure")
+command_confirmation_time = registry.histogram("smarther2mqtt_command_confirmation_seconds", "Time from the request of a thermostat update to its confirmation by the Netatmo cloud", None, (1, 2, 5, 10, 15, 20, 30, 60, 120, 300))
+command_handling_time = registry.histogram("smarther2mqtt_command_handling_seconds", "Time spent handling MQTT commands", "topic", (0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+
+def MetricsHTTPRequestHandler(registry):
+    class HTTPRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_error(404)
+
+        # Requests are not logged, as they are usually periodic scrapes
+        def log_message(self, format, *args):
+            pass
+
+    return HTTPRequestHandler
+
+# Run a long-lived web server that exposes metrics on /metrics,
+# in a separate (daemon) thread
+def start_metrics_server(ipaddress, port):
+    log.info("Exposing metrics on http://%s:%i/metrics" % (ipaddress, port))
+    server = ThreadingHTTPServer((ipaddress, port), MetricsHTTPRequestHandler(registry))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
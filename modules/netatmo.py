@@ -1,8 +1,16 @@
-import os, sys, json, threading, requests, signal, time
+import itertools, os, sys, threading, requests, signal, time
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from queue import Queue
-from threading import Timer, Lock
-from modules.utilities import log, settings, LogRequester, signal_to_interrupt
+from urllib.parse import quote, urlencode
+from threading import Lock
+from modules.utilities import log, settings, LogRequester, signal_to_interrupt, configured_rooms
+from modules.polling import RateBudget, PollScheduler
+from modules.retry import CONNECTION, SERVER_ERROR, RATE_LIMIT, TOKEN_EXPIRED, classify_failure, configured_policies
+from modules.scheduler import DebounceScheduler
+from modules import metrics, codec
 
 def MinimalHTTPRequestHandler(redirect_url, msg_queue):
     class HTTPRequestHandler(BaseHTTPRequestHandler):
@@ -39,6 +47,67 @@ def MinimalHTTPRequestHandler(redirect_url, msg_queue):
             
     return HTTPRequestHandler
 
+# An HTTP adapter that keeps count of the connections it has established,
+# which tells whether a request has been sent over a reused connection
+class ConnectionCountingHTTPAdapter(HTTPAdapter):
+    def __init__(self, *args, **kwargs):
+        self.connections_established = 0
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+
+        class CountingHTTPConnection(HTTPConnection):
+            def connect(self):
+                adapter.connections_established += 1
+                super().connect()
+        class CountingHTTPSConnection(HTTPSConnection):
+            def connect(self):
+                adapter.connections_established += 1
+                super().connect()
+        class CountingHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = CountingHTTPConnection
+        class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = CountingHTTPSConnection
+
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool
+        }
+
+# Status of a single room (thermostat) served by this instance, including
+# the target setpoint and mode of any pending thermostat update
+class RoomState:
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.target_mode = None
+        self.target_temperature = None
+        self.last_set_temperature = None
+        self.last_set_mode = None
+        # Time of the first request of the pending update, if any
+        self.requested_at = None
+        # Update that is being sent (or waiting to be retried), as taken
+        # over by send_thermostat_update
+        self.in_flight = None
+        # Update that has been sent, but not yet confirmed by the status
+        # retrieved from the Netatmo cloud
+        self.unconfirmed = None
+
+# Fields of the status of a room that are used by smarther2mqtt
+ROOM_STATUS_FIELDS = ('therm_measured_temperature', 'humidity', 'therm_setpoint_temperature', 'therm_setpoint_mode', 'therm_setpoint_end_time')
+
+# Extract the status of the given rooms from the JSON description of a
+# home, keeping only the fields that are used. The status of each room
+# is indexed by room id, so that it can be looked up in constant time
+def extract_rooms(home_json, room_ids):
+    return {r['id']: {k: r.get(k) for k in ROOM_STATUS_FIELDS} for r in home_json.get('rooms', []) if r.get('id') in room_ids}
+
+# Return the types of the modules that are located in the given rooms,
+# according to a summary of the topology of a home (see snapshot.py)
+def room_device_types(topology, room_ids):
+    return sorted(set(m['type'] for m in topology.get('modules', []) if m.get('room_id') in room_ids and m.get('type')))
+
 class NetatmoToken:
     # Load last used token from a file, whose
     # name is defined in the settings. This
@@ -56,9 +125,9 @@ class NetatmoToken:
                 return
             
             try:
-                token = json.load(f)
-            except json.JSONDecodeError as e:
-                log.warning("Invalid syntax in token file \"%s\": %s at line %i", self.TOKEN_FILE, e.msg, e.lineno)
+                token = codec.loads(f.read())
+            except ValueError as e:
+                log.warning("Invalid syntax in token file \"%s\": %s", self.TOKEN_FILE, e)
                 f.close()
                 return
             f.close()
@@ -82,10 +151,17 @@ class NetatmoToken:
             log.warning("Error while attempting to save token to file \"%s\": %s", self.TOKEN_FILE, e.strerror)
             return
     
-        f.write(json.dumps(self.token))
+        f.write(codec.dumps(self.token))
         f.close()
 
     
+    # Load the token again from file, as it may have been refreshed by
+    # another instance sharing the same token file, and schedule its refresh
+    def reload_token(self):
+        with self.token_lock:
+            self.load_token_from_file()
+        self.schedule_token_refresh()
+
     # Return token stored in the current NetatmoToken instance
     def current_token(self):
         return self.token
@@ -95,14 +171,80 @@ class NetatmoToken:
     def token_exists(self):
         return self.token is not None
 
+    # Return the persistent HTTP session that is used for all the requests
+    # to the Netatmo API (and to the other services the tool talks to), so
+    # that connections are kept alive and reused across requests rather
+    # than being established from scratch (including the TLS handshake)
+    # every time. Connections that have been idle for longer than the
+    # configured timeout are discarded, as they have most likely been
+    # closed by the server in the meantime. The session is shared by
+    # several threads (polling, scheduler, topology refresh)
+    def http_session(self):
+        with self.session_lock:
+            if self.session is not None and time.monotonic() - self.session_last_used > self.HTTP_IDLE_TIMEOUT:
+                log.debug("HTTP session idle for more than %i seconds: discarding pooled connections" % self.HTTP_IDLE_TIMEOUT)
+                self.session = None
+            if self.session is None:
+                log.debug("Creating HTTP session with a pool of %i connections" % self.HTTP_POOL_SIZE)
+                self.session = requests.Session()
+                # Failed requests are never repeated by the adapter: retries are
+                # left to the retry policies of netatmo_api_call, so that every
+                # request sent goes through the rate budget and is accounted for.
+                # Token requests, in particular, must never be sent twice, as a
+                # repeated refresh revokes the token obtained by the first one
+                adapter = ConnectionCountingHTTPAdapter(
+                    pool_connections=self.HTTP_POOL_SIZE,
+                    pool_maxsize=self.HTTP_POOL_SIZE,
+                    max_retries=0
+                )
+                self.session.mount("https://", adapter)
+                self.session.mount("http://", adapter)
+            self.session_last_used = time.monotonic()
+            return self.session
+
+    # Discard all the pooled connections of the given session (by default,
+    # the current one), unless it has already been replaced. A new session
+    # is created when the next request is sent. The discarded session is not
+    # closed, as other threads may still be sending requests through it:
+    # its connections are closed once it is garbage collected
+    def reset_http_session(self, session=None):
+        with self.session_lock:
+            if session is None or session is self.session:
+                self.session = None
+
+    # Send an HTTP request by using the persistent session, with the
+    # configured connect/read timeouts. Whether a pooled connection has
+    # been reused or a new one has been established is logged at debug level
+    def http_request(self, method, url, **kwargs):
+        session = self.http_session()
+        adapter = session.get_adapter(url)
+        endpoint = url.split('?')[0].rsplit('/', 1)[-1]
+        # Every request counts against the API rate limits, whatever its outcome
+        self.rate_budget.record_call(endpoint)
+        connections_before = adapter.connections_established
+        try:
+            with metrics.api_latency.time(endpoint):
+                r = session.request(method, url, timeout=(self.HTTP_CONNECT_TIMEOUT, self.HTTP_READ_TIMEOUT), **kwargs)
+        except requests.ConnectionError:
+            # Drop all pooled connections, so that the next request starts
+            # from a clean state after a network failure
+            self.reset_http_session(session)
+            raise
+        metrics.api_response_size.observe(len(r.content), endpoint)
+        if adapter.connections_established > connections_before:
+            log.debug("%s %s sent over a new connection", method, url)
+        else:
+            log.debug("%s %s reused a pooled connection", method, url)
+        return r
+
     # Parse JSON structure of a token and return a corresponding Python
     # data structure
     def parse_json_token(self, token_string):
         temp_token = None
         try:
-            log.debug("Attempting to decode token %s" % token_string)
-            temp_token = json.loads(token_string)
-        except json.JSONDecodeError as e:
+            log.debug("Attempting to decode token %s", token_string)
+            temp_token = codec.loads(token_string)
+        except ValueError as e:
             log.error("Failure while decoding token: %s - Token dump:%s" % (repr(e), token_string))
 
         if 'access_token' not in temp_token or \
@@ -110,8 +252,38 @@ class NetatmoToken:
             log.error("Token is invalid: %s" % token_string)
             return None
 
+        # Record the time when the token expires, so that it can be
+        # refreshed in advance (also after loading it from file)
+        if 'expires_in' in temp_token:
+            temp_token['expires_at'] = int(time.time()) + int(temp_token['expires_in'])
+
         return temp_token
 
+    # Schedule a refresh of the current token shortly before it expires, so
+    # that API calls never need to be repeated because of an expired token.
+    # Nothing is done if the expiry time of the token is unknown
+    def schedule_token_refresh(self, delay=None):
+        if self.token is None or 'expires_at' not in self.token:
+            log.debug("Token expiry time unknown: token will only be refreshed upon expiry")
+            return
+        if delay is None:
+            delay = max(self.token['expires_at'] - self.TOKEN_REFRESH_MARGIN - time.time(), 0)
+        log.debug("Scheduling token refresh within %i seconds" % delay)
+        self.scheduler.schedule_at(('token_refresh',), time.monotonic() + delay, self.refresh_token_in_background)
+
+    # Refresh the token before it expires. This method is meant
+    # to be invoked by the scheduler
+    def refresh_token_in_background(self):
+        if not self.refresh_in_advance():
+            log.debug("Token is about to expire, but it is not refreshed in advance by this instance")
+            return
+        log.debug("Token is about to expire: refreshing it in advance")
+        try:
+            self.refresh_token("proactive")
+        except Exception as e:
+            log.warning("Failed to refresh token in advance: %s. Trying again in 60 seconds" % repr(e))
+            self.schedule_token_refresh(60)
+
     # Do whatever is required to obtain a new token from the Netatmo API cloud.
     # This is different from refreshing a token. The only optional argument is a
     # list of classes which implement a "publish" method that is used to present
@@ -125,7 +297,7 @@ class NetatmoToken:
         # to access the URL is published on all applicable
         # communication channels
         for c in channels_list:
-            c().publish("The *Netatmo Smarther2* tool requires authorization. Please grant it by accessing this web page: http://%s:%i/authorize" % (self.HTTP_SERVER_IPADDRESS, self.HTTP_SERVER_PORT))
+            c(self.http_session()).publish("The *Netatmo Smarther2* tool requires authorization. Please grant it by accessing this web page: http://%s:%i/authorize" % (self.HTTP_SERVER_IPADDRESS, self.HTTP_SERVER_PORT))
 
         # Run a temporary web server to receive the OAuth2
         # authorization code. This is also used to serve a
@@ -142,7 +314,10 @@ class NetatmoToken:
         # Suspend this thread and wait until an authorization
         # code is received or the process is interrupted by
         # Ctrl+C or SIGTERM
-        signal.signal(signal.SIGTERM, signal_to_interrupt)
+        # (signal handlers can only be installed by the main thread)
+        in_main_thread = threading.current_thread() is threading.main_thread()
+        if in_main_thread:
+            signal.signal(signal.SIGTERM, signal_to_interrupt)
         try:
             netatmo_grant_code = self.msg_queue.get()
         except KeyboardInterrupt:
@@ -150,7 +325,8 @@ class NetatmoToken:
             sys.exit(0)
         log.debug("Received authorization code: \"%s\"" % netatmo_grant_code)
         temp_http_server.shutdown()
-        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if in_main_thread:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
         # Request token using the authorization code just
         # obtained
@@ -164,7 +340,7 @@ class NetatmoToken:
                 'scope': 'read_smarther write_smarther'
             }
             log.debug("Requesting token from %s with data: %s" % (self.NETATMO_TOKEN_URL, repr(token_request_data)))
-            r = requests.post(self.NETATMO_TOKEN_URL, data=token_request_data, timeout=20)
+            r = self.http_request("POST", self.NETATMO_TOKEN_URL, data=token_request_data)
             # Raise exception in case something went wrong
             r.raise_for_status()
         except requests.ConnectionError as e:
@@ -174,94 +350,158 @@ class NetatmoToken:
             log.error("HTTP error %i while contacting %s to obtain a token: %s" % (r.status_code, self.NETATMO_TOKEN_URL, repr(e)))
             raise
 
-        temp_token = self.parse_json_token(r.text)
+        temp_token = self.parse_json_token(r.content)
         if temp_token is None:
             raise Exception("Failed to receive token: invalid JSON format in %s" % r.text)
         log.info("New token successfully obtained")
         self.token = temp_token
         self.write_token_to_file()
+        self.schedule_token_refresh()
 
     # Refresh an existing token. The method returns True if the
-    # token is successfully refreshed; False otherwise.
-    def refresh_token(self):
-        try:
-            token_refresh_data = {
-                'grant_type': 'refresh_token',
-                'refresh_token': self.token['refresh_token'],
-                'client_id': self.CLIENT_ID,
-                'client_secret': self.CLIENT_SECRET
-            }
-            log.debug("Refreshing token from %s with data: %s" % (self.NETATMO_TOKEN_URL, repr(token_refresh_data)))
-            r = requests.post(self.NETATMO_TOKEN_URL, data=token_refresh_data, timeout=20)
-            # Raise exception in case something went wrong
-            r.raise_for_status()
-        except requests.ConnectionError as e:
-            log.error("Error while contacting %s to refresh token: %s" % (self.NETATMO_TOKEN_URL, repr(e)))
-            raise
-        except requests.HTTPError as e:
-            log.error("HTTP error %i while contacting %s to refresh token: %s" % (r.status_code, self.NETATMO_TOKEN_URL, repr(e)))
-            raise
+    # token is successfully refreshed; False otherwise. The trigger
+    # of the refresh is only used for accounting purposes. If the
+    # expired access token is given, the token is not refreshed again
+    # when it has already been replaced in the meantime
+    def refresh_token(self, trigger="expired", expired_access_token=None):
+        # Refreshes may be triggered both in the background and upon
+        # expiry: make sure they never overlap
+        with self.token_lock:
+            if expired_access_token is not None and self.token['access_token'] != expired_access_token:
+                # Concurrent calls that have failed with the same expired
+                # token must not refresh it again, as that would revoke
+                # the token just obtained by the first one
+                log.debug("Token already refreshed by a concurrent API call")
+                return
+            try:
+                token_refresh_data = {
+                    'grant_type': 'refresh_token',
+                    'refresh_token': self.token['refresh_token'],
+                    'client_id': self.CLIENT_ID,
+                    'client_secret': self.CLIENT_SECRET
+                }
+                log.debug("Refreshing token from %s with data: %s" % (self.NETATMO_TOKEN_URL, repr(token_refresh_data)))
+                r = self.http_request("POST", self.NETATMO_TOKEN_URL, data=token_refresh_data)
+                # Raise exception in case something went wrong
+                r.raise_for_status()
+            except requests.ConnectionError as e:
+                log.error("Error while contacting %s to refresh token: %s" % (self.NETATMO_TOKEN_URL, repr(e)))
+                raise
+            except requests.HTTPError as e:
+                log.error("HTTP error %i while contacting %s to refresh token: %s" % (r.status_code, self.NETATMO_TOKEN_URL, repr(e)))
+                raise
         
-        temp_token = self.parse_json_token(r.text)
-        if temp_token is None:
-            raise Exception("Failed to refresh token: invalid JSON format in %s" % r.text)
-        log.info("Token successfully refreshed")
-        self.token = temp_token
-        self.write_token_to_file()
+            temp_token = self.parse_json_token(r.content)
+            if temp_token is None:
+                raise Exception("Failed to refresh token: invalid JSON format in %s" % r.text)
+            log.info("Token successfully refreshed")
+            metrics.token_refreshes.inc(label=trigger)
+            self.token = temp_token
+            self.write_token_to_file()
+            self.schedule_token_refresh()
         
 
-    # Invoke a Netatmo API call. Grant token is automatically
-    # refreshed in case it has expired
-    def netatmo_api_call(self, url, request_parameters=None, attempt_errors=[]):
+    # Invoke a Netatmo API call. Transient failures (connection errors,
+    # server errors, rate limit hits) are retried according to the retry
+    # policy of the call type ('poll' or 'setstate'), with exponential
+    # backoff, until the deadline of the call. Retries also count against
+    # the rate budget, and are only sent as long as the global retry budget
+    # allows it. Grant token is automatically refreshed in case it has expired
+    def netatmo_api_call(self, url, request_parameters=None, call_type='poll'):
+        policy = self.retry_policies[call_type]
+        deadline = time.monotonic() + policy.deadline
+        retries = {}
+        while True:
+            access_token = self.token['access_token']
+            r, failure, error = self.send_api_request(url, request_parameters, access_token)
+            if error is None:
+                # The raw body is returned, so that it is decoded only once
+                # (JSON decoders accept bytes)
+                return r.content
+            delay = self.retry_delay(url, policy, failure, retries, r, deadline)
+            if delay is None:
+                return self.give_up_api_call(url, failure, r, error)
+            self.prepare_retry(url, policy, failure, retries, delay, access_token)
+            time.sleep(delay)
+
+    # Send a single API request, without retrying it. Return a tuple
+    # (response, failure, error): response is None if no response was
+    # received, failure is the class of failure and error the exception
+    # raised (both None if the request succeeded)
+    def send_api_request(self, url, request_parameters, access_token):
         request_headers = {
             'accept': 'application/json',
-            'Authorization': 'Bearer ' + self.token['access_token']
+            'Authorization': 'Bearer ' + access_token
         }
-
+        r = None
         try:
             if request_parameters:
-                log.debug("Sending request to %s with headers %s and parameters %s" % (url, request_headers, repr(request_parameters)))
-                r = requests.post(url, headers=request_headers, json=request_parameters, timeout=20)
+                log.debug("Sending request to %s with headers %s and parameters %r", url, request_headers, request_parameters)
+                r = self.http_request("POST", url, headers=request_headers, json=request_parameters)
             else:
-                log.debug("Sending request to %s with headers %s" % (url, request_headers))
-                r = requests.get(url, headers=request_headers, timeout=20)
+                log.debug("Sending request to %s with headers %s", url, request_headers)
+                r = self.http_request("GET", url, headers=request_headers)
             r.raise_for_status()
-        except requests.ConnectionError as e:
+            return r, None, None
+        except (requests.ConnectionError, requests.Timeout) as e:
             log.error("Error while performing API call %s: %s" % (url, repr(e)))
-            raise
+            return None, CONNECTION, e
         except requests.HTTPError as e:
             log.warn("HTTP error %i while performing API call %s: %s, details: %s" % (r.status_code, url, repr(e), r.text))
-            if r.status_code >= 500 and r.status_code <=599:
-                # Likely a temporary server error
-                log.warn("Possible server error: failing silently")
-                return r.text
-            if r.status_code == 403:
-                j = json.loads(r.text)
-                if j['error']['code'] == 3:
-                    if (403, 3) not in attempt_errors:
-                        # Error 403, code 3 has never occurred in any of the currently active recursive calls
-                        log.warn("Access token expired")
-                        self.refresh_token()
-                        log.info("Token successfully refreshed. Attempting to repeat last HTTP request")
-                        return self.netatmo_api_call(url, request_parameters, attempt_errors + [(403, 3)])
-                    else:
-                        log.error("Token expired error even after refreshing token (HTTP error %i while performing API call %s: %s)" % (r.status_code, url, repr(e)))
-                        raise
-            if r.status_code == 429:
-                j = json.loads(r.text)
-                if j['error']['code'] == 11:
-                    if not attempt_errors or attempt_errors[-1] != (429, 11):
-                        # Error 429, code 11 is not the latest occurred in the currently active recursive calls
-                        log.warn("Rate limit hit. Holding request for 30 seconds, then retrying")
-                        time.sleep(30)
-                        return self.netatmo_api_call(url, request_parameters, attempt_errors + [(429, 11)])
-                    else:
-                        log.warn("Rate limit hit again. Failing silently and giving up")
-                        # JSON error bodies are processed by the main loop anyway
-                        return r.text
-            log.error("HTTP error %i while performing API call %s: %s" % (r.status_code, url, repr(e)))
-            raise
-        return r.text
+            failure = classify_failure(r)
+            if failure == RATE_LIMIT:
+                self.rate_budget.record_rate_limit_hit()
+            return r, failure, e
+
+    # Return how long to wait before retrying a failed API call, or None
+    # if it must not be retried. retries counts the retries already sent
+    # for each class of failure
+    def retry_delay(self, url, policy, failure, retries, r, deadline):
+        rule = policy.rules.get(failure)
+        if rule is None or retries.get(failure, 0) >= rule.max_retries:
+            return None
+        if failure == TOKEN_EXPIRED:
+            return 0
+        # Never wait less than the server asks for, nor than
+        # needed to stay within the rate budget
+        retry_after = r.headers.get('Retry-After', '') if r is not None else ''
+        delay = max(rule.delay(retries.get(failure, 0) + 1), float(retry_after) if retry_after.isdigit() else 0, self.rate_budget.delay())
+        if time.monotonic() + delay > deadline:
+            log.warn("No time left to retry API call %s before its deadline" % url)
+            return None
+        if not self.rate_budget.allow_retry(failure):
+            log.warn("Retry budget exhausted: not retrying API call %s" % url)
+            return None
+        return delay
+
+    # Account for a retry that is about to be scheduled. In case the
+    # access token has expired, it is refreshed before returning
+    def prepare_retry(self, url, policy, failure, retries, delay, access_token):
+        retries[failure] = retries.get(failure, 0) + 1
+        metrics.api_retries.inc(label=failure)
+        if failure == TOKEN_EXPIRED:
+            log.warn("Access token expired")
+            self.refresh_token(expired_access_token=access_token)
+            log.info("Token successfully refreshed. Attempting to repeat last HTTP request")
+        else:
+            log.warn("API call %s failed (%s): retry %i of %i in %.1f seconds" % (url, failure, retries[failure], policy.rules[failure].max_retries, delay))
+
+    # Give up a failed API call: return the body of error responses that
+    # are processed by the caller anyway, raise the error otherwise
+    def give_up_api_call(self, url, failure, r, error):
+        if failure == SERVER_ERROR:
+            # Likely a temporary server error
+            log.warn("Possible server error: failing silently")
+            return r.content
+        if failure == RATE_LIMIT:
+            log.warn("Rate limit hit. Failing silently and giving up")
+            # JSON error bodies are processed by the main loop anyway
+            return r.content
+        if failure == TOKEN_EXPIRED:
+            log.error("Token expired error even after refreshing token (HTTP error %i while performing API call %s: %s)" % (r.status_code, url, repr(error)))
+        elif r is not None:
+            log.error("HTTP error %i while performing API call %s: %s" % (r.status_code, url, repr(error)))
+        raise error
 
     # Methods for specific API calls follow
 
@@ -270,15 +510,45 @@ class NetatmoToken:
         request_url = self.BASE_URL + self.HOMESDATA
         return self.netatmo_api_call(request_url)
     
-    # Get information about a specific home
+    # Get information about a specific home. If device types are set
+    # (see set_homestatus_device_types), only the status of modules of
+    # those types is requested
     def query_homestatus(self, home_id):
-        request_url = self.BASE_URL + self.HOMESTATUS + "?home_id=" + home_id
+        parameters = {'home_id': home_id}
+        if self.homestatus_device_types:
+            parameters['device_types'] = self.homestatus_device_types
+        request_url = self.BASE_URL + self.HOMESTATUS + "?" + urlencode(parameters, doseq=True)
+        return self.netatmo_api_call(request_url)
+
+    # Restrict /homestatus requests to the given device types (e.g., the
+    # types of the thermostats), so that the status of unrelated modules
+    # of the same home (lights, plugs, etc.) is not transferred and parsed
+    # at every poll. None restores unrestricted requests
+    def set_homestatus_device_types(self, device_types):
+        if device_types != self.homestatus_device_types:
+            log.debug("Requesting the status of device types: %s" % (", ".join(device_types) if device_types else "<all>"))
+            self.homestatus_device_types = device_types
+
+    # Register (or unregister) the URL that webhook events are
+    # sent to by the Netatmo cloud
+    def add_webhook(self, url):
+        request_url = self.BASE_URL + self.ADDWEBHOOK + "?url=" + quote(url, safe="")
+        return self.netatmo_api_call(request_url)
+
+    def drop_webhook(self):
+        request_url = self.BASE_URL + self.DROPWEBHOOK
         return self.netatmo_api_call(request_url)
 
 
     # Convenience function to wrap parameters in a proper JSON
     # data structure that is expected by the Netatmo Connect API
     def prepare_room_request(self, home_id, room_id, parameters_dict):
+        return self.prepare_rooms_request(home_id, {room_id: parameters_dict})
+
+    # Same as above, for several rooms at once. The Netatmo Connect API
+    # accepts changes to multiple rooms in a single request. The argument
+    # rooms_parameters maps room ids to the parameters for each room
+    def prepare_rooms_request(self, home_id, rooms_parameters):
         return {
             "home": {
                 "id": home_id,
@@ -286,7 +556,7 @@ class NetatmoToken:
                     {
                         "id": room_id,
                         **parameters_dict
-                    }
+                    } for room_id, parameters_dict in rooms_parameters.items()
                 ]
             }
         }
@@ -297,126 +567,348 @@ class NetatmoToken:
     # changes are received.
     # Once a long enough period of silence is detected, a request is issued that
     # integrates all required status changes that have been gathered in the meantime.
-
-    # Utility method to commit a thermostat status change. This method is
-    # meant to be invoked by a Timer object
-    def send_thermostat_update(self):
+    # Unless disabled in the settings, changes to different rooms that are
+    # requested within the same time window are sent in a single request.
+
+    # Return the parameters that apply the pending changes of a room
+    def room_update_parameters(self, room):
+        request_parameters_data = {}
+        if room.target_temperature:
+            request_parameters_data["therm_setpoint_temperature"] = room.target_temperature
+        if room.target_mode:
+            request_parameters_data["therm_setpoint_mode"] = room.target_mode
+        if settings['netatmo']['default_duration'] is not None:
+            if int(settings['netatmo']['default_duration']) > 0:
+                request_parameters_data["therm_setpoint_end_time"] = int(time.time()) + int(settings['netatmo']['default_duration']) * 60
+            else:
+                # 2147483647 is the magic value for "until a new order",
+                # as documented in https://dev.netatmo.com/apidocumentation/control#setstate.
+                # However, it seems to cause HTTP error 403 with description "Service
+                # unavailable - The request is blocked". A slightly lower value
+                # is therefore used here
+                request_parameters_data["therm_setpoint_end_time"] = 2147483646
+        return request_parameters_data
+
+    # Utility method to commit thermostat status changes for the rooms
+    # identified by room_ids (by default, all rooms with pending changes)
+    # in a single request. This method is meant to be invoked by the scheduler.
+    # The pending changes are taken over under the lock, which is released
+    # before sending them, so that new changes can be requested meanwhile
+    def send_thermostat_update(self, room_ids=None):
         with self.lock:
-            log.debug("Sending thermostat update")
-            request_url = self.BASE_URL + self.SETSTATE
-
-            request_parameters_data = {}
-            if self.target_temperature:
-                request_parameters_data["therm_setpoint_temperature"] = self.target_temperature
-            if self.target_mode:
-                request_parameters_data["therm_setpoint_mode"] = self.target_mode
-            if settings['netatmo']['default_duration'] is not None:
-                if int(settings['netatmo']['default_duration']) > 0:
-                    request_parameters_data["therm_setpoint_end_time"] = int(time.time()) + int(settings['netatmo']['default_duration']) * 60
-                else:
-                    # 2147483647 is the magic value for "until a new order",
-                    # as documented in https://dev.netatmo.com/apidocumentation/control#setstate.
-                    # However, it seems to cause HTTP error 403 with description "Service
-                    # unavailable - The request is blocked". A slightly lower value
-                    # is therefore used here
-                    request_parameters_data["therm_setpoint_end_time"] = 2147483646
-            request_parameters = self.prepare_room_request(settings['netatmo']['homeid'], settings['netatmo']['roomid'], request_parameters_data)
-
+            if room_ids is None:
+                room_ids = self.rooms.keys()
+            room_ids = [r for r in room_ids if self.temperature_update_pending(r) or self.mode_update_pending(r)]
+            if not room_ids:
+                log.debug("No pending thermostat updates")
+                return
+            log.debug("Sending thermostat update for rooms %s" % ", ".join(room_ids))
+            update = {
+                'key': ('setstate_retry', next(self.setstate_sequence)),
+                'parameters': {r: self.room_update_parameters(self.rooms[r]) for r in room_ids},
+                'rooms': {r: {'temperature': self.rooms[r].target_temperature, 'mode': self.rooms[r].target_mode, 'requested_at': self.rooms[r].requested_at} for r in room_ids},
+                'deadline': time.monotonic() + self.retry_policies['setstate'].deadline,
+                'retries': {}
+            }
+            for r in room_ids:
+                self.rooms[r].in_flight = update
+                self.rooms[r].target_temperature = None
+                self.rooms[r].target_mode = None
+                self.rooms[r].requested_at = None
+        self.attempt_thermostat_update(update)
+
+    # Send (or send again) a thermostat update taken over by
+    # send_thermostat_update. Transient failures are retried according to
+    # the 'setstate' retry policy, but retries are scheduled as separate
+    # calls instead of waiting for them here, so that neither the scheduler
+    # (which also refreshes the token) nor new changes are held up. Rooms
+    # whose update has been superseded by a newer one (or discarded) in
+    # the meantime are left out of retries
+    def attempt_thermostat_update(self, update):
+        with self.lock:
+            room_ids = [r for r in update['rooms'] if self.rooms[r].in_flight is update]
+        if not room_ids:
+            log.debug("Thermostat update superseded: not sending it again")
+            return
+        request_url = self.BASE_URL + self.SETSTATE
+        request_parameters = self.prepare_rooms_request(settings['netatmo']['homeid'], {r: update['parameters'][r] for r in room_ids})
+        access_token = self.token['access_token']
+        # Updates are sent one at a time, so that they reach the
+        # Netatmo cloud in the same order as they are requested
+        with self.setstate_lock:
+            self.setstate_sending = True
             try:
-                self.netatmo_api_call(request_url, request_parameters)
+                r, failure, error = self.send_api_request(request_url, request_parameters, access_token)
             finally:
-                # Make sure to clear pending updates even if an exception is raised
-                # by netatmo_api_call, so that future status change requests are
-                # handled correctly
-                self.scheduled_request = None
-                self.target_temperature = None
-                self.target_mode = None
-    
-    # Schedule a thermostat status update for a later time.
-    # Cancel an already scheduled update, if any
-    def schedule_thermostat_update(self):
-        if self.scheduled_request:
-            log.debug("Canceling pending thermostat update")
-            self.scheduled_request.cancel()
-        self.scheduled_request = Timer(settings['netatmo']['min_request_idle_time'], self.send_thermostat_update)
-        log.debug("Scheduling thermostat update within %i seconds" % settings['netatmo']['min_request_idle_time'])
-        self.scheduled_request.start()
+                self.setstate_sending = False
+        if error is None:
+            self.finish_thermostat_update(update, room_ids, r.content)
+            return
+        try:
+            delay = self.retry_delay(request_url, self.retry_policies['setstate'], failure, update['retries'], r, update['deadline'])
+            if delay is not None:
+                self.prepare_retry(request_url, self.retry_policies['setstate'], failure, update['retries'], delay, access_token)
+                self.scheduler.schedule_at(update['key'], time.monotonic() + delay, self.attempt_thermostat_update, update)
+                return
+            response = self.give_up_api_call(request_url, failure, r, error)
+        except Exception as e:
+            self.finish_thermostat_update(update, room_ids, None, e)
+            raise
+        self.finish_thermostat_update(update, room_ids, response)
+
+    # Record the outcome of a thermostat update that has been sent
+    # (or given up) and report it to the listeners
+    def finish_thermostat_update(self, update, room_ids, response, exception=None):
+        with self.lock:
+            for r in room_ids:
+                if self.rooms[r].in_flight is update:
+                    self.rooms[r].in_flight = None
+        # Fresh readings are likely to change soon after a command
+        self.poll_scheduler.notify_activity()
+        if exception is None:
+            # Confirm that the update has been applied by polling a few
+            # times in quick succession
+            sent_at = time.monotonic()
+            for r in room_ids:
+                self.rooms[r].unconfirmed = dict(update['rooms'][r], sent_at=sent_at)
+            if self.VERIFICATION_POLLS > 0:
+                self.poll_scheduler.start_burst(self.VERIFICATION_POLLS, self.VERIFICATION_INTERVAL)
+        self.report_setstate_results(room_ids, response, exception)
+
+    # Notify the registered listeners about the outcome of a /setstate
+    # request for each of the rooms it included. Each listener is invoked
+    # with a room id and a dictionary describing the result
+    def report_setstate_results(self, room_ids, response_text, exception=None):
+        room_errors = {}
+        global_error = None
+        if exception is not None:
+            global_error = {'code': None, 'message': repr(exception)}
+        else:
+            try:
+                response = codec.loads(response_text)
+            except (TypeError, ValueError):
+                response = {'error': {'code': None, 'message': "Invalid response: %s" % response_text}}
+            if 'error' in response:
+                global_error = response['error'] if isinstance(response['error'], dict) else {'code': None, 'message': response['error']}
+            else:
+                # Errors concerning specific rooms are reported in the response body
+                # (see https://dev.netatmo.com/apidocumentation/general#status-ok)
+                for e in (response.get('body') or {}).get('errors', []):
+                    room_errors[str(e.get('id'))] = e
+        for room_id in room_ids:
+            error = global_error or room_errors.get(room_id)
+            if error:
+                log.warning("Thermostat update failed for room %s: %s" % (room_id, error))
+                self.rooms[room_id].unconfirmed = None
+                result = {'status': 'error', 'code': error.get('code'), 'message': error.get('message')}
+            else:
+                result = {'status': 'ok'}
+            for listener in self.setstate_listeners:
+                try:
+                    listener(room_id, result)
+                except Exception as e:
+                    log.error("Exception raised while reporting thermostat update result: %s" % repr(e))
+
+    # Return the scheduler key of the pending update of a room
+    def setstate_key(self, room_id):
+        return ('setstate',) if self.BATCH_SETSTATE else ('setstate', room_id)
+
+    # Schedule a thermostat status update for a later time. An already
+    # scheduled update for the same room (or for any room, if updates
+    # are batched), if any, is coalesced with this one
+    def schedule_thermostat_update(self, room_id):
+        room = self.rooms[room_id]
+        if room.requested_at is None:
+            room.requested_at = time.monotonic()
+        if self.BATCH_SETSTATE:
+            self.scheduler.schedule(self.setstate_key(room_id), self.send_thermostat_update)
+        else:
+            self.scheduler.schedule(self.setstate_key(room_id), self.send_thermostat_update, [room_id])
+
+    # Return the pending thermostat updates, as a dictionary indexed
+    # by room id (e.g., to hand them over to another instance). Updates
+    # that are still being sent are included, unless superseded
+    def pending_updates(self):
+        pending = {}
+        with self.lock:
+            for r in self.rooms.values():
+                if r.target_temperature is not None or r.target_mode is not None:
+                    pending[r.room_id] = {'temperature': r.target_temperature, 'mode': r.target_mode}
+                elif r.in_flight is not None:
+                    update = r.in_flight['rooms'][r.room_id]
+                    pending[r.room_id] = {'temperature': update['temperature'], 'mode': update['mode']}
+        return pending
+
+    # Schedule thermostat updates handed over by another instance,
+    # in the format returned by pending_updates()
+    def restore_pending_updates(self, pending):
+        for room_id, update in pending.items():
+            if room_id not in self.rooms:
+                continue
+            log.debug("Restoring pending thermostat update for room %s: %s" % (room_id, update))
+            with self.lock:
+                room = self.rooms[room_id]
+                if update.get('temperature') is not None:
+                    room.target_temperature = room.last_set_temperature = float(update['temperature'])
+                if update.get('mode') is not None:
+                    room.target_mode = room.last_set_mode = update['mode']
+                self.schedule_thermostat_update(room_id)
+
+    # Drop all pending thermostat updates without sending them,
+    # including the retries of updates that failed
+    def discard_pending_updates(self):
+        with self.lock:
+            for room_id, room in self.rooms.items():
+                self.scheduler.cancel(self.setstate_key(room_id))
+                if room.in_flight is not None:
+                    self.scheduler.cancel(room.in_flight['key'])
+                room.target_temperature = None
+                room.target_mode = None
+                room.in_flight = None
+
+    # Immediately send all pending thermostat updates (e.g., before
+    # quitting), including the retries of updates that failed
+    def flush_thermostat_updates(self):
+        with self.lock:
+            retry_keys = {r.in_flight['key'] for r in self.rooms.values() if r.in_flight is not None}
+        for key in retry_keys:
+            self.scheduler.flush(key)
+        for room_id in self.rooms:
+            self.scheduler.flush(self.setstate_key(room_id))
 
     # Change the thermostat's setpoint temperature and
-    # automatically set "manual" mode
-    def set_temperature(self, temp):
+    # automatically set "manual" mode. Return True if an update
+    # has been scheduled, False if the setpoint is unchanged
+    def set_temperature(self, room_id, temp):
         with self.lock:
+            room = self.rooms[room_id]
             target_temperature = float(temp)
             # Check if temperature has really changed since the last time it
             # has been set. This is useful to avoid publish/subscribe loops
-            if target_temperature != self.last_set_temperature:
-                log.debug("Requested temperature change from %.1f to %.1f" % ((self.last_set_temperature or 0), target_temperature))
-                self.target_temperature = target_temperature
-                self.last_set_temperature = self.target_temperature
-                self.target_mode = "manual"
-                self.last_set_mode = self.target_mode
-                self.schedule_thermostat_update()
+            if target_temperature != room.last_set_temperature:
+                log.debug("Requested temperature change in room %s from %.1f to %.1f" % (room_id, (room.last_set_temperature or 0), target_temperature))
+                room.target_temperature = target_temperature
+                room.last_set_temperature = room.target_temperature
+                room.target_mode = "manual"
+                room.last_set_mode = room.target_mode
+                self.schedule_thermostat_update(room_id)
+                return True
             else:
-                log.debug("Temperature %.1f unchanged: doing nothing" % self.last_set_temperature or 0)
+                log.debug("Temperature %.1f unchanged in room %s: doing nothing" % (room.last_set_temperature or 0, room_id))
+                return False
 
-    # Change the thermostat's operational mode.
+    # Change the thermostat's operational mode. Return True if an update
+    # has been scheduled, False if the mode is unchanged.
     # According to the schema of the /homestatus API call
     # (https://dev.netatmo.com/apidocumentation/control#homestatus),
     # allowed modes are: home, manual, max, hg (anti-frost mode)
-    def set_mode(self, mode):
-        if (self.last_set_mode is None or self.last_set_mode.lower() == "hg") and mode.lower() == "max":
-            # Changing from the OFF to the BOOST status requires a transition through an
-            # intermediate mode
-            log.debug("BOOST mode requested. Setting intermediate MANUAL mode first")
-            if self.scheduled_request:
-                self.scheduled_request.cancel()
-            self.target_mode = "manual"
-            self.target_temperature = 18.0
-            self.send_thermostat_update()
+    def set_mode(self, room_id, mode):
+        room = self.rooms[room_id]
+        with self.lock:
+            boost_from_off = (room.last_set_mode is None or room.last_set_mode.lower() == "hg") and mode.lower() == "max"
+            if boost_from_off:
+                # Changing from the OFF to the BOOST status requires a transition through an
+                # intermediate mode
+                log.debug("BOOST mode requested for room %s. Setting intermediate MANUAL mode first" % room_id)
+                room.target_mode = "manual"
+                room.target_temperature = 18.0
+                self.schedule_thermostat_update(room_id)
+        if boost_from_off:
+            # The intermediate mode is sent right away (if updates are
+            # batched, along with the changes pending for other rooms),
+            # unless the scheduler is sending it already
+            self.scheduler.flush(self.setstate_key(room_id))
         with self.lock:
             # Check if mode has really changed since the last time it
             # has been set. This is useful to avoid publish/subscribe loops
-            if mode.lower() != self.last_set_mode:
-                log.debug("Requested mode change from " + (self.last_set_mode or "<None>") + " to " + mode.lower())
-                self.target_mode = mode.lower()
-                self.last_set_mode = self.target_mode
+            if mode.lower() != room.last_set_mode:
+                log.debug("Requested mode change in room " + room_id + " from " + (room.last_set_mode or "<None>") + " to " + mode.lower())
+                room.target_mode = mode.lower()
+                room.last_set_mode = room.target_mode
                 # When mode is set to "manual", a temperature setpoint must
                 # be included in the next call to the Netatmo API, otherwise
                 # the call will be ineffective
                 if mode.lower() == "manual":
                     # Check if there already is a temperature setpoint pending
                     # application
-                    if not self.target_temperature:
+                    if not room.target_temperature:
                         # Try to re-apply a recently set temperature setting
-                        if self.last_set_temperature:
-                            self.target_temperature = self.last_set_temperature
+                        if room.last_set_temperature:
+                            room.target_temperature = room.last_set_temperature
                         else:
                             # Last resort: apply a (supposedly) safe temperature
-                            self.target_temperature = 18.0
-                            self.last_set_temperature = self.target_temperature
-                        log.debug("Manual mode was requested and no temperature setpoint pending: applying one now (%.1f°)" % self.target_temperature)
-                self.schedule_thermostat_update()
+                            room.target_temperature = 18.0
+                            room.last_set_temperature = room.target_temperature
+                        log.debug("Manual mode was requested and no temperature setpoint pending: applying one now (%.1f°)" % room.target_temperature)
+                self.schedule_thermostat_update(room_id)
+                return True
             else:
-                log.debug("Mode " + (self.last_set_mode or "<None>") + " unchanged: doing nothing")
+                log.debug("Mode " + (room.last_set_mode or "<None>") + " unchanged in room " + room_id + ": doing nothing")
+                return False
     
     # Simply update the last applied temperature setpoint and mode
     # as learned from the Netatmo cloud, without sending any commands
     # to the thermostat
-    def update_temperature(self, temp):
+    def update_temperature(self, room_id, temp):
+        room = self.rooms[room_id]
         try:
-            log.debug("Updating last known applied temperature setpoint to %s (was %.1f)" % (temp, self.last_set_temperature or 0))
-            self.last_set_temperature = float(temp)
+            log.debug("Updating last known applied temperature setpoint in room %s to %s (was %.1f)", room_id, temp, room.last_set_temperature or 0)
+            room.last_set_temperature = float(temp)
         except ValueError:
             log.warn("Invalid temperature setpoint value received from the Home+Control API: " + temp)
-    def update_mode(self, mode):
-        log.debug("Updating last known applied mode to %s (was %s)" % (mode, self.last_set_mode or "<None>"))
-        self.last_set_mode = mode
+    def update_mode(self, room_id, mode):
+        room = self.rooms[room_id]
+        log.debug("Updating last known applied mode in room %s to %s (was %s)", room_id, mode, room.last_set_mode or "<None>")
+        room.last_set_mode = mode
+
+    # Check whether the status of a room, as observed at observed_at (as
+    # returned by time.monotonic()), confirms the last update sent to it.
+    # Return the time elapsed from the request of the update to its
+    # confirmation, or None if there is nothing (new) to confirm
+    def confirm_update(self, room_id, room_status, observed_at):
+        room = self.rooms[room_id]
+        update = room.unconfirmed
+        if update is None or observed_at < update['sent_at']:
+            return None
+        now = time.monotonic()
+        if now - update['sent_at'] > self.CONFIRMATION_TIMEOUT:
+            log.warning("Thermostat update of room %s not confirmed after %i seconds" % (room_id, self.CONFIRMATION_TIMEOUT))
+            room.unconfirmed = None
+            self.report_confirmation(room_id, room_status, False)
+            return None
+        if update['mode'] is not None and room_status.get('therm_setpoint_mode') != update['mode']:
+            return None
+        if update['temperature'] is not None and (room_status.get('therm_setpoint_temperature') is None or abs(float(room_status['therm_setpoint_temperature']) - update['temperature']) > 0.05):
+            return None
+        room.unconfirmed = None
+        latency = now - (update['requested_at'] or update['sent_at'])
+        log.debug("Thermostat update of room %s confirmed %.1f seconds after it was requested", room_id, latency)
+        metrics.command_confirmation_time.observe(latency)
+        if not any(r.unconfirmed for r in self.rooms.values()):
+            self.poll_scheduler.end_burst()
+        self.report_confirmation(room_id, room_status, True)
+        return latency
+
+    # Notify the registered listeners that the last update sent to a room
+    # has been confirmed by its status, or has timed out
+    def report_confirmation(self, room_id, room_status, confirmed):
+        for listener in self.confirmation_listeners:
+            try:
+                listener(room_id, room_status, confirmed)
+            except Exception as e:
+                log.error("Exception raised while reporting thermostat update confirmation: %s" % repr(e))
+
+    # Check whether any updates are waiting to be sent (or being sent).
+    # Updates waiting for a retry are not included, as polls would
+    # otherwise be held until the deadline of the update
+    def thermostat_updates_pending(self):
+        return self.setstate_sending or any(r.target_temperature is not None or r.target_mode is not None for r in list(self.rooms.values()))
 
     # Check if there are temperature or mode updates pending
-    def temperature_update_pending(self):
-        return not (self.target_temperature is None)
-    def mode_update_pending(self):
-        return not (self.target_mode is None)
+    def temperature_update_pending(self, room_id):
+        return not (self.rooms[room_id].target_temperature is None)
+    def mode_update_pending(self, room_id):
+        return not (self.rooms[room_id].target_mode is None)
 
 
 
@@ -427,24 +919,74 @@ class NetatmoToken:
         self.token = None
         self.msg_queue = Queue()
         self.lock = Lock()
-        self.scheduled_request = None
-        self.target_mode = None
-        self.target_temperature = None
-        self.last_set_temperature = None
-        self.last_set_mode = None
+        self.token_lock = Lock()
+        # Return False while the token must not be refreshed before it
+        # expires (e.g., on standby instances)
+        self.refresh_in_advance = lambda: True
+        self.setstate_lock = Lock()
+        # Whether a thermostat update is being sent right now
+        self.setstate_sending = False
+        # Identifies the retries of each thermostat update
+        self.setstate_sequence = itertools.count()
+        # Functions invoked with the outcome of each thermostat update
+        self.setstate_listeners = []
+        # Functions invoked with a room id, its status and whether it has
+        # confirmed the last update sent to the room (False on timeout)
+        self.confirmation_listeners = []
+        # Deferred execution of thermostat updates. This can be replaced
+        # by a different implementation (e.g., based on an event loop)
+        self.scheduler = DebounceScheduler(settings['netatmo']['min_request_idle_time'], settings['netatmo'].get('max_request_delay', 15))
+        self.scheduler.start()
+        self.session = None
+        self.session_last_used = 0
+        self.session_lock = Lock()
+        self.homestatus_device_types = None
+        # Accounting of API calls and scheduling of /homestatus polls
+        adaptive_polling = settings['netatmo'].get('adaptive_polling') or {}
+        retry_settings = settings['netatmo'].get('retry') or {}
+        self.rate_budget = RateBudget(settings['netatmo'].get('budget_fraction', 0.8), retry_settings.get('budget', 60))
+        self.retry_policies = configured_policies(retry_settings)
+        self.poll_scheduler = PollScheduler(
+            self.rate_budget,
+            adaptive_polling.get('min_interval', settings['netatmo']['polling_interval']),
+            adaptive_polling.get('max_interval', settings['netatmo']['polling_interval']),
+            adaptive_polling.get('backoff_factor', 1.5)
+        )
+        # Thermostat updates take priority over polls
+        self.poll_scheduler.writes_pending = self.thermostat_updates_pending
+        verification = settings['netatmo'].get('verification') or {}
+        self.VERIFICATION_POLLS = verification.get('polls', 3)
+        self.VERIFICATION_INTERVAL = verification.get('interval', 3)
+        self.CONFIRMATION_TIMEOUT = verification.get('timeout', 300)
+        # Per-room status, indexed by room id
+        self.rooms = {r['roomid']: RoomState(r['roomid']) for r in configured_rooms()}
 
         self.TOKEN_FILE = settings['netatmo']['token_file']
         self.CLIENT_ID = settings['netatmo']['clientid']
         self.CLIENT_SECRET = settings['netatmo']['clientsecret']
         self.HTTP_SERVER_IPADDRESS = settings['oauth_code_endpoint']['ipaddress']
         self.HTTP_SERVER_PORT = settings['oauth_code_endpoint']['port']
-        self.NETATMO_TOKEN_URL = "https://api.netatmo.com/oauth2/token"
+        http_settings = settings['netatmo'].get('http') or {}
+        self.HTTP_POOL_SIZE = http_settings.get('pool_size', 4)
+        self.HTTP_IDLE_TIMEOUT = http_settings.get('idle_timeout', 60)
+        self.HTTP_CONNECT_TIMEOUT = http_settings.get('connect_timeout', 5)
+        self.HTTP_READ_TIMEOUT = http_settings.get('read_timeout', 20)
+        self.BATCH_SETSTATE = settings['netatmo'].get('batch_setstate', True)
+        # Tokens are refreshed this many seconds before they expire
+        self.TOKEN_REFRESH_MARGIN = settings['netatmo'].get('token_refresh_margin', 300)
+        # The address of the Netatmo API can be overridden (e.g., to point
+        # to a local stand-in server for testing purposes)
+        self.API_URL = settings['netatmo'].get('api_url', "https://api.netatmo.com").rstrip('/')
+        self.NETATMO_TOKEN_URL = self.API_URL + "/oauth2/token"
         self.TOKEN_CONFIRMATION_URL = "http://%s:%i/token" % (self.HTTP_SERVER_IPADDRESS, self.HTTP_SERVER_PORT)
-        self.AUTHORIZE_URL = "https://api.netatmo.com/oauth2/authorize?client_id=%s&scope=read_smarther%%20write_smarther&redirect_uri=%s" % (self.CLIENT_ID, self.TOKEN_CONFIRMATION_URL)
+        self.AUTHORIZE_URL = self.API_URL + "/oauth2/authorize?client_id=%s&scope=read_smarther%%20write_smarther&redirect_uri=%s" % (self.CLIENT_ID, self.TOKEN_CONFIRMATION_URL)
 
-        self.BASE_URL = "https://api.netatmo.com/api/"
+        self.BASE_URL = self.API_URL + "/api/"
         self.HOMESDATA = "homesdata"
         self.HOMESTATUS = "homestatus"
         self.SETSTATE = "setstate"
+        self.ADDWEBHOOK = "addwebhook"
+        self.DROPWEBHOOK = "dropwebhook"
 
         self.load_token_from_file()
+        self.schedule_token_refresh()
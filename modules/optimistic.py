@@ -0,0 +1,64 @@
+import time
+from threading import Lock
+from modules.utilities import log
+
+# Bookkeeping of commanded states that have been published optimistically,
+# i.e., before the Netatmo cloud has confirmed them. Each expected state is
+# reconciled once the corresponding thermostat update has been sent and the
+# status of the room has either confirmed it or failed to do so in time, as
+# the Netatmo cloud may take a few polls to reflect an update
+class OptimisticState:
+    # Record the setpoint temperature and/or mode that have been commanded
+    # for a room. Values not specified are left unchanged
+    def command(self, room_id, temperature=None, mode=None):
+        with self.lock:
+            expected = self.expected.setdefault(room_id, {'temperature': None, 'mode': None, 'sent_at': None})
+            if temperature is not None:
+                expected['temperature'] = temperature
+            if mode is not None:
+                expected['mode'] = mode
+            # A new command postpones reconciliation until it has been sent as well
+            expected['sent_at'] = None
+
+    # Record that the thermostat update for a room has been sent. If it
+    # has failed, the expected state is forgotten without reconciling it,
+    # as the update has never been applied
+    def mark_sent(self, room_id, succeeded=True):
+        with self.lock:
+            if room_id not in self.expected:
+                return
+            if succeeded:
+                self.expected[room_id]['sent_at'] = time.monotonic()
+            else:
+                del self.expected[room_id]
+
+    # Reconcile the expected state of a room once the last update sent to
+    # it has been confirmed by the Netatmo cloud (confirmed is True), or has
+    # not been confirmed in time (confirmed is False), in which case it is
+    # compared with the given status. Return None if there is nothing to
+    # reconcile or the states match; otherwise, return a dictionary
+    # describing the mismatch. In both cases, the expected state is
+    # forgotten once reconciled
+    def reconcile(self, room_id, room_status, confirmed):
+        with self.lock:
+            expected = self.expected.get(room_id)
+            if expected is None or expected['sent_at'] is None:
+                return None
+            del self.expected[room_id]
+        if confirmed:
+            log.debug("Commanded state of room %s confirmed by the Netatmo cloud" % room_id)
+            return None
+        mismatch = {}
+        if expected['temperature'] is not None and float(room_status['therm_setpoint_temperature']) != expected['temperature']:
+            mismatch['temperature_setpoint'] = {'expected': expected['temperature'], 'actual': room_status['therm_setpoint_temperature']}
+        if expected['mode'] is not None and room_status['therm_setpoint_mode'] != expected['mode']:
+            mismatch['mode'] = {'expected': expected['mode'], 'actual': room_status['therm_setpoint_mode']}
+        if mismatch:
+            log.warning("Room %s did not reach the commanded state: %s" % (room_id, mismatch))
+            return mismatch
+        log.debug("Commanded state of room %s confirmed by the Netatmo cloud" % room_id)
+        return None
+
+    def __init__(self):
+        self.lock = Lock()
+        self.expected = {}
@@ -0,0 +1,263 @@
+import time
+from collections import deque
+from threading import Lock, Event
+from modules.utilities import log
+from modules import metrics
+
+# Netatmo API per-user rate limits, as documented in
+# https://dev.netatmo.com/guideline#rate-limits
+SHORT_TERM_LIMIT = 50
+SHORT_TERM_PERIOD = 10
+LONG_TERM_LIMIT = 500
+LONG_TERM_PERIOD = 3600
+
+# How often (in seconds) a poll held by pending thermostat
+# updates checks whether they have been sent
+WRITE_PRIORITY_DELAY = 1
+
+# A token bucket that holds up to "capacity" tokens and is refilled
+# at a constant rate, so that it becomes full again after "period"
+# seconds. Every API call takes one token from the bucket
+class TokenBucket:
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    # Take one token from the bucket. Calls that have already been
+    # sent must be accounted for anyway, so the number of tokens in
+    # the bucket may become negative
+    def consume(self):
+        self.refill()
+        self.tokens -= 1
+
+    # Empty the bucket, for example because the server has
+    # signaled that the rate limit has been hit
+    def drain(self):
+        self.refill()
+        self.tokens = min(self.tokens, 0)
+
+    # Return the time (in seconds) until at least one token is available
+    def time_until_available(self):
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+# A sliding window that allows at most "limit" calls in any interval of
+# "period" seconds, by keeping the time of the calls made in the last
+# period. Unlike a token bucket, which starts full and is refilled at the
+# same time, the limit cannot be exceeded even within the first period
+class SlidingWindow:
+    def expire(self):
+        horizon = time.monotonic() - self.period
+        while self.calls and self.calls[0] <= horizon:
+            self.calls.popleft()
+
+    # Record a call. Calls that have already been sent must be
+    # accounted for anyway, so the limit may be exceeded
+    def consume(self):
+        self.expire()
+        self.calls.append(time.monotonic())
+
+    # Hold further calls, for example because the server has signaled
+    # that the rate limit has been hit, for as long as the average
+    # spacing of calls within the limit
+    def drain(self):
+        self.blocked_until = time.monotonic() + self.period / self.limit
+
+    # Return the time (in seconds) until another call is allowed
+    def time_until_available(self):
+        self.expire()
+        now = time.monotonic()
+        delay = max(self.blocked_until - now, 0)
+        excess = len(self.calls) - self.limit
+        if excess >= 0:
+            # Wait for enough calls to leave the window
+            delay = max(delay, self.calls[excess] + self.period - now)
+        return delay
+
+    def __init__(self, limit, period):
+        self.limit = max(int(limit), 1)
+        self.period = period
+        self.calls = deque()
+        self.blocked_until = 0
+
+# Accounting of all the calls sent to the Netatmo API, with respect to the
+# per-user rate limits. Only a configurable fraction of the limits is
+# considered as available budget, leaving some headroom for other
+# applications using the same account and for unexpected calls
+class RateBudget:
+    # Account for an API call of the given kind (e.g., an endpoint name)
+    def record_call(self, kind):
+        with self.lock:
+            for b in self.buckets:
+                b.consume()
+            self.calls_by_kind[kind] = self.calls_by_kind.get(kind, 0) + 1
+
+    # Record that the server has reported that the rate limit has been hit
+    def record_rate_limit_hit(self):
+        with self.lock:
+            for b in self.buckets:
+                b.drain()
+            self.rate_limit_hits += 1
+
+    # Check whether a failed call of the given kind (e.g., a class of
+    # failures) may be retried, and account for the retry if so. Retries
+    # are limited globally, so that a persistent failure cannot turn
+    # into a storm of retries
+    def allow_retry(self, kind):
+        with self.lock:
+            if self.retry_bucket.time_until_available() > 0:
+                self.retries_denied += 1
+                return False
+            self.retry_bucket.consume()
+            self.retries_by_kind[kind] = self.retries_by_kind.get(kind, 0) + 1
+            return True
+
+    # Return the time (in seconds) to wait before another call
+    # can be issued without exceeding the budget
+    def delay(self):
+        with self.lock:
+            return max(b.time_until_available() for b in self.buckets)
+
+    def __init__(self, budget_fraction=0.8, retry_budget=60):
+        self.lock = Lock()
+        # At most retry_budget retries per hour
+        self.retry_bucket = TokenBucket(retry_budget, 3600)
+        self.retries_by_kind = {}
+        self.retries_denied = 0
+        # The budget is enforced over sliding windows, so that it is never
+        # exceeded in any period (a token bucket starting full would allow
+        # up to twice the budget in the first period)
+        self.buckets = [
+            SlidingWindow(SHORT_TERM_LIMIT * budget_fraction, SHORT_TERM_PERIOD),
+            SlidingWindow(LONG_TERM_LIMIT * budget_fraction, LONG_TERM_PERIOD)
+        ]
+        self.calls_by_kind = {}
+        self.rate_limit_hits = 0
+
+# Decide when the next /homestatus poll should be issued. Polling happens
+# every min_interval seconds right after a command has been sent or a
+# reading has changed, and the interval is progressively increased (by
+# backoff_factor, up to max_interval) as long as readings remain stable.
+# In any case, a poll is never issued if it would exceed the rate budget,
+# and polls give way to thermostat updates: a poll that is due while an
+# update is waiting to be sent (or being sent) is held until it has been
+# sent, as it would retrieve a status that is about to change anyway
+class PollScheduler:
+    def wakeup(self):
+        self.wake.set()
+        for listener in self.wake_listeners:
+            listener()
+
+    # Signal that something happened (e.g., a command has been sent to
+    # the thermostat) which makes fresh readings likely to be different
+    def notify_activity(self):
+        with self.lock:
+            self.interval = self.min_interval
+        self.wakeup()
+
+    # Poll every interval seconds for the next given number of polls (e.g.,
+    # to confirm that a thermostat update has been applied), unless the
+    # rate budget is already exhausted
+    def start_burst(self, polls, interval):
+        if self.budget.delay() > 0:
+            log.debug("Rate budget exhausted: skipping burst of polls")
+            return
+        with self.lock:
+            self.burst_polls = polls
+            self.burst_interval = interval
+        self.wakeup()
+
+    def end_burst(self):
+        with self.lock:
+            self.burst_polls = 0
+
+    # Register a function to be invoked whenever activity is notified,
+    # so that a pending wait for the next poll can be shortened
+    def add_wake_listener(self, listener):
+        self.wake_listeners.append(listener)
+
+    # Replace the bounds of the polling interval (e.g., when polling
+    # is only used as a safety net)
+    def set_intervals(self, min_interval, max_interval):
+        with self.lock:
+            self.min_interval = min_interval
+            self.max_interval = max(min_interval, max_interval)
+            self.interval = min(max(self.interval, self.min_interval), self.max_interval)
+        self.wake.set()
+
+    # Restore the intervals the scheduler has been created with
+    def reset_intervals(self):
+        self.set_intervals(*self.default_intervals)
+
+    # Adjust the polling interval depending on whether the
+    # last poll has returned changed readings or not
+    def notify_poll_result(self, changed):
+        with self.lock:
+            if changed:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff_factor, self.max_interval)
+
+    # Return the time of the next poll, according to the current interval
+    # (or to the burst interval, during a burst). Must be called with the
+    # lock held
+    def due_time(self):
+        return self.last_poll + (self.burst_interval if self.burst_polls > 0 else self.interval)
+
+    # Return the time (in seconds) until the next poll is due
+    def next_poll_delay(self):
+        with self.lock:
+            due = self.due_time()
+        delay = max(due - time.monotonic(), self.budget.delay(), 0)
+        if delay <= 0 and self.writes_pending():
+            # The wait is also cut short as soon as updates are sent
+            return WRITE_PRIORITY_DELAY
+        return delay
+
+    # Record that a poll is being issued now, and how late it
+    # is with respect to its schedule
+    def mark_polled(self):
+        now = time.monotonic()
+        with self.lock:
+            due = self.due_time()
+            if self.burst_polls > 0:
+                self.burst_polls -= 1
+        metrics.poll_jitter.observe(max(now - due, 0))
+        self.last_poll = now
+
+    # Block until the next poll is due. The wait is shortened whenever
+    # activity is notified in the meantime
+    def wait_next_poll(self):
+        while True:
+            delay = self.next_poll_delay()
+            if delay <= 0:
+                break
+            log.debug("Waiting %.1f seconds before next poll", delay)
+            self.wake.wait(delay)
+            self.wake.clear()
+        self.mark_polled()
+
+    def __init__(self, budget, min_interval, max_interval, backoff_factor=1.5):
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.default_intervals = (self.min_interval, self.max_interval)
+        self.backoff_factor = backoff_factor
+        self.interval = min_interval
+        self.last_poll = time.monotonic()
+        self.lock = Lock()
+        self.wake = Event()
+        self.wake_listeners = []
+        self.burst_polls = 0
+        self.burst_interval = 0
+        # Return True while thermostat updates are waiting to be sent
+        self.writes_pending = lambda: False
@@ -0,0 +1,142 @@
+import marshal, os, sys, threading, time, traceback
+from collections import Counter
+from threading import Event, Lock
+from modules.utilities import log
+
+# On-demand sampling profiler, which can be started and stopped while
+# smarther2mqtt is running (e.g., upon a signal or an MQTT command). While
+# running, a dedicated thread periodically takes the stack of every other
+# thread (main loop, MQTT client, schedulers, command worker, ...) and
+# counts identical stacks: nothing is hooked into the profiled code, so the
+# overhead is limited to the sampling thread itself and timing is hardly
+# affected. When stopped (explicitly or after max_duration seconds), the
+# profiler writes, in the given directory:
+# - the sampled stacks in folded format (one line per stack, rooted at the
+#   thread name, followed by the number of samples), as expected by
+#   flamegraph.pl, speedscope and similar tools
+# - the same samples as a pstats file, which can be loaded by the pstats
+#   module or by snakeviz (call counts are actually sample counts)
+# - the current stack of all the threads
+# The stacks of all the threads are also written when the profiler starts,
+# so that a stuck thread can be spotted right away
+class SamplingProfiler:
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # Start sampling, unless already running. Return False if already running
+    def start(self):
+        with self.lock:
+            if self.is_running():
+                return False
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+            self.thread.start()
+        return True
+
+    # Stop sampling. The dumps are written by the sampling thread, so that
+    # this can be invoked by a signal handler without holding up the caller.
+    # Return False if not running
+    def stop(self):
+        if not self.is_running():
+            return False
+        self.stopping.set()
+        return True
+
+    def sample(self, stacks):
+        own_ident = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            # Stacks are stored from the outermost call
+            codes.reverse()
+            stacks[(names.get(ident, str(ident)), tuple(codes))] += 1
+
+    # Body of the sampling thread
+    def run(self):
+        started = time.time()
+        self.dump_threads(started)
+        log.info("Profiler started: sampling all threads every %.3f seconds for up to %i seconds" % (self.interval, self.max_duration))
+        stacks = Counter()
+        deadline = time.monotonic() + self.max_duration
+        while not self.stopping.wait(self.interval):
+            self.sample(stacks)
+            if time.monotonic() >= deadline:
+                log.info("Profiler stopped after %i seconds" % self.max_duration)
+                break
+        self.dump_profile(stacks, started)
+        self.dump_threads(time.time())
+
+    def path(self, kind, timestamp, extension):
+        return os.path.join(self.directory, "smarther2mqtt-%s-%s-%03i.%s" % (kind, time.strftime("%Y%m%d-%H%M%S", time.localtime(timestamp)), timestamp % 1 * 1000, extension))
+
+    # Write the sampled stacks in folded and pstats format
+    def dump_profile(self, stacks, started):
+        folded_path = self.path("profile", started, "folded")
+        pstats_path = self.path("profile", started, "pstats")
+        try:
+            with open(folded_path, mode="w") as f:
+                for (thread_name, codes), count in sorted(stacks.items(), key=lambda s: -s[1]):
+                    f.write("%s;%s %i\n" % (thread_name, ";".join("%s (%s:%i)" % (c.co_name, os.path.basename(c.co_filename), c.co_firstlineno) for c in codes), count))
+            with open(pstats_path, mode="wb") as f:
+                marshal.dump(pstats_table(stacks, self.interval), f)
+        except OSError as e:
+            log.error("Error while attempting to save profile to \"%s\": %s" % (self.directory, e.strerror))
+            return
+        log.info("Profiler stopped: %i samples saved to %s and %s" % (sum(stacks.values()), folded_path, pstats_path))
+
+    # Write the current stack of all the threads
+    def dump_threads(self, timestamp):
+        path = self.path("threads", timestamp, "txt")
+        names = {t.ident: (t.name, t.daemon) for t in threading.enumerate()}
+        frames = sys._current_frames()
+        try:
+            with open(path, mode="w") as f:
+                for ident, frame in frames.items():
+                    name, daemon = names.get(ident, (str(ident), None))
+                    f.write("Thread %s (%i%s):\n" % (name, ident, ", daemon" if daemon else ""))
+                    f.write("".join(traceback.format_stack(frame)))
+                    f.write("\n")
+        except OSError as e:
+            log.error("Error while attempting to save thread stacks to \"%s\": %s" % (path, e.strerror))
+            return
+        log.info("Stacks of %i threads saved to %s" % (len(frames), path))
+
+    def __init__(self, directory, interval=0.01, max_duration=300):
+        self.directory = directory
+        self.interval = interval
+        self.max_duration = max_duration
+        self.lock = Lock()
+        self.stopping = Event()
+        self.thread = None
+
+# Convert sampled stacks into the table that the pstats module loads, i.e.
+# {(file, line, function): (calls, primitive calls, own time, cumulative
+# time, {caller: (calls, primitive calls, own time, cumulative time)})},
+# by counting samples as calls and charging each sample with the sampling
+# interval
+def pstats_table(stacks, interval):
+    table = {}
+    def entry(function):
+        if function not in table:
+            table[function] = [0, 0, 0.0, 0.0, {}]
+        return table[function]
+    for (thread_name, codes), count in stacks.items():
+        functions = [(c.co_filename, c.co_firstlineno, c.co_name) for c in codes]
+        # Recursive calls are only charged once per sample
+        for function in set(functions):
+            e = entry(function)
+            e[0] += count
+            e[1] += count
+            e[3] += count * interval
+        if functions:
+            entry(functions[-1])[2] += count * interval
+        for caller, callee in set(zip(functions, functions[1:])):
+            own_time = count * interval if callee == functions[-1] else 0.0
+            calls, primitive_calls, tt, ct = entry(callee)[4].get(caller, (0, 0, 0.0, 0.0))
+            entry(callee)[4][caller] = (calls + count, primitive_calls + count, tt + own_time, ct + count * interval)
+    return {function: tuple(e) for function, e in table.items()}
@@ -0,0 +1,56 @@
+import time
+from threading import Lock
+from modules.utilities import log
+
+# Wrapper around an MQTT client that keeps track of the last value published
+# on each topic, so that a value is only published again when it actually
+# changes. This avoids flooding the broker (and waking up all the subscribers)
+# with identical messages at every polling cycle. Optionally, unchanged
+# values are republished anyway once every republish_interval seconds.
+# All values are published with the same QoS
+class StatePublisher:
+    # Publish a payload on a topic, unless the same payload has already
+    # been published on the same topic (and the republish interval, if any,
+    # has not expired yet). Setting force to True always publishes the payload.
+    # If value is given, it is compared instead of the payload (e.g., for
+    # payloads that carry a timestamp, which changes at every publication).
+    # Return True if the payload has been published; False otherwise
+    def publish(self, topic, payload, retain=True, force=False, value=None):
+        value = str(payload) if value is None else value
+        now = time.monotonic()
+        with self.lock:
+            if not force and topic in self.last_published:
+                last_value, last_time = self.last_published[topic]
+                if last_value == value and (self.republish_interval is None or now - last_time < self.republish_interval):
+                    self.suppressed_count += 1
+                    return False
+            self.last_published[topic] = (value, now)
+            self.sent_count += 1
+        self.mqttc.publish(topic, payload=payload, qos=self.qos, retain=retain)
+        return True
+
+    # Forget the last published value for a topic (or for all topics, if
+    # no topic is specified), so that the next value is published anyway
+    def invalidate(self, topic=None):
+        with self.lock:
+            if topic is None:
+                self.last_published.clear()
+            else:
+                self.last_published.pop(topic, None)
+
+    # Return the number of sent and suppressed publications
+    def stats(self):
+        return (self.sent_count, self.suppressed_count)
+
+    def __init__(self, mqttc, republish_interval=None, qos=0):
+        self.mqttc = mqttc
+        self.qos = qos
+        # Republish interval is configured in minutes
+        self.republish_interval = republish_interval * 60 if republish_interval else None
+        self.lock = Lock()
+        # Last value published on each topic, along with
+        # the time it has been published
+        self.last_published = {}
+        self.sent_count = 0
+        self.suppressed_count = 0
+        log.debug("State publisher initialized (republish interval: %s)" % (("%i minutes" % republish_interval) if republish_interval else "none"))
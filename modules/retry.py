@@ -0,0 +1,84 @@
+import random
+from modules import codec
+
+# Classes of failed API calls that may be retried
+CONNECTION = "connection"
+SERVER_ERROR = "server_error"
+RATE_LIMIT = "rate_limit"
+TOKEN_EXPIRED = "token_expired"
+
+# Return the class of a failed API call, given the HTTP response (if any),
+# or None if the failure is not transient and the call should not be retried
+def classify_failure(response):
+    if response is None:
+        return CONNECTION
+    if 500 <= response.status_code <= 599:
+        return SERVER_ERROR
+    if response.status_code in (403, 429):
+        try:
+            code = codec.loads(response.content)['error']['code']
+        except (ValueError, KeyError, TypeError):
+            return None
+        if response.status_code == 403 and code == 3:
+            return TOKEN_EXPIRED
+        if response.status_code == 429 and code == 11:
+            return RATE_LIMIT
+    return None
+
+# How many times a class of failures is retried, and how long to wait
+# before each retry: the delay grows exponentially from base_delay up to
+# max_delay, and half of it is randomized (jitter), so that clients that
+# have failed at the same time do not all retry at the same time
+class RetryRule:
+    def delay(self, retry):
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (retry - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def __init__(self, max_retries, base_delay, max_delay, multiplier=2):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+
+# Retry rules for a type of API call, by class of failure, along with
+# the maximum time (in seconds) that the call may take, retries included
+class RetryPolicy:
+    def __init__(self, deadline, rules):
+        self.deadline = deadline
+        self.rules = rules
+
+# Thermostat updates carry the user's intent, so they are retried more
+# persistently than polls, which are repeated at the next cycle anyway.
+# An expired token is refreshed and the call repeated right away, once
+DEFAULT_POLICIES = {
+    'poll': RetryPolicy(20, {
+        CONNECTION: RetryRule(2, 1, 5),
+        SERVER_ERROR: RetryRule(2, 2, 8),
+        RATE_LIMIT: RetryRule(0, 30, 60),
+        TOKEN_EXPIRED: RetryRule(1, 0, 0)
+    }),
+    'setstate': RetryPolicy(180, {
+        CONNECTION: RetryRule(5, 1, 30),
+        SERVER_ERROR: RetryRule(5, 2, 30),
+        RATE_LIMIT: RetryRule(3, 30, 120),
+        TOKEN_EXPIRED: RetryRule(1, 0, 0)
+    })
+}
+
+# Return the retry policies, with any overrides from the given settings, e.g.:
+#   {'setstate': {'deadline': 60, 'rate_limit': {'max_retries': 1}}}
+def configured_policies(retry_settings):
+    policies = {}
+    for call_type, default in DEFAULT_POLICIES.items():
+        overrides = retry_settings.get(call_type) or {}
+        rules = {}
+        for failure, rule in default.rules.items():
+            rule_overrides = overrides.get(failure) or {}
+            rules[failure] = RetryRule(
+                rule_overrides.get('max_retries', rule.max_retries),
+                rule_overrides.get('base_delay', rule.base_delay),
+                rule_overrides.get('max_delay', rule.max_delay),
+                rule_overrides.get('multiplier', rule.multiplier)
+            )
+        policies[call_type] = RetryPolicy(overrides.get('deadline', default.deadline), rules)
+    return policies
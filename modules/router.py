@@ -0,0 +1,73 @@
+from modules.utilities import log
+from modules import metrics
+
+# Compute the topic filter that matches all the given topics by
+# replacing the levels that differ among them with a "+" wildcard.
+# Return None if topics differ in depth or in more than max_wildcards
+# levels, so that a filter would match too many unrelated topics
+def common_filter(topics, max_wildcards=1):
+    split_topics = [t.split('/') for t in topics]
+    if len(set(len(s) for s in split_topics)) != 1:
+        return None
+    levels = [l[0] if all(x == l[0] for x in l) else '+' for l in zip(*split_topics)]
+    if levels.count('+') > max_wildcards:
+        return None
+    return '/'.join(levels)
+
+# A command topic, along with the room it is addressed to and the
+# functions that parse its payload and act upon it
+class Route:
+    def __init__(self, topic, room_id, action, parser, handler):
+        self.topic = topic
+        self.room_id = room_id
+        self.action = action
+        self.parser = parser
+        self.handler = handler
+
+# Dispatcher of received MQTT commands. Routes are compiled once into
+# a table indexed by full topic, so that each message is dispatched
+# with a single lookup, whatever the number of rooms served
+class TopicRouter:
+    def add(self, topic, room_id, action, parser, handler):
+        self.routes[topic] = Route(topic, room_id, action, parser, handler)
+
+    # Return the topic filters to be subscribed to in order to receive
+    # all the routed topics. The rooms that topics belong to are merged
+    # under a single "+" wildcard where possible (e.g., a/+/commands/+
+    # instead of a/room1/commands/+ and a/room2/commands/+), unless
+    # filters are explicitly configured
+    def subscriptions(self, configured_filters=None):
+        if configured_filters:
+            return list(configured_filters)
+        parents = sorted(set(t.rsplit('/', 1)[0] for t in self.routes))
+        merged = common_filter(parents) if len(parents) > 1 else None
+        if merged is not None:
+            return [merged + '/+']
+        return [p + '/+' for p in parents]
+
+    # Check whether a topic is routed. Wildcard subscriptions may match
+    # other topics (e.g., the status topics published by smarther2mqtt
+    # itself), which are better ignored before doing anything with them
+    def routed(self, topic):
+        return topic in self.routes
+
+    # Dispatch a message to the handler of its topic, passing the
+    # room it is addressed to, its parsed payload and userdata.
+    # Return False if the topic is not routed or the payload is invalid
+    def dispatch(self, topic, payload, userdata=None):
+        route = self.routes.get(topic)
+        if route is None:
+            # Wildcard subscriptions may match topics that are not routed
+            log.debug("No route for topic %s: message ignored" % topic)
+            return False
+        with metrics.command_handling_time.time(topic):
+            try:
+                value = route.parser(payload)
+            except ValueError as e:
+                log.warning("Invalid %s command for room %s: %s" % (route.action, route.room_id, e))
+                return False
+            route.handler(route.room_id, value, userdata)
+        return True
+
+    def __init__(self):
+        self.routes = {}
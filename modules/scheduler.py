@@ -0,0 +1,151 @@
+import heapq, time
+from threading import Thread, Condition
+from modules.utilities import log
+
+# A single scheduler that runs deferred calls from one persistent thread,
+# instead of creating a separate Timer thread for each call.
+# Calls are identified by a key (e.g., the room a thermostat update is
+# meant for): scheduling a call with the same key as a pending one replaces
+# the pending call and postpones it until no further calls with that key are
+# scheduled for idle_time seconds (debouncing). However, a call is never
+# postponed by more than max_delay seconds after the first pending request,
+# so that a steady stream of requests cannot delay it forever.
+# Pending calls are kept in a heap ordered by deadline.
+class DebounceScheduler:
+    class Entry:
+        def __init__(self, function, args, first_requested, deadline, seq):
+            self.function = function
+            self.args = args
+            self.first_requested = first_requested
+            self.deadline = deadline
+            self.seq = seq
+
+    # Add an entry to the pending ones. Must be called with the condition held
+    def add_entry(self, key, function, args, first_requested, deadline):
+        self.seq += 1
+        self.entries[key] = self.Entry(function, args, first_requested, deadline, self.seq)
+        heapq.heappush(self.heap, (deadline, self.seq, key))
+        self.wakeup()
+
+    # Schedule function(*args) to be run once no other calls with
+    # the same key have been scheduled for idle_time seconds
+    def schedule(self, key, function, *args):
+        now = time.monotonic()
+        with self.condition:
+            self.scheduled_count += 1
+            entry = self.entries.get(key)
+            first_requested = entry.first_requested if entry else now
+            deadline = now + self.idle_time
+            if self.max_delay is not None:
+                deadline = min(deadline, first_requested + self.max_delay)
+            log.debug("Scheduling %s within %.1f seconds" % (repr(key), deadline - now))
+            self.add_entry(key, function, args, first_requested, deadline)
+
+    # Schedule function(*args) to be run at a specific time (as returned
+    # by time.monotonic()), replacing any pending call with the same key
+    def schedule_at(self, key, when, function, *args):
+        with self.condition:
+            self.scheduled_count += 1
+            self.add_entry(key, function, args, time.monotonic(), when)
+
+    # Cancel the pending call with the given key, if any.
+    # Return True if a call has been canceled
+    def cancel(self, key):
+        with self.condition:
+            if self.entries.pop(key, None) is None:
+                return False
+            log.debug("Canceled pending %s" % repr(key))
+            self.wakeup()
+            return True
+
+    # Check whether a call with the given key is pending
+    def pending(self, key):
+        with self.condition:
+            return key in self.entries
+
+    # Remove and return all the entries that are due by the given time (or
+    # all the entries that match the given key, if any). Entries are returned
+    # in order of deadline. Must be called with the condition held
+    def pop_entries(self, until=None, key=None):
+        if key is not None:
+            entry = self.entries.pop(key, None)
+            return [entry] if entry else []
+        due = []
+        while self.heap and (until is None or self.heap[0][0] <= until):
+            deadline, seq, k = heapq.heappop(self.heap)
+            entry = self.entries.get(k)
+            # Skip heap items that have been superseded by a newer
+            # call with the same key, or canceled
+            if entry is None or entry.seq != seq:
+                continue
+            del self.entries[k]
+            due.append(entry)
+        return due
+
+    # Return the deadline of the earliest pending call, or None if
+    # no calls are pending. Must be called with the condition held
+    def next_deadline(self):
+        while self.heap:
+            deadline, seq, k = self.heap[0]
+            entry = self.entries.get(k)
+            if entry is not None and entry.seq == seq:
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    def run_entries(self, entries):
+        for entry in entries:
+            self.executed_count += 1
+            try:
+                entry.function(*entry.args)
+            except Exception as e:
+                log.error("Exception raised by scheduled call %s: %s" % (getattr(entry.function, '__name__', repr(entry.function)), repr(e)))
+
+    # Immediately run the pending call with the given key (or all pending
+    # calls, if no key is given) in the calling thread
+    def flush(self, key=None):
+        with self.condition:
+            entries = self.pop_entries(key=key)
+        self.run_entries(entries)
+
+    # Signal that the set of pending calls has changed. Must be
+    # called with the condition held
+    def wakeup(self):
+        self.condition.notify()
+
+    # Body of the scheduler thread
+    def run(self):
+        while True:
+            with self.condition:
+                if self.stopped:
+                    return
+                due = self.pop_entries(until=time.monotonic())
+                if not due:
+                    deadline = self.next_deadline()
+                    self.condition.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+                    continue
+            self.run_entries(due)
+
+    def start(self):
+        self.thread = Thread(target=self.run, name='scheduler', daemon=True)
+        self.thread.start()
+
+    # Stop the scheduler thread. Pending calls are discarded, unless
+    # they are explicitly flushed beforehand
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.wakeup()
+
+    def __init__(self, idle_time, max_delay=None):
+        self.idle_time = idle_time
+        self.max_delay = max_delay
+        self.condition = Condition()
+        self.heap = []
+        self.entries = {}
+        self.seq = 0
+        self.stopped = False
+        self.thread = None
+        # Counters used to assess how many calls have been coalesced
+        self.scheduled_count = 0
+        self.executed_count = 0
@@ -0,0 +1,89 @@
+import os, time
+from threading import Lock
+from modules.utilities import log
+from modules import codec
+
+# Room status fields that are persisted in the snapshot
+SNAPSHOT_ROOM_FIELDS = ('therm_measured_temperature', 'humidity', 'therm_setpoint_temperature', 'therm_setpoint_mode', 'therm_setpoint_end_time')
+
+# Compact summary of the topology of a home, as returned by /homesdata:
+# the name of each room and the modules (with their types) in each room
+def summarize_topology(home_json):
+    return {
+        'rooms': {r['id']: r.get('name') for r in home_json.get('rooms', [])},
+        'modules': [{'id': m['id'], 'type': m.get('type'), 'room_id': m.get('room_id')} for m in home_json.get('modules', [])]
+    }
+
+# Snapshot of the last known status of each room and of the topology of
+# the home, persisted to a file so that it can be published right away
+# upon the next startup, before the Netatmo cloud is contacted.
+# The file is only rewritten when its contents have changed
+class StateSnapshot:
+    # Load the snapshot from file. This method is silently ineffective
+    # in case the file does not exist or is not valid
+    def load(self):
+        if not os.path.isfile(self.path):
+            log.debug("State snapshot file not found")
+            return
+        try:
+            with open(self.path, mode="rb") as f:
+                snapshot = codec.loads(f.read())
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring invalid state snapshot file \"%s\": %s" % (self.path, repr(e)))
+            return
+        with self.lock:
+            self.rooms = snapshot.get('rooms') or {}
+            self.topology = snapshot.get('topology')
+            self.saved_at = snapshot.get('saved_at')
+        log.debug("State snapshot loaded (saved %s seconds ago)" % ("%.0f" % (time.time() - self.saved_at) if self.saved_at else "<unknown>"))
+
+    # Write the snapshot to file, if it has changed since it was last
+    # written. The file is replaced atomically, so that a crash never
+    # leaves a truncated snapshot behind
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.saved_at = time.time()
+            data = codec.dumps({'saved_at': self.saved_at, 'rooms': self.rooms, 'topology': self.topology})
+            self.dirty = False
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, mode="w") as f:
+                f.write(data)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            log.warning("Error while attempting to save state snapshot to file \"%s\": %s" % (self.path, e.strerror))
+
+    # Record the last known status of a room
+    def update_room(self, room_id, room_status):
+        room_snapshot = {k: room_status.get(k) for k in SNAPSHOT_ROOM_FIELDS}
+        with self.lock:
+            if self.rooms.get(room_id) != room_snapshot:
+                self.rooms[room_id] = room_snapshot
+                self.dirty = True
+
+    def update_topology(self, topology):
+        with self.lock:
+            if self.topology != topology:
+                self.topology = topology
+                self.dirty = True
+
+    # Return the last known status of a room, or None if unknown
+    def room(self, room_id):
+        with self.lock:
+            room_snapshot = self.rooms.get(room_id)
+            return dict(room_snapshot) if room_snapshot else None
+
+    # Return the last known status of all the rooms
+    def all_rooms(self):
+        with self.lock:
+            return {room_id: dict(room_snapshot) for room_id, room_snapshot in self.rooms.items()}
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.rooms = {}
+        self.topology = None
+        self.saved_at = None
+        self.dirty = False
@@ -30,12 +30,21 @@ logging.basicConfig(format="[%(asctime)s] %(levelname)s:%(name)s:%(funcName)s:%(
 
 # A few ready-to-use classes that implement a
 # "publish" method used to present messages that
-# request user interaction
+# request user interaction. Each class can optionally
+# be given an HTTP session to be used for sending
+# messages (by default, a new connection is opened for
+# every message)
 class LogRequester:
+    def __init__(self, session=requests):
+        self.session = session
+
     def publish(self, message):
         log.info(message)
 
 class TelegramRequester:
+    def __init__(self, session=requests):
+        self.session = session
+
     def publish(self, message):
         telegram_base_url = "https://api.telegram.org/bot%s/sendMessage" %settings['telegram']['bot_token']
         message = re.sub(r"\.", "\\.", message)
@@ -45,17 +54,39 @@ class TelegramRequester:
             'text': message
         }
         log.debug("Sending telegram message by using the following URL: %s and JSON data: %s" % (telegram_base_url, repr(json_dict)))
-        requests.post(telegram_base_url, json=json_dict, timeout=20)
+        self.session.post(telegram_base_url, json=json_dict, timeout=20)
+
+# Return the list of rooms (thermostats) served by this instance. Each
+# room is described by a dictionary with keys 'roomid', 'publish_base_topic'
+# and 'subscribe_base_topic'. If no 'rooms' list is configured, the single
+# room identified by the 'roomid' setting is returned, using the base topics
+# from the MQTT settings
+def configured_rooms():
+    if 'rooms' in settings['netatmo'] and settings['netatmo']['rooms']:
+        return [{
+            'roomid': r['roomid'],
+            'publish_base_topic': r['publish_base_topic'],
+            'subscribe_base_topic': r['subscribe_base_topic']
+        } for r in settings['netatmo']['rooms']]
+    return [{
+        'roomid': settings['netatmo']['roomid'],
+        'publish_base_topic': settings['mqtt']['publish_topics']['base_topic'],
+        'subscribe_base_topic': settings['mqtt']['subscribe_topics']['base_topic']
+    }]
 
-# Set up connection to the MQTT broker
-def mqtt_init():
+# Set up connection to the MQTT broker. An instance id (which must be unique
+# among all the instances of smarther2mqtt) and a Last Will, given as a
+# (topic, payload) tuple, can be optionally specified
+def mqtt_init(instance_id=None, will=None):
     log.debug("Initializing connection to the MQTT broker")
     # A client_id is required in order to preserve topic subscriptions in case
     # connection with the broker is lost and restored. To limit the likeliness
     # of collision with other instances of smarther2mqtt, a random client_id is
-    # generated here
-    mqttc = mqtt.Client(client_id = 'smarther2mqtt_' + ''.join(choices(ascii_letters + digits, k=10)), clean_session = False)
+    # generated here, unless an instance id is given
+    mqttc = mqtt.Client(client_id = 'smarther2mqtt_' + (instance_id or ''.join(choices(ascii_letters + digits, k=10))), clean_session = False)
     mqttc.enable_logger(log)
+    if will is not None:
+        mqttc.will_set(will[0], payload = will[1], qos = 1, retain = True)
     mqttc.connect(settings['mqtt']['broker']['ipaddress'], port=(settings['mqtt']['broker']['port'] if 'port' in settings['mqtt']['broker'] else 1883))
     return mqttc
 
@@ -0,0 +1,91 @@
+import hmac, hashlib, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+from threading import Lock
+from modules.utilities import log
+from modules import codec
+
+# Room status fields that webhook events may carry. Any other field
+# of an event is ignored
+ROOM_EVENT_FIELDS = ('therm_measured_temperature', 'humidity', 'therm_setpoint_temperature', 'therm_setpoint_mode', 'therm_setpoint_end_time')
+
+# Last known status of each room, as retrieved by polling and then
+# incrementally updated by webhook events
+class RoomStatusCache:
+    # Store the status of a room as retrieved by a poll started at
+    # poll_started (as returned by time.monotonic()). Return False if
+    # the room has been updated by a webhook event in the meantime, in
+    # which case the (possibly older) polled status is discarded
+    def update_from_poll(self, room_id, room_status, poll_started):
+        with self.lock:
+            if self.event_times.get(room_id, 0) > poll_started:
+                return False
+            self.statuses[room_id] = dict(room_status)
+            return True
+
+    # Merge the fields carried by a webhook event into the status of a room.
+    # Return the updated status, or None if the room has never been polled
+    # (events only carry the fields that have changed)
+    def update_from_event(self, room_id, room_event):
+        with self.lock:
+            if room_id not in self.statuses:
+                return None
+            self.statuses[room_id].update({k: v for k, v in room_event.items() if k in ROOM_EVENT_FIELDS})
+            self.event_times[room_id] = time.monotonic()
+            return dict(self.statuses[room_id])
+
+    def __init__(self):
+        self.lock = Lock()
+        self.statuses = {}
+        self.event_times = {}
+
+# Check the signature of a webhook event. The Netatmo cloud signs each
+# event with an HMAC-SHA256 of its body, keyed with the client secret
+# of the application
+def valid_signature(secret, body, signature):
+    expected = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+def WebhookHTTPRequestHandler(path, secret, event_handler):
+    class HTTPRequestHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if urlparse(self.path).path != path:
+                log.debug("Unexpected webhook URL: %s - No actions taken" % self.path)
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if secret is not None and not valid_signature(secret, body, self.headers.get('X-Netatmo-Secret')):
+                log.warning("Discarding webhook event with invalid signature from %s" % self.client_address[0])
+                self.send_error(403)
+                return
+            try:
+                event = codec.loads(body)
+            except ValueError:
+                log.warning("Discarding webhook event with invalid JSON body: %s" % body)
+                self.send_error(400)
+                return
+            # Acknowledge the event before processing it, so that
+            # the sender is never kept waiting
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            try:
+                event_handler(event)
+            except Exception as e:
+                log.error("Exception raised while processing webhook event %s: %s" % (event, repr(e)))
+
+        def log_message(self, format, *args):
+            log.debug("Webhook request from %s: %s" % (self.client_address[0], format % args))
+
+    return HTTPRequestHandler
+
+# Run a long-lived web server that receives webhook events on the
+# given path, in a separate (daemon) thread. Each event is handed,
+# JSON-decoded, to event_handler. If a secret is given, events whose
+# signature does not match are rejected
+def start_webhook_server(ipaddress, port, path, secret, event_handler):
+    log.info("Listening for webhook events on http://%s:%i%s" % (ipaddress, port, path))
+    server = ThreadingHTTPServer((ipaddress, port), WebhookHTTPRequestHandler(path, secret, event_handler))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+    return server
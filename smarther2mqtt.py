@@ -1,9 +1,24 @@
 #!/usr/bin/python3
 
-import time, json, requests, signal
-from threading import Thread
-from modules.utilities import log, settings, mqtt_init, mode_user_to_NA, mode_NA_to_user, LogRequester, TelegramRequester, signal_to_interrupt
-from modules.netatmo import NetatmoToken
+import time, os, requests, signal, socket
+from threading import Thread, current_thread
+from modules.utilities import log, settings, mqtt_init, mode_user_to_NA, mode_NA_to_user, LogRequester, TelegramRequester, signal_to_interrupt, configured_rooms
+from modules.netatmo import NetatmoToken, extract_rooms, room_device_types
+from modules.publisher import StatePublisher
+from modules.optimistic import OptimisticState
+from modules.webhook import RoomStatusCache, start_webhook_server
+from modules.snapshot import StateSnapshot, summarize_topology
+from modules.history import HistoryBuffer
+from modules.router import TopicRouter
+from modules.commands import CommandQueue
+from modules.ha import LeaderElection
+from modules.aioengine import AsyncioEngine
+from modules.health import HealthMonitor, LIVENESS, start_health_server
+from modules.profiler import SamplingProfiler
+from modules import metrics, codec
+
+# Time-to-first-publish is measured from here
+startup_time = time.monotonic()
 
 
 def obtain_netatmo_token(netatmo):
@@ -13,24 +28,68 @@ def obtain_netatmo_token(netatmo):
             notification_channels += [TelegramRequester]
     netatmo.get_new_token(notification_channels)
 
-def get_room_in_home(home_json, room_id):
-    for r in home_json['rooms']:
-        if r['id'] == room_id:
-            return r
-    return None
+# Parsers of command payloads. They raise ValueError for invalid payloads
+def parse_temperature(payload):
+    return float(payload.decode())
+
+def parse_mode(payload):
+    mode = payload.decode().upper()
+    if mode not in mode_user_to_NA:
+        raise ValueError("invalid mode %s" % mode)
+    return mode_user_to_NA[mode]
+
+# Handlers of commands, invoked with the room that they are addressed to,
+# the parsed payload and the state publisher
+def command_temperature_setpoint(room_id, temperature, publisher):
+    if netatmo.set_temperature(room_id, temperature):
+        publish_optimistic_state(publisher, room_id, temperature = temperature, mode = "manual")
+
+def command_mode(room_id, mode, publisher):
+    if netatmo.set_mode(room_id, mode):
+        publish_optimistic_state(publisher, room_id, mode = mode)
+
+# Compile the routes of the command topics of all the rooms
+def build_router():
+    router = TopicRouter()
+    for room in rooms:
+        base_topic = room['subscribe_base_topic'] + '/'
+        router.add(base_topic + settings['mqtt']['subscribe_topics']['temperature_setpoint'], room['roomid'], "temperature setpoint", parse_temperature, command_temperature_setpoint)
+        router.add(base_topic + settings['mqtt']['subscribe_topics']['mode'], room['roomid'], "mode", parse_mode, command_mode)
+    return router
 
+# Execute a command, in the worker thread of the command queue. Commands
+# with an invalid payload are rejected on the result topic of their room
+def execute_command(topic, payload, publisher):
+    if election is not None and not election.is_leader():
+        # Leadership has been lost while the command was queued
+        election.record_command(topic, payload)
+        return
+    if not router.dispatch(topic, payload, publisher):
+        route = router.routes.get(topic)
+        if route is not None:
+            publish_command_result(publisher.mqttc, route.room_id, {'status': 'rejected', 'message': "Invalid %s command: %s" % (route.action, payload.decode(errors='replace'))})
+    publish_handover()
+
+# Notify the sender of a command that has been discarded because
+# the command queue is full
+def report_dropped_command(topic, payload, publisher):
+    route = router.routes.get(topic)
+    if route is not None:
+        publish_command_result(publisher.mqttc, route.room_id, {'status': 'dropped', 'message': "Command queue full"})
+
+# Received commands are only queued here, as this is run by the
+# MQTT client, which must never be kept waiting
 def handle_received_command(client, userdata, message):
     try:
-        msg = message.payload.decode().upper()
-        log.debug("Received MQTT command %s with topic %s" % (msg, message.topic))
-        base_topic = settings['mqtt']['subscribe_topics']['base_topic']
-        if message.topic == base_topic + '/' + settings['mqtt']['subscribe_topics']['temperature_setpoint']:
-            netatmo.set_temperature(msg)
-        elif message.topic == base_topic + '/' + settings['mqtt']['subscribe_topics']['mode']:
-            if msg in mode_user_to_NA:
-                netatmo.set_mode(mode_user_to_NA[msg])
-            else:
-                log.warning("Invalid mode received: %s", msg)
+        if not router.routed(message.topic):
+            log.debug("No route for topic %s: message ignored" % message.topic)
+            return
+        log.debug("Received MQTT command %s with topic %s" % (message.payload, message.topic))
+        if election is not None and not election.is_leader():
+            # Only the leader acts upon commands
+            election.record_command(message.topic, message.payload)
+            return
+        command_queue.put(message.topic, message.payload, userdata)
     except Exception as e:
         # In recent releases of paho-mqtt, exceptions raised inside
         # callback functions may have two alternative effects:
@@ -46,92 +105,672 @@ def handle_received_command(client, userdata, message):
         # In this case option b) is applied.
         log.error("Exception raised while processing received message '%s': %s" % (message.payload, repr(e)))
 
+# Topics that optimistic states are published to: either the
+# state topics themselves or separate "target" topics
+def optimistic_topics(room_id):
+    base_topic = room_by_id[room_id]['publish_base_topic'] + '/'
+    publish_topics = settings['mqtt']['publish_topics']
+    if OPTIMISTIC_MODE == 'state':
+        return base_topic + publish_topics['temperature_setpoint'], base_topic + publish_topics['mode']
+    return (base_topic + publish_topics.get('target_temperature_setpoint', 'target_temperature_setpoint'),
+            base_topic + publish_topics.get('target_mode', 'target_mode'))
+
+# If optimistic publishing is enabled, publish a commanded state right
+# away, without waiting for the Netatmo cloud to confirm it
+def publish_optimistic_state(publisher, room_id, temperature=None, mode=None):
+    if OPTIMISTIC_MODE not in ('target', 'state'):
+        return
+    optimistic.command(room_id, temperature, mode)
+    temperature_topic, mode_topic = optimistic_topics(room_id)
+    if temperature is not None:
+        publisher.publish(temperature_topic, payload = temperature, retain = True)
+    if mode is not None:
+        publisher.publish(mode_topic, payload = mode_NA_to_user[mode], retain = True)
+
+# Reconcile the optimistic state of a room with its status as reported
+# by the Netatmo cloud, once the update sent to the room has been confirmed
+# or has timed out. If they differ, publish a mismatch event and correct
+# the target topics (state topics are corrected anyway by
+# publish_room_status)
+def reconcile_optimistic_state(publisher, room, room_status, confirmed):
+    mismatch = optimistic.reconcile(room['roomid'], room_status, confirmed)
+    if mismatch is None:
+        return
+    topic = room['publish_base_topic'] + '/' + settings['mqtt']['publish_topics'].get('mismatch', 'mismatch')
+    publisher.mqttc.publish(topic, payload = codec.dumps({'room': room['roomid'], 'mismatch': mismatch, 'timestamp': int(time.time())}), qos = QOS['events'])
+    if OPTIMISTIC_MODE == 'target':
+        temperature_topic, mode_topic = optimistic_topics(room['roomid'])
+        publisher.publish(temperature_topic, payload = room_status['therm_setpoint_temperature'], retain = True)
+        publisher.publish(mode_topic, payload = mode_NA_to_user[room_status['therm_setpoint_mode']], retain = True)
+
+# Publish the status of a single room to the MQTT broker, on separate
+# topics for each field and/or as a single JSON document on the state
+# topic, depending on the publish mode
+# Values are only published when they have changed
+# since the last time they have been published
+def publish_room_status(publisher, room, room_status):
+    room_id = room['roomid']
+    base_topic = room['publish_base_topic'] + '/'
+    publish_topics = settings['mqtt']['publish_topics']
+    # While a command is pending, the setpoint and mode retrieved from the
+    # Netatmo cloud are outdated: the last published ones are kept instead
+    fields = {
+        'temperature': room_status['therm_measured_temperature'],
+        'humidity': room_status['humidity'],
+        'setpoint_endtime': room_status['therm_setpoint_end_time'] or 0
+    }
+    if not netatmo.temperature_update_pending(room_id):
+        fields['temperature_setpoint'] = room_status['therm_setpoint_temperature']
+        netatmo.update_temperature(room_id, room_status['therm_setpoint_temperature'])
+    if not netatmo.mode_update_pending(room_id):
+        fields['mode'] = mode_NA_to_user[room_status['therm_setpoint_mode']]
+        netatmo.update_mode(room_id, room_status['therm_setpoint_mode'])
+    if PUBLISH_MODE in ('fields', 'both'):
+        for field, value in fields.items():
+            publisher.publish(base_topic + publish_topics[field], payload = value, retain = True)
+    if PUBLISH_MODE in ('json', 'both'):
+        state = room_states.setdefault(room_id, {})
+        state.update(fields)
+        # The timestamp is left out of the comparison, so that the
+        # document is only published again when a field changes
+        publisher.publish(base_topic + publish_topics.get('state', 'state'),
+                          payload = codec.dumps({**state, 'timestamp': int(time.time())}),
+                          retain = True,
+                          value = codec.dumps(state, sort_keys = True))
+
+
+def stale_topic(room):
+    return room['publish_base_topic'] + '/' + settings['mqtt']['publish_topics'].get('stale', 'stale')
+
+# Record the time elapsed since startup when the first status (either
+# from the snapshot or fresh from the Netatmo cloud) is published
+def record_first_publish(source):
+    if source not in first_publish:
+        first_publish[source] = time.monotonic() - startup_time
+        log.info("Time to first publish (%s status): %.3f seconds" % (source, first_publish[source]))
+
+# Publish the last known status of all the rooms, as saved in the
+# snapshot, and mark it as stale until fresh readings are retrieved
+def publish_snapshot(publisher):
+    published = False
+    for room in rooms:
+        room_status = snapshot.room(room['roomid'])
+        if room_status is None:
+            continue
+        publish_room_status(publisher, room, room_status)
+        publisher.publish(stale_topic(room), payload = "true", retain = True)
+        published = True
+    if published:
+        record_first_publish("snapshot")
+
+# Check that all the configured rooms exist in the topology of the home,
+# and restrict polls to the types of the modules located in those rooms
+def check_topology(topology):
+    for room in rooms:
+        if room['roomid'] in topology['rooms']:
+            log.debug("Room %s is named \"%s\"" % (room['roomid'], topology['rooms'][room['roomid']]))
+        else:
+            log.warning("Room %s not found in the topology of home %s" % (room['roomid'], settings['netatmo']['homeid']))
+    if settings['netatmo'].get('trim_homestatus', True) and homestatus_trimmed is not False:
+        netatmo.set_homestatus_device_types(room_device_types(topology, room_by_id) or None)
+
+# Retrieve the topology of the home from the Netatmo cloud and update
+# the snapshot. This is run in the background, so that it never delays
+# the publication of the status of the rooms
+def refresh_topology():
+    try:
+        homes_data = codec.loads(netatmo.query_homesdata())
+        home = next(h for h in homes_data['body']['homes'] if h['id'] == settings['netatmo']['homeid'])
+    except StopIteration:
+        log.warning("Home %s not found in the topology retrieved from the Netatmo cloud" % settings['netatmo']['homeid'])
+        return
+    except Exception as e:
+        log.warning("Failed to retrieve the topology of the home: %s" % repr(e))
+        return
+    topology = summarize_topology(home)
+    log.debug("Home topology: %s", codec.Lazy(topology))
+    check_topology(topology)
+    snapshot.update_topology(topology)
+
+# Publish the status of a room, as observed at observed_at (as returned
+# by time.monotonic()), and check whether it confirms the last update
+# sent to the room
+def process_room_status(publisher, room, room_status, observed_at):
+    publish_room_status(publisher, room, room_status)
+    publisher.publish(stale_topic(room), payload = "false", retain = True)
+    snapshot.update_room(room['roomid'], room_status)
+    if history is not None:
+        history.record(room['roomid'], time.time(), room_status.get('therm_measured_temperature'), room_status.get('humidity'), room_status.get('therm_setpoint_temperature'), room_status.get('therm_setpoint_mode'))
+    record_first_publish("fresh")
+    confirmation_latency = netatmo.confirm_update(room['roomid'], room_status, observed_at)
+    if confirmation_latency is not None:
+        topic = room['publish_base_topic'] + '/' + settings['mqtt']['publish_topics'].get('confirmation_latency', 'confirmation_latency')
+        publisher.mqttc.publish(topic, payload = "%.1f" % confirmation_latency, qos = QOS['events'])
+
+# Run a single polling cycle: retrieve the status of the home
+# and publish the status of all the configured rooms
+def poll_cycle(publisher, last_readings):
+    # Get information about the whole home
+    poll_started = time.monotonic()
+    home_status_string = netatmo.query_homestatus(settings['netatmo']['homeid'])
+    decode_started = time.perf_counter()
+    with metrics.json_decode_time.time("homestatus"):
+        home_status = codec.loads(home_status_string)
+    log.debug("Home status: %i bytes, decoded in %.2f milliseconds", len(home_status_string), (time.perf_counter() - decode_started) * 1000)
+    # Logged lazily, so that the document is only serialized again
+    # when debug logging is enabled
+    log.debug("Received home status: %s", codec.Lazy(home_status))
+
+    # Check whether global API rate limits (which may occasionally occur)
+    # have been hit. This is signaled by the following response body in an
+    # HTTP 429 error response:
+    # {
+    #   "error": {
+    #     "code": 11,
+    #     "message": "Failed to enter concurrency limited section"
+    #   }
+    # }
+    if 'error' in home_status:
+        log.warning("API returned system-wide error %s. Will try again at next polling cycle" % home_status['error'].get('code'))
+        return
+    else:
+        # The response is assumed to have a 'body' key at this point
+
+        # Check whether any application-level errors have been
+        # reported (see https://dev.netatmo.com/apidocumentation/general#status-ok)
+        if 'errors' in home_status['body']:
+            log.warning("API returned application-evel error code %i. Will try again at next polling cycle" % home_status['body']['errors'][0]['code'])
+            return
+    health.beat("homestatus")
+    
+    # Retrieve information about the rooms of interest, and only
+    # about the fields that are used
+    room_index = extract_rooms(home_status['body']['home'], room_by_id)
+    if not trimmed_homestatus_valid(room_index):
+        return
+
+    # Publish data to the MQTT broker
+    log.debug("Publishing information to the MQTT broker")
+    readings_changed = False
+    for room in rooms:
+        room_status = room_index.get(room['roomid'])
+        log.debug("Room %s status: %s", room['roomid'], room_status)
+        if room_status is None:
+            log.warning("Room %s not found in home %s" % (room['roomid'], settings['netatmo']['homeid']))
+            continue
+        if not room_status_cache.update_from_poll(room['roomid'], room_status, poll_started):
+            log.debug("Room %s has been updated by a webhook event in the meantime: skipping polled status" % room['roomid'])
+            continue
+        readings = tuple(room_status.get(k) for k in ('therm_measured_temperature', 'humidity', 'therm_setpoint_temperature', 'therm_setpoint_mode', 'therm_setpoint_end_time'))
+        if last_readings.get(room['roomid']) != readings:
+            readings_changed = True
+            last_readings[room['roomid']] = readings
+        process_room_status(publisher, room, room_status, poll_started)
+    # Poll faster while readings are changing, slow down otherwise
+    netatmo.poll_scheduler.notify_poll_result(readings_changed)
+    snapshot.save()
+    publish_handover()
+    log.debug("MQTT publications so far: %i sent, %i suppressed as unchanged", *publisher.stats())
+
+# Check that a trimmed /homestatus response carries the status of all the
+# rooms. Otherwise, modules that are needed have been filtered out (e.g.,
+# if the topology of the home is not accurate): trimming is disabled for
+# good, and the next poll is issued at the shortest interval
+def trimmed_homestatus_valid(room_index):
+    global homestatus_trimmed
+    if not netatmo.homestatus_device_types:
+        return True
+    homestatus_trimmed = all(room_index.get(room['roomid'], {}).get('therm_measured_temperature') is not None for room in rooms)
+    if not homestatus_trimmed:
+        log.warning("Status of the rooms missing from the response to a trimmed /homestatus request: requesting the status of all devices from now on")
+        netatmo.set_homestatus_device_types(None)
+        netatmo.poll_scheduler.notify_activity()
+    return homestatus_trimmed
+
+# Apply a webhook event to the last known status of the rooms it
+# refers to, and publish the changes right away. Events that do not
+# carry room status (e.g., the webhook activation event) are ignored
+def handle_webhook_event(publisher, event):
+    log.debug("Received webhook event: %s", codec.Lazy(event))
+    if election is not None and not election.is_leader():
+        log.debug("Standby instance: ignoring webhook event")
+        return
+    home = event.get('home') or {}
+    if (home.get('id') or event.get('home_id')) != settings['netatmo']['homeid']:
+        log.debug("Ignoring webhook event of type %s" % event.get('push_type'))
+        return
+    for room_event in home.get('rooms', []):
+        room = room_by_id.get(room_event.get('id'))
+        if room is None:
+            continue
+        observed_at = time.monotonic()
+        room_status = room_status_cache.update_from_event(room['roomid'], room_event)
+        if room_status is None:
+            log.debug("Status of room %s not polled yet: ignoring webhook event" % room['roomid'])
+            continue
+        process_room_status(publisher, room, room_status, observed_at)
+
+# Receive webhook events from the Netatmo cloud, so that changes are
+# published as soon as they happen and polling is only kept as a
+# (slow) safety net to resynchronize the status. With several instances,
+# the webhook URL is only registered by the leader
+def start_webhook(publisher):
+    webhook_settings = settings['webhook']
+    secret = settings['netatmo']['clientsecret'] if webhook_settings.get('verify_signature', True) else None
+    start_webhook_server(webhook_settings.get('ipaddress', '0.0.0.0'), webhook_settings.get('port', 9091), webhook_settings.get('path', '/webhook'), secret, lambda event: handle_webhook_event(publisher, event))
+    if election is None:
+        register_webhook()
+
+# Register the webhook URL (if any) with the Netatmo cloud and
+# poll at the safety interval from now on
+def register_webhook():
+    webhook_settings = settings['webhook']
+    if webhook_settings.get('url'):
+        log.info("Registering webhook URL %s" % webhook_settings['url'])
+        try:
+            response = codec.loads(netatmo.add_webhook(webhook_settings['url']))
+            if response.get('status') != 'ok':
+                raise Exception(response)
+        except Exception as e:
+            log.error("Failed to register webhook URL: %s. Polling at the usual interval" % repr(e))
+            return
+    safety_poll_interval = webhook_settings.get('safety_poll_interval', 600)
+    log.info("Webhook events enabled: polling every %i seconds as a safety net" % safety_poll_interval)
+    netatmo.poll_scheduler.set_intervals(safety_poll_interval, safety_poll_interval)
+
+def unregister_webhook():
+    if settings.get('webhook', {}).get('url'):
+        log.debug("Unregistering webhook URL")
+        try:
+            netatmo.drop_webhook()
+        except Exception as e:
+            log.warning("Failed to unregister webhook URL: %s" % repr(e))
+
+# Unregister the webhook URL before quitting, unless it has been
+# registered by another instance (i.e., this is a standby instance)
+def stop_webhook():
+    if election is None or election.is_leader():
+        unregister_webhook()
+
+# Run a polling cycle, handling any errors that may occur so that
+# polling can be resumed at the next cycle
+def run_poll_cycle(publisher, last_readings):
+    health.beat("poll_loop")
+    if election is not None and not election.is_leader():
+        log.debug("Standby instance: skipping polling cycle")
+        return
+    try:
+        with metrics.poll_cycle_duration.time():
+            poll_cycle(publisher, last_readings)
+    except requests.ConnectionError as e:
+        log.error("Error while connecting to server: %s. Restarting polling cycle" % repr(e))
+    except requests.HTTPError as e:
+        log.error("HTTP exception in polling cycle: %s" % repr(e))
+        log.debug("Obtaining a new token and restarting the loop")
+        obtain_netatmo_token(netatmo)
+    except KeyboardInterrupt:
+        raise
+    except Exception as e:
+        log.error("Unknown exception occurred: %s" % repr(e))
+
+# Health checks. They only look at values at hand, so that probes are
+# answered without any network I/O or waits
+def check_threads():
+    threads = {'commands': command_queue.thread, 'scheduler': netatmo.scheduler.thread, 'mqtt': mqtt_thread}
+    if election is not None:
+        threads['election'] = election.thread
+    dead = [name for name, thread in threads.items() if thread is not None and not thread.is_alive()]
+    return not dead, {'dead': dead}
+
+def check_poll_loop():
+    age = health.age("poll_loop")
+    max_age = 3 * netatmo.poll_scheduler.max_interval + 300
+    return age is None or age <= max_age, {'age': None if age is None else round(age, 1), 'max_age': max_age}
+
+def check_homestatus(max_age=None):
+    if election is not None and not election.is_leader():
+        return True, {'role': 'standby'}
+    age = health.age("homestatus")
+    # By default, a few polling cycles may fail in a row
+    max_age = max_age or 3 * netatmo.poll_scheduler.max_interval
+    return age is not None and age <= max_age, {'age': None if age is None else round(age, 1), 'max_age': max_age}
+
+def check_token():
+    # Standby instances do not refresh the token (see take_over)
+    if election is not None and not election.is_leader():
+        return netatmo.token is not None, {'standby': True}
+    expires_at = (netatmo.token or {}).get('expires_at')
+    if expires_at is None:
+        return netatmo.token is not None, {}
+    expires_in = expires_at - time.time()
+    return expires_in > 0, {'expires_in': int(expires_in)}
+
+def check_command_queue():
+    depth = command_queue.depth()
+    return depth < command_queue.max_size, {'depth': depth, 'max_size': command_queue.max_size}
+
+# Publish the outcome of a thermostat update on the result
+# topic of the room it was meant for
+def publish_command_result(mqttc, room_id, result):
+    topic = room_by_id[room_id]['publish_base_topic'] + '/' + settings['mqtt']['publish_topics'].get('command_result', 'command_result')
+    mqttc.publish(topic, payload = codec.dumps({**result, 'timestamp': int(time.time())}), qos = QOS['events'])
+
+
+# Answer a request for the history of a room. The request is a JSON
+# document such as {"room": "...", "from": ..., "to": ..., "tier": "5m"},
+# with times in seconds since the epoch (by default, the last 24 hours)
+# and tier among raw, 5m, 1h and auto (the default, which picks the finest
+# tier that covers the requested range). The whole range is published in
+# a single message on the response topic (which the request can override),
+# with samples packed in columns, along with the id of the request, if any
+def handle_history_request(client, userdata, message):
+    if election is not None and not election.is_leader():
+        return
+    history_settings = settings['history']
+    response_topic = history_settings.get('response_topic', 'smarther2mqtt/history/response')
+    request_id = None
+    try:
+        request = codec.loads(message.payload)
+        request_id = request.get('id')
+        response_topic = request.get('response_topic') or response_topic
+        room_id = request.get('room') or (rooms[0]['roomid'] if len(rooms) == 1 else None)
+        end = int(request.get('to') or time.time())
+        start = int(request.get('from') or end - 86400)
+        response = history.query(room_id, request.get('tier', 'auto'), start, end)
+    except (ValueError, TypeError, AttributeError) as e:
+        log.warning("Invalid history request %s: %s" % (message.payload, repr(e)))
+        response = {'error': str(e)}
+    except Exception as e:
+        log.error("Exception raised while processing history request %s: %s" % (message.payload, repr(e)))
+        response = {'error': repr(e)}
+    client.publish(response_topic, payload = codec.dumps({'id': request_id, **response}), qos = QOS['events'])
+
+# Handle a command received on the admin topic: 'start_profiler',
+# 'stop_profiler' or 'dump_threads'. Every instance handles them,
+# whether it is the leader or not
+def handle_admin_command(client, userdata, message):
+    command = message.payload.decode("utf-8", errors="replace").strip()
+    if command == "start_profiler":
+        if not profiler.start():
+            log.info("Profiler already running")
+    elif command == "stop_profiler":
+        if not profiler.stop():
+            log.info("Profiler not running")
+    elif command == "dump_threads":
+        profiler.dump_threads(time.time())
+    else:
+        log.warning("Ignoring unknown admin command: %s" % command)
+
+# SIGUSR1 starts the profiler and SIGUSR2 stops it or, if it is
+# not running, only saves the stacks of all the threads
+def handle_profiler_signal(signum, frame):
+    if signum == signal.SIGUSR1:
+        if not profiler.start():
+            log.info("Profiler already running")
+    elif not profiler.stop():
+        profiler.dump_threads(time.time())
+
+# Publish the pending thermostat updates and the last known status of
+# the rooms, so that another instance can take over from this one
+def publish_handover():
+    if election is not None:
+        election.publish_handover({'pending': netatmo.pending_updates(), 'rooms': snapshot.all_rooms()})
+
+# Take over from the previous leader: restore the last known status and
+# the pending thermostat updates it has handed over, then act upon any
+# commands that it may not have handled. The token is loaded again from
+# file, as it may have been refreshed by the previous leader (standby
+# instances never refresh it, so as not to invalidate the refresh token
+# in use by the leader). Calls to the Netatmo cloud that are only made
+# by the leader are run in the background, so that the lease is renewed
+# in the meantime
+def take_over(publisher, handover, commands):
+    netatmo.reload_token()
+    if handover is not None:
+        log.debug("Taking over from instance %s" % handover.get('instance'))
+        for room_id, room_status in (handover.get('rooms') or {}).items():
+            if room_id not in room_by_id:
+                continue
+            snapshot.update_room(room_id, room_status)
+            if room_status.get('therm_setpoint_temperature') is not None:
+                netatmo.update_temperature(room_id, room_status['therm_setpoint_temperature'])
+            if room_status.get('therm_setpoint_mode') is not None:
+                netatmo.update_mode(room_id, room_status['therm_setpoint_mode'])
+        netatmo.restore_pending_updates(handover.get('pending') or {})
+    for topic, payload in commands:
+        log.info("Handling command %s received on topic %s before taking over" % (payload, topic))
+        command_queue.put(topic, payload, publisher)
+    publish_handover()
+    # Poll right away
+    netatmo.poll_scheduler.notify_activity()
+    Thread(target=start_leading, name='leadership', daemon=True).start()
+
+# Refresh the topology of the home and register the webhook URL
+# (if enabled) upon becoming the leader
+def start_leading():
+    refresh_topology()
+    if 'webhook' in settings and election.is_leader():
+        register_webhook()
+
+# Stand by after losing leadership: pending thermostat updates are
+# dropped, as they are handed over to the new leader, and the webhook
+# URL is unregistered, as events are only handled by the leader
+def stand_by():
+    netatmo.discard_pending_updates()
+    if 'webhook' in settings:
+        netatmo.poll_scheduler.reset_intervals()
+        Thread(target=unregister_webhook, name='leadership', daemon=True).start()
+
+# The thread that handles the MQTT connection is recorded, so that
+# the health checks can tell whether it is still alive
+def on_mqtt_connect(publisher):
+    global mqtt_thread
+    mqtt_thread = current_thread()
+    publisher.invalidate()
+    if election is not None:
+        election.on_connect()
+
+# Release resources before quitting, after pending thermostat
+# updates have been sent. Commands that are still queued are executed
+# first, then the scheduler is stopped and the updates they have
+# scheduled are sent right away. This is invoked by both engines
+def shutdown():
+    command_queue.stop()
+    netatmo.scheduler.stop()
+    netatmo.flush_thermostat_updates()
+    publish_handover()
+    stop_webhook()
+    snapshot.save()
+    if history is not None:
+        history.flush()
+    if election is not None:
+        election.stop()
 
 def main():
+    global election
     log.debug("Netatmo token exists: %s", netatmo.token_exists())
     if not netatmo.token_exists():
         obtain_netatmo_token(netatmo)
 
-    mqttc = mqtt_init()
+    if 'high_availability' in settings:
+        ha_settings = settings['high_availability']
+        instance_id = ha_settings.get('instance_id') or socket.gethostname()
+        log.info("High availability enabled: instance %s starting as standby" % instance_id)
+        election = LeaderElection(
+            instance_id,
+            ha_settings.get('lease_topic', 'smarther2mqtt/leader'),
+            ha_settings.get('handover_topic', 'smarther2mqtt/handover'),
+            ha_settings.get('lease_duration', 15),
+            lambda handover, commands: take_over(publisher, handover, commands),
+            stand_by
+        )
+        # Standby instances do not refresh the token in advance
+        netatmo.refresh_in_advance = election.is_leader
+        mqttc = mqtt_init(instance_id, election.will())
+    else:
+        mqttc = mqtt_init()
+    publisher = StatePublisher(mqttc, settings['mqtt'].get('republish_interval'), QOS['state'])
+
+    # Publish the last known status right away, then refresh the
+    # topology of the home in the background. With several instances,
+    # the status published by the leader is more recent than any snapshot
+    snapshot.load()
+    if election is None:
+        publish_snapshot(publisher)
+    if snapshot.topology:
+        check_topology(snapshot.topology)
+    # With several instances, the topology is refreshed by the leader
+    if election is None:
+        Thread(target=refresh_topology, name='topology', daemon=True).start()
+    # Retained messages may have been lost if the broker has been restarted
+    # in the meantime: make sure that all values are published again upon
+    # (re)connection
+    mqttc.on_connect = lambda client, userdata, flags, rc: on_mqtt_connect(publisher)
+
+    # The publisher is handed to the callback function that handles
+    # received commands, in order to publish optimistic states
+    mqttc.user_data_set(publisher)
+
+    for topic_filter in router.subscriptions(settings['mqtt'].get('subscribe_filters')):
+        log.debug("Subscribing to %s" % topic_filter)
+        # Subscribe to selected MQTT topics for which messages are expected from the broker
+        mqttc.subscribe(topic_filter, QOS['commands'])
+        # Set up a callback function to handle received messages
+        mqttc.message_callback_add(topic_filter, handle_received_command)
+
+    if history is not None:
+        request_topic = settings['history'].get('request_topic', 'smarther2mqtt/history/request')
+        log.debug("Subscribing to %s" % request_topic)
+        mqttc.subscribe(request_topic, QOS['commands'])
+        mqttc.message_callback_add(request_topic, handle_history_request)
+
+    if profiler is not None:
+        signal.signal(signal.SIGUSR1, handle_profiler_signal)
+        signal.signal(signal.SIGUSR2, handle_profiler_signal)
+        admin_topic = settings['profiler'].get('admin_topic') if settings.get('profiler') else None
+        if admin_topic:
+            log.debug("Subscribing to %s" % admin_topic)
+            mqttc.subscribe(admin_topic, QOS['commands'])
+            mqttc.message_callback_add(admin_topic, handle_admin_command)
+
+    netatmo.setstate_listeners.append(lambda room_id, result: publish_command_result(mqttc, room_id, result))
+    netatmo.setstate_listeners.append(lambda room_id, result: optimistic.mark_sent(room_id, result['status'] == 'ok'))
+    if OPTIMISTIC_MODE in ('target', 'state'):
+        netatmo.confirmation_listeners.append(lambda room_id, room_status, confirmed: reconcile_optimistic_state(publisher, room_by_id[room_id], room_status, confirmed))
+    netatmo.setstate_listeners.append(lambda room_id, result: publish_handover())
 
-    base_topic = settings['mqtt']['subscribe_topics']['base_topic']
-    # Subscribe to selected MQTT topics for which messages are expected from the broker
-    mqttc.subscribe(base_topic + '/+', 0)
-    # Set up a callback function to handle received messages
-    mqttc.message_callback_add(base_topic + '/+', handle_received_command)
+    command_queue.start()
+    if election is not None:
+        election.start(mqttc)
+
+    # Last readings for each room, used to detect changes
+    last_readings = {}
+
+    if 'metrics' in settings:
+        # Values that are already tracked elsewhere are only
+        # collected when metrics are exposed
+        metrics.registry.function("smarther2mqtt_mqtt_publishes_sent_total", "MQTT messages published", lambda: publisher.stats()[0], "counter")
+        metrics.registry.function("smarther2mqtt_mqtt_publishes_suppressed_total", "MQTT messages not published as unchanged", lambda: publisher.stats()[1], "counter")
+        metrics.registry.function("smarther2mqtt_rate_limit_hits_total", "Rate limit errors (HTTP 429, code 11) returned by the Netatmo API", lambda: netatmo.rate_budget.rate_limit_hits, "counter")
+        metrics.registry.function("smarther2mqtt_api_retries_denied_total", "Retries of failed API calls not sent as the retry budget was exhausted", lambda: netatmo.rate_budget.retries_denied, "counter")
+        metrics.registry.function("smarther2mqtt_debounce_scheduled_total", "Calls scheduled on the debounce scheduler", lambda: netatmo.scheduler.scheduled_count, "counter")
+        metrics.registry.function("smarther2mqtt_debounce_executed_total", "Calls executed by the debounce scheduler", lambda: netatmo.scheduler.executed_count, "counter")
+        metrics.registry.function("smarther2mqtt_debounce_coalescing_ratio", "Ratio of scheduled to executed debounced calls", lambda: netatmo.scheduler.scheduled_count / max(netatmo.scheduler.executed_count, 1))
+        metrics.registry.function("smarther2mqtt_command_queue_depth", "Commands waiting to be executed", command_queue.depth)
+        metrics.registry.function("smarther2mqtt_commands_dropped_total", "Commands discarded because the command queue was full", lambda: command_queue.dropped_count, "counter")
+        metrics.registry.function("smarther2mqtt_time_to_first_stale_publish_seconds", "Time from startup to the publication of the status saved in the snapshot", lambda: first_publish["snapshot"])
+        metrics.registry.function("smarther2mqtt_time_to_first_publish_seconds", "Time from startup to the publication of fresh status", lambda: first_publish["fresh"])
+        metrics.start_metrics_server(settings['metrics'].get('ipaddress', '0.0.0.0'), settings['metrics'].get('port', 9100))
+
+    if 'webhook' in settings:
+        start_webhook(publisher)
+
+    # The health endpoint is enabled unless health is set to False
+    health_settings = settings.get('health', {})
+    if health_settings is not False:
+        health_settings = health_settings or {}
+        health.add_check("threads", check_threads, LIVENESS)
+        health.add_check("poll_loop", check_poll_loop, LIVENESS)
+        health.add_check("homestatus", lambda: check_homestatus(health_settings.get('max_status_age')))
+        health.add_check("mqtt", lambda: (mqttc.is_connected(), {}))
+        health.add_check("token", check_token)
+        health.add_check("command_queue", check_command_queue)
+        # The Docker image passes the port probed by its HEALTHCHECK
+        start_health_server(health_settings.get('ipaddress', '127.0.0.1'), health_settings.get('port', int(os.environ.get('HEALTH_PORT', 9092))), health)
+
+    if settings.get('engine', 'threads') == 'asyncio':
+        log.info("Starting polling cycle (asyncio engine)")
+        AsyncioEngine(netatmo, mqttc, lambda: run_poll_cycle(publisher, last_readings), shutdown).run()
+        return
 
     mqttc.loop_start()
 
     log.info("Starting polling cycle")
     first_iteration = True
-    while True:
-        signal.signal(signal.SIGTERM, signal_to_interrupt)
-        try:
-            # Start polling cycle
-            log.debug("(Re)starting polling cycle")
-            while True:
-                if not first_iteration:
-                    log.debug("Waiting %i seconds" % settings['netatmo']['polling_interval'])
-                    time.sleep(settings['netatmo']['polling_interval'])
-                first_iteration = False
-
-                # Get information about the whole home
-                home_status_string = netatmo.query_homestatus(settings['netatmo']['homeid'])
-                log.debug("Received home status: %s" % home_status_string)
-                home_status = json.loads(home_status_string)
-                log.debug("JSON-decoded home status: %s" % json.dumps(home_status))
-
-                # Check whether global API rate limits (which may occasionally occur)
-                # have been hit. This is signaled by the following response body in an
-                # HTTP 429 error response:
-                # {
-                #   "error": {
-                #     "code": 11,
-                #     "message": "Failed to enter concurrency limited section"
-                #   }
-                # }
-                if 'error' in home_status:
-                    log.warning("API returned system-wide error: %i. Will try again at next polling cycle" % home_status['erorr']['message'])
-                    continue
-                else:
-                    # The response is assumed to have a 'body' key at this point
-
-                    # Check whether any application-level errors have been
-                    # reported (see https://dev.netatmo.com/apidocumentation/general#status-ok)
-                    if 'errors' in home_status['body']:
-                        log.warning("API returned application-evel error code %i. Will try again at next polling cycle" % home_status['body']['errors'][0]['code'])
-                        continue
-                
-                # Retrieve information about the room of interest
-                room_status = get_room_in_home(home_status['body']['home'], settings['netatmo']['roomid'])
-                log.debug("Room status: %s" % room_status)
-                
-                # Publish data to the MQTT broker
-                log.debug("Publishing information to the MQTT broker")
-                base_topic = settings['mqtt']['publish_topics']['base_topic']
-                mqttc.publish(base_topic + '/' + settings['mqtt']['publish_topics']['temperature'], payload = room_status['therm_measured_temperature'], retain = True)
-                mqttc.publish(base_topic + '/' + settings['mqtt']['publish_topics']['humidity'], payload = room_status['humidity'], retain = True)
-                mqttc.publish(base_topic + '/' + settings['mqtt']['publish_topics']['setpoint_endtime'], payload = (room_status['therm_setpoint_end_time'] or "0"), retain = True)
-                if not netatmo.temperature_update_pending():
-                    mqttc.publish(base_topic + '/' + settings['mqtt']['publish_topics']['temperature_setpoint'], payload = room_status['therm_setpoint_temperature'], retain = True)
-                    netatmo.update_temperature(room_status['therm_setpoint_temperature'])
-                if not netatmo.mode_update_pending():
-                    mqttc.publish(base_topic + '/' + settings['mqtt']['publish_topics']['mode'], payload = mode_NA_to_user[room_status['therm_setpoint_mode']], retain = True)
-                    netatmo.update_mode(room_status['therm_setpoint_mode'])
-
-        except requests.ConnectionError as e:
-            log.error("Error while connecting to server: %s. Restarting polling cycle" % repr(e))
-        except requests.HTTPError as e:
-            log.error("HTTP exception in polling cycle: %s" % repr(e))
-            log.debug("Obtaining a new token and restarting the loop")
-            obtain_netatmo_token(netatmo)
-        except KeyboardInterrupt:
-            mqttc.loop_stop()
-            return
-        except Exception as e:
-            log.error("Unknown exception occurred: %s" % repr(e))
+    try:
+        while True:
+            # The handler is installed again at every cycle, as obtaining a new
+            # token restores the default one
+            signal.signal(signal.SIGTERM, signal_to_interrupt)
+            if not first_iteration:
+                netatmo.poll_scheduler.wait_next_poll()
+            first_iteration = False
+            run_poll_cycle(publisher, last_readings)
+    except KeyboardInterrupt:
+        shutdown()
+        mqttc.loop_stop()
+        return
 
 
 
+rooms = configured_rooms()
+room_by_id = {r['roomid']: r for r in rooms}
 netatmo = NetatmoToken()
+router = build_router()
+# Received commands are executed by a dedicated worker thread
+command_settings = settings['mqtt'].get('command_queue') or {}
+command_queue = CommandQueue(execute_command, report_dropped_command, command_settings.get('max_size', 100), command_settings.get('drop_policy', 'oldest'))
+# Commanded states are optionally published before they are confirmed
+# by the Netatmo cloud. Allowed values: off, target, state
+OPTIMISTIC_MODE = settings['mqtt'].get('optimistic', 'off')
+# The status of each room is published on separate topics for each field
+# and/or as a single JSON document. Allowed values: fields, json, both
+PUBLISH_MODE = settings['mqtt'].get('publish_mode', 'fields')
+# Fields of the JSON document last published for each room
+room_states = {}
+# QoS of MQTT messages, by group: status (retained) messages, subscriptions
+# to commands and events (command results, mismatches, history responses)
+QOS = dict({'state': 0, 'commands': 1, 'events': 1}, **settings['mqtt'].get('qos', {}))
+optimistic = OptimisticState()
+# Last known status of each room, shared by polling and webhook events
+room_status_cache = RoomStatusCache()
+# Last known status of each room and topology of the home, persisted
+# across restarts (by default, next to the token file)
+snapshot = StateSnapshot(settings['netatmo'].get('state_file') or os.path.join(os.path.dirname(settings['netatmo']['token_file']), 'smarther2mqtt_state.json'))
+# History of the status of each room, if enabled, kept in a memory-mapped
+# file (by default, next to the token file)
+history = None
+if 'history' in settings:
+    history = HistoryBuffer(settings['history'].get('file') or os.path.join(os.path.dirname(settings['netatmo']['token_file']), 'smarther2mqtt_history.bin'),
+                            room_by_id.keys(),
+                            {tier: settings['history'][tier + '_samples'] for tier in ('raw', '5m', '1h') if tier + '_samples' in settings['history']})
+# Heartbeats and checks reported by the health endpoint
+health = HealthMonitor()
+# On-demand profiler, enabled unless profiler is set to False. Profiles
+# and thread stacks are saved (by default) next to the token file
+profiler = None
+if settings.get('profiler', {}) is not False:
+    profiler_settings = settings.get('profiler') or {}
+    profiler = SamplingProfiler(profiler_settings.get('directory') or os.path.dirname(os.path.abspath(settings['netatmo']['token_file'])),
+                                profiler_settings.get('interval', 0.01),
+                                profiler_settings.get('max_duration', 300))
+# Whether trimmed /homestatus requests return the status of all the rooms
+# (None until known)
+homestatus_trimmed = None
+# Time elapsed from startup to the first publication, by source
+first_publish = {}
+# Leader election among several instances, if high availability is enabled
+election = None
+# Thread handling the MQTT connection (known once connected)
+mqtt_thread = None
 main()
@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+# End-to-end benchmark of smarther2mqtt. The bridge is run as a separate
+# process against the local Netatmo API stand-in (fake_netatmo.py) and an
+# MQTT broker (either an existing one or a mosquitto instance started for
+# the purpose). Commands are published on the MQTT topics of the emulated
+# rooms, and the following figures are reported:
+# - command-to-setstate latency (from the MQTT publication of a command to
+#   the reception of the corresponding /setstate request)
+# - poll throughput and API calls per hour
+# - CPU time and resident memory of the bridge, overall and per room
+#
+# Example:
+#   tools/benchmark.py --rooms 10 --duration 60 --start-broker
+
+import argparse, json, os, shutil, socket, subprocess, sys, tempfile, threading, time
+import yaml
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_netatmo
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Start the fake Netatmo API in a background thread of this process
+def start_fake_api(options):
+    fake_options = fake_netatmo.parse_arguments([
+        "--port", str(free_port()),
+        "--rooms", str(options.rooms),
+        "--latency", str(options.latency),
+        "--concurrency-error-rate", str(options.concurrency_error_rate),
+        "--token-lifetime", str(options.token_lifetime)
+    ])
+    server, home = fake_netatmo.make_server(fake_options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, home, "http://127.0.0.1:%i" % fake_options.port
+
+def start_broker(port):
+    if shutil.which("mosquitto") is None:
+        sys.exit("mosquitto not found: use --broker to point to an existing MQTT broker")
+    return subprocess.Popen(["mosquitto", "-p", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+# Write a configuration file (and a valid token file) for the bridge in
+# the given working directory. Extra settings are merged into the netatmo
+# and mqtt sections
+def write_bridge_settings(workdir, api_url, home, broker_address, broker_port, options, extra_settings=None):
+    rooms = sorted(home.rooms)
+    bridge_settings = {
+        'debug': options.debug,
+        'oauth_code_endpoint': {'ipaddress': '127.0.0.1', 'port': free_port()},
+        'netatmo': {
+            'api_url': api_url,
+            'token_file': os.path.join(workdir, 'netatmo_token'),
+            'clientid': 'benchmark',
+            'clientsecret': 'benchmark',
+            'homeid': home.home_id,
+            'rooms': [{
+                'roomid': room_id,
+                'publish_base_topic': 'benchmark/%s/sensors' % room_id,
+                'subscribe_base_topic': 'benchmark/%s/commands' % room_id
+            } for room_id in rooms],
+            'polling_interval': options.polling_interval,
+            'min_request_idle_time': options.idle_time,
+            'default_duration': None,
+            'budget_fraction': 1
+        },
+        'mqtt': {
+            'broker': {'ipaddress': broker_address, 'port': broker_port},
+            'publish_topics': {
+                'base_topic': 'benchmark/sensors',
+                'temperature': 'temperature',
+                'humidity': 'humidity',
+                'temperature_setpoint': 'temperature_setpoint',
+                'mode': 'mode',
+                'setpoint_endtime': 'setpoint_endtime'
+            },
+            'subscribe_topics': {
+                'base_topic': 'benchmark/commands',
+                'temperature_setpoint': 'temperature_setpoint',
+                'mode': 'mode'
+            }
+        }
+    }
+    if options.engine:
+        bridge_settings['engine'] = options.engine
+    if options.json_backend:
+        bridge_settings['json_backend'] = options.json_backend
+    for section, values in (extra_settings or {}).items():
+        if isinstance(values, dict) and isinstance(bridge_settings.get(section), dict):
+            bridge_settings[section].update(values)
+        else:
+            bridge_settings[section] = values
+    with open(os.path.join(workdir, 'smarther2mqtt_settings.yml'), 'w') as f:
+        yaml.safe_dump(bridge_settings, f)
+    with open(os.path.join(workdir, 'netatmo_token'), 'w') as f:
+        json.dump(home.new_access_token(), f)
+    return rooms
+
+def start_bridge(workdir, log_file):
+    return subprocess.Popen([sys.executable, os.path.join(REPOSITORY_DIR, 'smarther2mqtt.py')], cwd=workdir, stdout=log_file, stderr=subprocess.STDOUT)
+
+# Return the CPU time (in seconds) and the resident set size (in bytes)
+# of a process, as reported by /proc
+def process_usage(pid):
+    with open("/proc/%i/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    with open("/proc/%i/status" % pid) as f:
+        rss = next(int(l.split()[1]) * 1024 for l in f if l.startswith("VmRSS:"))
+    return cpu, rss
+
+# Publish a command with a unique temperature setpoint to each room in
+# turn, and measure the time until the corresponding /setstate request
+# is received by the fake API
+def measure_command_latency(mqttc, home, rooms, count, timeout):
+    latencies = []
+    for i in range(count):
+        room_id = rooms[i % len(rooms)]
+        temperature = round(15 + (i % 100) * 0.1 + 0.05, 2)
+        already_received = len(home.setstate_log)
+        sent = time.time()
+        mqttc.publish('benchmark/%s/commands/temperature_setpoint' % room_id, str(temperature), qos=1).wait_for_publish()
+        deadline = sent + timeout
+        received = None
+        while received is None and time.time() < deadline:
+            for t, request in list(home.setstate_log[already_received:]):
+                if any(r.get('id') == room_id and r.get('therm_setpoint_temperature') == temperature for r in request['home']['rooms']):
+                    received = t
+                    break
+            time.sleep(0.005)
+        if received is None:
+            print("Command %i (room %s) not received within %.0f seconds" % (i, room_id, timeout))
+        else:
+            latencies.append(received - sent)
+    return latencies
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of smarther2mqtt")
+    parser.add_argument("--rooms", type=int, default=1, help="number of rooms")
+    parser.add_argument("--duration", type=float, default=30, help="duration of the polling measurement, in seconds")
+    parser.add_argument("--commands", type=int, default=10, help="number of commands used to measure latency")
+    parser.add_argument("--polling-interval", type=float, default=1, help="polling interval of the bridge, in seconds")
+    parser.add_argument("--idle-time", type=float, default=0.5, help="min_request_idle_time of the bridge, in seconds")
+    parser.add_argument("--latency", type=float, default=0, help="latency of the fake API, in seconds")
+    parser.add_argument("--concurrency-error-rate", type=float, default=0, help="probability of HTTP 429 responses from the fake API")
+    parser.add_argument("--token-lifetime", type=int, default=10800, help="lifetime of access tokens issued by the fake API, in seconds")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], help="execution engine of the bridge")
+    parser.add_argument("--json-backend", choices=["auto", "orjson", "ujson", "stdlib"], help="JSON library used by the bridge")
+    parser.add_argument("--broker", default="127.0.0.1:1883", help="address:port of an existing MQTT broker")
+    parser.add_argument("--start-broker", action="store_true", help="start a mosquitto instance on a free port")
+    parser.add_argument("--debug", action="store_true", help="enable debug logging in the bridge")
+    parser.add_argument("--json", action="store_true", help="print results in JSON format")
+    options = parser.parse_args()
+
+    server, home, api_url = start_fake_api(options)
+    broker = None
+    if options.start_broker:
+        broker_address, broker_port = "127.0.0.1", free_port()
+        broker = start_broker(broker_port)
+        time.sleep(0.5)
+    else:
+        broker_address, broker_port = options.broker.rsplit(":", 1)
+        broker_port = int(broker_port)
+
+    workdir = tempfile.mkdtemp(prefix="smarther2mqtt-benchmark-")
+    rooms = write_bridge_settings(workdir, api_url, home, broker_address, broker_port, options)
+    log_file = open(os.path.join(workdir, "bridge.log"), "w")
+    bridge = start_bridge(workdir, log_file)
+    results = {}
+    try:
+        mqttc = mqtt.Client()
+        mqttc.connect(broker_address, broker_port)
+        mqttc.loop_start()
+
+        # Let the bridge start up and perform its first polling cycle
+        time.sleep(2)
+        if bridge.poll() is not None:
+            sys.exit("The bridge has terminated unexpectedly. See %s" % log_file.name)
+
+        # Polling throughput, CPU and memory while idle
+        cpu_start, _ = process_usage(bridge.pid)
+        requests_start = dict(home.requests_by_endpoint)
+        time.sleep(options.duration)
+        cpu_end, rss = process_usage(bridge.pid)
+        polls = home.requests_by_endpoint.get("homestatus", 0) - requests_start.get("homestatus", 0)
+        api_calls = sum(home.requests_by_endpoint.values()) - sum(requests_start.values())
+        results['polls_per_second'] = polls / options.duration
+        results['api_calls_per_hour'] = api_calls * 3600 / options.duration
+        results['cpu_seconds_per_poll'] = (cpu_end - cpu_start) / max(polls, 1)
+        results['cpu_percent'] = 100 * (cpu_end - cpu_start) / options.duration
+        results['cpu_percent_per_room'] = results['cpu_percent'] / options.rooms
+        results['rss_bytes'] = rss
+        results['rss_bytes_per_room'] = rss / options.rooms
+
+        # Command-to-setstate latency
+        latencies = measure_command_latency(mqttc, home, rooms, options.commands, options.idle_time + 30)
+        results['commands_received'] = len(latencies)
+        results['command_latency_p50'] = percentile(latencies, 50)
+        results['command_latency_p95'] = percentile(latencies, 95)
+        results['command_latency_max'] = max(latencies) if latencies else float('nan')
+        results['rate_limited_requests'] = home.rate_limited_count
+        mqttc.loop_stop()
+    finally:
+        bridge.terminate()
+        bridge.wait()
+        log_file.close()
+        if broker:
+            broker.terminate()
+        server.shutdown()
+
+    if options.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("Rooms:                        %i" % options.rooms)
+        print("Polls per second:             %.2f" % results['polls_per_second'])
+        print("API calls per hour:           %.0f" % results['api_calls_per_hour'])
+        print("CPU time per poll:            %.2f ms" % (results['cpu_seconds_per_poll'] * 1000))
+        print("CPU usage:                    %.2f%% (%.3f%% per room)" % (results['cpu_percent'], results['cpu_percent_per_room']))
+        print("RSS:                          %.1f MiB (%.1f KiB per room)" % (results['rss_bytes'] / 2**20, results['rss_bytes_per_room'] / 2**10))
+        print("Commands received:            %i/%i" % (results['commands_received'], options.commands))
+        print("Command-to-setstate latency:  p50 %.3f s, p95 %.3f s, max %.3f s" % (results['command_latency_p50'], results['command_latency_p95'], results['command_latency_max']))
+        print("Rate-limited requests:        %i" % results['rate_limited_requests'])
+        print("Bridge log:                   %s" % os.path.join(workdir, "bridge.log"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+#!/usr/bin/python3
+
+# A local stand-in for the Netatmo Connect API, serving the subset of
+# endpoints used by smarther2mqtt (/oauth2/token, /api/homesdata,
+# /api/homestatus and /api/setstate). It emulates a home with a configurable
+# number of rooms, network latency, access token expiry (HTTP 403, code 3),
+# sporadic concurrency errors and per-user rate limits (HTTP 429, code 11),
+# and optionally sporadic server errors (HTTP 503) and dropped connections.
+# A webhook URL can be registered through /api/addwebhook: status changes
+# (caused by /setstate requests or emulated at random with
+# --external-change-interval) are then posted to it as signed events.
+# Other Home+Control modules (plugs, lights, etc.) located in a separate
+# room can be added with --other-modules: /homestatus only returns their
+# status if it is not restricted to other device types (device_types).
+# Statistics about the requests received are available at /stats.
+#
+# smarther2mqtt can be pointed to this server by setting the api_url
+# setting in the netatmo section of its configuration file, e.g.:
+#   api_url: 'http://127.0.0.1:8080'
+
+import argparse, hashlib, hmac, json, queue, random, threading, time, urllib.request
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Per-user rate limits, as documented in
+# https://dev.netatmo.com/guideline#rate-limits
+RATE_LIMITS = ((50, 10), (500, 3600))
+
+# Types of the other modules of the emulated home (plugs, lights, switches,
+# shutters) and the room they are located in
+OTHER_MODULE_TYPES = ('NLP', 'NLF', 'NLT', 'NLV')
+OTHER_ROOM_ID = '2000'
+
+# Status of the emulated home and bookkeeping of received requests
+class FakeHome:
+    def new_access_token(self):
+        self.token_generation += 1
+        self.access_token = "access-%i" % self.token_generation
+        self.refresh_token = "refresh-%i" % self.token_generation
+        self.token_expiry = time.time() + self.token_lifetime
+        return {
+            'access_token': self.access_token,
+            'refresh_token': self.refresh_token,
+            'expires_in': self.token_lifetime,
+            'scope': ['read_smarther', 'write_smarther']
+        }
+
+    # Record a request and check whether it exceeds the rate limits.
+    # Return True if the request is allowed
+    def account_request(self, endpoint):
+        now = time.time()
+        with self.lock:
+            self.requests_by_endpoint[endpoint] = self.requests_by_endpoint.get(endpoint, 0) + 1
+            if not self.rate_limits_enabled:
+                return True
+            self.request_times.append(now)
+            while self.request_times and self.request_times[0] < now - RATE_LIMITS[-1][1]:
+                self.request_times.popleft()
+            for limit, period in RATE_LIMITS:
+                if sum(1 for t in self.request_times if t >= now - period) > limit:
+                    self.rate_limited_count += 1
+                    return False
+        return True
+
+    # Let measured temperatures slowly move towards the setpoints
+    def drift(self):
+        if not self.drift_enabled:
+            return
+        for r in self.rooms.values():
+            delta = r['therm_setpoint_temperature'] - r['therm_measured_temperature']
+            r['therm_measured_temperature'] = round(r['therm_measured_temperature'] + max(min(delta, 0.1), -0.1), 1)
+
+    # Return the status of the home, restricted to the modules of the
+    # given types, if any. The status of the rooms is only returned if
+    # thermostats are included
+    def homestatus(self, device_types=None):
+        with self.lock:
+            self.drift()
+            modules = [{'id': 'module-%s' % room_id, 'type': 'BNS', 'boiler_status': False} for room_id in self.rooms]
+            modules += [dict(m) for m in self.other_modules]
+            rooms = [dict(r) for r in self.rooms.values()] if not device_types or 'BNS' in device_types else []
+            if self.other_modules:
+                rooms.append({'id': OTHER_ROOM_ID})
+            return {
+                'status': 'ok',
+                'time_server': int(time.time()),
+                'body': {
+                    'home': {
+                        'id': self.home_id,
+                        'rooms': rooms,
+                        'modules': [m for m in modules if not device_types or m['type'] in device_types]
+                    }
+                }
+            }
+
+    def homesdata(self):
+        rooms = [{'id': room_id, 'name': 'Room %s' % room_id, 'type': 'livingroom', 'module_ids': ['module-%s' % room_id]} for room_id in self.rooms]
+        modules = [{'id': 'module-%s' % room_id, 'type': 'BNS', 'name': 'Smarther %s' % room_id, 'room_id': room_id} for room_id in self.rooms]
+        if self.other_modules:
+            rooms.append({'id': OTHER_ROOM_ID, 'name': 'Other room', 'type': 'kitchen', 'module_ids': [m['id'] for m in self.other_modules]})
+            modules += [{'id': m['id'], 'type': m['type'], 'name': 'Module %s' % m['id'], 'room_id': OTHER_ROOM_ID} for m in self.other_modules]
+        return {
+            'status': 'ok',
+            'time_server': int(time.time()),
+            'body': {
+                'homes': [{
+                    'id': self.home_id,
+                    'name': 'Fake home',
+                    'rooms': rooms,
+                    'modules': modules
+                }]
+            }
+        }
+
+    # Queue a webhook event about the current setpoint of some rooms,
+    # if a webhook URL has been registered
+    def push_event(self, event_type, room_ids):
+        if self.webhook_url is None or not room_ids:
+            return
+        with self.lock:
+            rooms = [{k: self.rooms[r][k] for k in ('id', 'therm_setpoint_temperature', 'therm_setpoint_mode', 'therm_setpoint_end_time')} for r in room_ids]
+        self.events.put({
+            'user_id': 'fakeuser',
+            'home_id': self.home_id,
+            'event_type': event_type,
+            'push_type': 'NATherm1-%s' % event_type,
+            'home': {'id': self.home_id, 'rooms': rooms}
+        })
+
+    # Post queued webhook events, in order, signed with the client
+    # secret as the Netatmo cloud does
+    def send_events(self):
+        while True:
+            event = self.events.get()
+            url = self.webhook_url
+            if url is None:
+                continue
+            body = json.dumps(event).encode("utf-8")
+            signature = hmac.new(self.client_secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+            request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json', 'X-Netatmo-Secret': signature})
+            try:
+                urllib.request.urlopen(request, timeout=5).close()
+                self.webhook_events_sent += 1
+            except Exception as e:
+                self.webhook_events_failed += 1
+                print("Failed to post webhook event to %s: %s" % (url, repr(e)), flush=True)
+
+    # Emulate a change of setpoint requested through some other
+    # interface (e.g., the mobile app) in a random room
+    def external_change(self):
+        with self.lock:
+            room_id = random.choice(list(self.rooms))
+            self.rooms[room_id]['therm_setpoint_temperature'] = round(random.uniform(16, 23) * 2) / 2
+            self.rooms[room_id]['therm_setpoint_mode'] = 'manual'
+            self.external_changes += 1
+        self.push_event('set_point', [room_id])
+
+    def register_webhook(self, url):
+        self.webhook_url = url
+        self.events.put({'push_type': 'webhook_activation'})
+
+    # Apply a /setstate request. Return a list of per-room errors
+    def setstate(self, request):
+        errors = []
+        changed = []
+        with self.lock:
+            self.setstate_log.append((time.time(), request))
+            for r in request.get('home', {}).get('rooms', []):
+                if r.get('id') not in self.rooms:
+                    errors.append({'code': 9, 'id': r.get('id')})
+                    continue
+                room = self.rooms[r['id']]
+                for k in ('therm_setpoint_mode', 'therm_setpoint_temperature', 'therm_setpoint_end_time'):
+                    if k in r:
+                        room[k] = r[k]
+                changed.append(r['id'])
+        self.push_event('set_point', changed)
+        return errors
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests_by_endpoint': dict(self.requests_by_endpoint),
+                'rate_limited': self.rate_limited_count,
+                'webhook_url': self.webhook_url,
+                'webhook_events_sent': self.webhook_events_sent,
+                'webhook_events_failed': self.webhook_events_failed,
+                'external_changes': self.external_changes,
+                'setstate': [{'time': t, 'request': r} for t, r in self.setstate_log]
+            }
+
+    def __init__(self, home_id, room_count, token_lifetime, drift, client_secret, other_module_count=0):
+        self.home_id = home_id
+        self.other_modules = [{
+            'id': 'other-%i' % i,
+            'type': OTHER_MODULE_TYPES[i % len(OTHER_MODULE_TYPES)],
+            'on': False,
+            'brightness': 100,
+            'power': 0,
+            'reachable': True,
+            'firmware_revision': 77,
+            'last_seen': int(time.time())
+        } for i in range(other_module_count)]
+        self.rooms = {}
+        for i in range(room_count):
+            room_id = str(1000 + i)
+            self.rooms[room_id] = {
+                'id': room_id,
+                'reachable': True,
+                'therm_measured_temperature': 19.5,
+                'humidity': 50,
+                'therm_setpoint_temperature': 20.0,
+                'therm_setpoint_mode': 'home',
+                'therm_setpoint_start_time': int(time.time()),
+                'therm_setpoint_end_time': None
+            }
+        self.token_lifetime = token_lifetime
+        self.token_generation = 0
+        self.drift_enabled = drift
+        self.lock = threading.Lock()
+        self.requests_by_endpoint = {}
+        self.request_times = deque()
+        self.rate_limited_count = 0
+        self.rate_limits_enabled = True
+        self.setstate_log = []
+        self.client_secret = client_secret
+        self.webhook_url = None
+        self.webhook_events_sent = 0
+        self.webhook_events_failed = 0
+        self.external_changes = 0
+        self.events = queue.Queue()
+        threading.Thread(target=self.send_events, daemon=True).start()
+        self.new_access_token()
+
+def FakeNetatmoRequestHandler(home, options):
+    class HTTPRequestHandler(BaseHTTPRequestHandler):
+        # Keep connections alive, as the real API does
+        protocol_version = "HTTP/1.1"
+
+        def reply(self, code, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def reply_error(self, http_code, code, message):
+            self.reply(http_code, {'error': {'code': code, 'message': message}})
+
+        def read_body(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return self.rfile.read(length) if length else b''
+
+        # Perform checks common to all API calls. Return True if
+        # the request can be served
+        def check_api_call(self, endpoint):
+            if options.latency:
+                time.sleep(max(random.gauss(options.latency, options.latency_jitter), 0))
+            if not home.account_request(endpoint):
+                self.reply_error(429, 11, "Failed to enter concurrency limited section")
+                return False
+            if random.random() < options.concurrency_error_rate:
+                self.reply_error(429, 11, "Failed to enter concurrency limited section")
+                return False
+            if random.random() < options.server_error_rate:
+                self.reply_error(503, 503, "Service temporarily unavailable")
+                return False
+            if random.random() < options.disconnect_rate:
+                # Drop the connection without replying
+                self.close_connection = True
+                return False
+            if self.headers.get('Authorization') != "Bearer " + home.access_token or time.time() > home.token_expiry:
+                self.reply_error(403, 3, "Access token expired")
+                return False
+            return True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/stats":
+                self.reply(200, home.stats())
+            elif url.path == "/api/homestatus":
+                if self.check_api_call("homestatus"):
+                    query = parse_qs(url.query)
+                    if query.get('home_id', [None])[0] != home.home_id:
+                        self.reply_error(404, 9, "Home not found")
+                    else:
+                        # Device types may be given as repeated or comma-separated values
+                        device_types = [t for v in query.get('device_types', []) for t in v.split(',')]
+                        self.reply(200, home.homestatus(device_types))
+            elif url.path == "/api/homesdata":
+                if self.check_api_call("homesdata"):
+                    self.reply(200, home.homesdata())
+            elif url.path == "/api/addwebhook":
+                if self.check_api_call("addwebhook"):
+                    webhook_url = parse_qs(url.query).get('url', [None])[0]
+                    if webhook_url is None:
+                        self.reply_error(400, 2, "Missing url parameter")
+                    else:
+                        home.register_webhook(webhook_url)
+                        self.reply(200, {'status': 'ok', 'time_server': int(time.time())})
+            elif url.path == "/api/dropwebhook":
+                if self.check_api_call("dropwebhook"):
+                    home.webhook_url = None
+                    self.reply(200, {'status': 'ok', 'time_server': int(time.time())})
+            else:
+                self.reply_error(404, 404, "Not found")
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self.read_body()
+            if url.path == "/oauth2/token":
+                home.account_request("token")
+                params = parse_qs(body.decode("utf-8"))
+                grant_type = params.get('grant_type', [None])[0]
+                if grant_type == 'refresh_token' and params.get('refresh_token', [None])[0] != home.refresh_token:
+                    self.reply(400, {'error': 'invalid_grant'})
+                else:
+                    self.reply(200, home.new_access_token())
+            elif url.path == "/api/setstate":
+                if self.check_api_call("setstate"):
+                    errors = home.setstate(json.loads(body))
+                    response = {'status': 'ok', 'time_server': int(time.time())}
+                    if errors:
+                        response['body'] = {'errors': errors}
+                    self.reply(200, response)
+            else:
+                self.reply_error(404, 404, "Not found")
+
+        def log_message(self, format, *args):
+            if options.verbose:
+                super().log_message(format, *args)
+
+    return HTTPRequestHandler
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the Netatmo Connect API")
+    parser.add_argument("--address", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--home-id", default="fakehome", help="identifier of the emulated home")
+    parser.add_argument("--rooms", type=int, default=1, help="number of rooms in the emulated home (room ids start from 1000)")
+    parser.add_argument("--latency", type=float, default=0, help="average latency of API calls, in seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0, help="standard deviation of the latency, in seconds")
+    parser.add_argument("--token-lifetime", type=int, default=10800, help="lifetime of access tokens, in seconds")
+    parser.add_argument("--concurrency-error-rate", type=float, default=0, help="probability of HTTP 429 (code 11) responses to API calls")
+    parser.add_argument("--server-error-rate", type=float, default=0, help="probability of HTTP 503 responses to API calls")
+    parser.add_argument("--disconnect-rate", type=float, default=0, help="probability of API calls answered by dropping the connection")
+    parser.add_argument("--no-rate-limits", action="store_true", help="do not enforce per-user rate limits (e.g., for accelerated soak tests)")
+    parser.add_argument("--drift", action="store_true", help="let measured temperatures move towards the setpoints")
+    parser.add_argument("--client-secret", default="fake-client-secret", help="client secret used to sign webhook events")
+    parser.add_argument("--external-change-interval", type=float, default=0, help="emulate a setpoint change from another interface every given number of seconds (0 to disable)")
+    parser.add_argument("--other-modules", type=int, default=0, help="number of other Home+Control modules (plugs, lights, etc.) in the emulated home")
+    parser.add_argument("--verbose", action="store_true", help="log received requests")
+    return parser.parse_args(args)
+
+def make_server(options):
+    home = FakeHome(options.home_id, options.rooms, options.token_lifetime, options.drift, options.client_secret, options.other_modules)
+    home.rate_limits_enabled = not options.no_rate_limits
+    server = ThreadingHTTPServer((options.address, options.port), FakeNetatmoRequestHandler(home, options))
+    server.daemon_threads = True
+    if options.external_change_interval > 0:
+        threading.Thread(target=emulate_external_changes, args=(home, options.external_change_interval), daemon=True).start()
+    return server, home
+
+def emulate_external_changes(home, interval):
+    while True:
+        time.sleep(interval)
+        home.external_change()
+
+if __name__ == "__main__":
+    options = parse_arguments()
+    server, home = make_server(options)
+    print("Fake Netatmo API listening on http://%s:%i (home %s, %i rooms). Current token: %s" % (options.address, options.port, options.home_id, options.rooms, json.dumps({'access_token': home.access_token, 'refresh_token': home.refresh_token})), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
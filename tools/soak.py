@@ -0,0 +1,330 @@
+#!/usr/bin/python3
+
+# Soak test of smarther2mqtt, meant to catch slow memory and thread leaks.
+# The real bridge (main loop, NetatmoToken, command queue, schedulers) is
+# run in this very process, against the local Netatmo API stand-in
+# (fake_netatmo.py, run as a separate process so that its own allocations
+# are not accounted) and an MQTT broker. Polling is accelerated (the rate
+# limits of the stand-in and the rate budget of the bridge are lifted), and
+# bursts of commands are published on the MQTT topics of the emulated rooms,
+# while the stand-in injects rate limit errors, server errors, dropped
+# connections and token expiries, so that retries and error handlers are
+# exercised as well.
+# After a warm-up, tracemalloc snapshots, the resident memory and the
+# running threads are sampled periodically. The test fails (exit status 1)
+# if, at the end, traced memory or the number of threads has grown beyond
+# the given thresholds with respect to the end of the warm-up; the
+# allocation sites that have grown the most are reported.
+#
+# Example:
+#   tools/soak.py --cycles 20000 --rooms 5 --start-broker
+
+import argparse, collections, gc, json, logging, os, random, runpy, signal, subprocess, sys, tempfile, threading, time, tracemalloc
+import yaml
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from benchmark import REPOSITORY_DIR, free_port, start_broker, process_usage
+
+# Allocations that are not made by the bridge (but by this tool or by
+# tracemalloc itself)
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, os.path.join(os.path.dirname(os.path.abspath(__file__)), "*")),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>")
+)
+
+# Start the fake Netatmo API as a separate process. Return the process,
+# the URL of the API and the refresh token it has issued
+def start_fake_api(options):
+    port = free_port()
+    fake_api = subprocess.Popen([
+        sys.executable, os.path.join(REPOSITORY_DIR, 'tools', 'fake_netatmo.py'),
+        "--port", str(port),
+        "--rooms", str(options.rooms),
+        "--token-lifetime", str(options.token_lifetime),
+        "--concurrency-error-rate", str(options.concurrency_error_rate),
+        "--server-error-rate", str(options.server_error_rate),
+        "--disconnect-rate", str(options.disconnect_rate),
+        "--no-rate-limits"
+    ], stdout=subprocess.PIPE, text=True)
+    banner = fake_api.stdout.readline()
+    if "Current token: " not in banner:
+        fake_api.terminate()
+        sys.exit("Failed to start the fake Netatmo API")
+    token = json.loads(banner.split("Current token: ", 1)[1])
+    return fake_api, "http://127.0.0.1:%i" % port, token['refresh_token']
+
+# Write a configuration file for the bridge in the given working directory,
+# along with a token file holding an expired access token (so that the token
+# is refreshed right away). Return the list of room ids
+def write_bridge_settings(workdir, api_url, refresh_token, broker_address, broker_port, options):
+    rooms = [str(1000 + i) for i in range(options.rooms)]
+    retry_delays = {'base_delay': options.polling_interval, 'max_delay': options.polling_interval * 4}
+    bridge_settings = {
+        'debug': options.debug,
+        'oauth_code_endpoint': {'ipaddress': '127.0.0.1', 'port': free_port()},
+        'netatmo': {
+            'api_url': api_url,
+            'token_file': os.path.join(workdir, 'netatmo_token'),
+            'clientid': 'soak',
+            'clientsecret': 'soak',
+            'homeid': 'fakehome',
+            'rooms': [{
+                'roomid': room_id,
+                'publish_base_topic': 'soak/%s/sensors' % room_id,
+                'subscribe_base_topic': 'soak/%s/commands' % room_id
+            } for room_id in rooms],
+            'polling_interval': options.polling_interval,
+            'min_request_idle_time': options.idle_time,
+            'max_request_delay': options.idle_time * 4,
+            'default_duration': None,
+            # Accelerated polling would otherwise be held by the rate budget
+            'budget_fraction': 1000,
+            'token_refresh_margin': options.token_lifetime / 3,
+            'retry': {
+                'budget': 10**9,
+                'poll': {failure: retry_delays for failure in ('connection', 'server_error', 'rate_limit')},
+                'setstate': {failure: retry_delays for failure in ('connection', 'server_error', 'rate_limit')}
+            },
+            'verification': {'polls': 3, 'interval': options.polling_interval}
+        },
+        'mqtt': {
+            'broker': {'ipaddress': broker_address, 'port': broker_port},
+            'publish_topics': {
+                'base_topic': 'soak/sensors',
+                'temperature': 'temperature',
+                'humidity': 'humidity',
+                'temperature_setpoint': 'temperature_setpoint',
+                'mode': 'mode',
+                'setpoint_endtime': 'setpoint_endtime'
+            },
+            'subscribe_topics': {
+                'base_topic': 'soak/commands',
+                'temperature_setpoint': 'temperature_setpoint',
+                'mode': 'mode'
+            },
+            'publish_mode': 'both'
+        },
+        'history': {'raw_samples': 1000, '5m_samples': 100, '1h_samples': 100},
+        'health': {'ipaddress': '127.0.0.1', 'port': free_port()}
+    }
+    if options.engine:
+        bridge_settings['engine'] = options.engine
+    with open(os.path.join(workdir, 'smarther2mqtt_settings.yml'), 'w') as f:
+        yaml.safe_dump(bridge_settings, f)
+    with open(os.path.join(workdir, 'netatmo_token'), 'w') as f:
+        json.dump({'access_token': 'expired', 'refresh_token': refresh_token}, f)
+    return rooms
+
+# Publish bursts of commands (mostly temperature setpoints, some mode
+# changes and some invalid payloads) until stopped
+def publish_commands(mqttc, rooms, options, stopped):
+    while not stopped.wait(options.command_interval):
+        for i in range(options.burst_size):
+            room_id = random.choice(rooms)
+            kind = random.random()
+            if kind < 0.05:
+                topic, payload = 'temperature_setpoint', "not a temperature"
+            elif kind < 0.2:
+                topic, payload = 'mode', random.choice(("AUTO", "OFF"))
+            else:
+                topic, payload = 'temperature_setpoint', str(random.randrange(30, 50) / 2)
+            mqttc.publish('soak/%s/commands/%s' % (room_id, topic), payload, qos=1)
+
+# Number of polling cycles completed by the bridge so far
+def completed_cycles():
+    metrics = sys.modules.get('modules.metrics')
+    if metrics is None:
+        return 0
+    with metrics.poll_cycle_duration.lock:
+        return sum(sum(counts) for counts in metrics.poll_cycle_duration.counts.values())
+
+def take_snapshot():
+    gc.collect()
+    return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+def traced_size(snapshot):
+    return sum(stat.size for stat in snapshot.statistics('filename'))
+
+# Slope of the least-squares line through the given (x, y) points
+def slope(points):
+    if len(points) < 2:
+        return float('nan')
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, y in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance if variance else float('nan')
+
+# Body of the sampling thread: wait for the end of the warm-up, take the
+# baseline, sample periodically until enough cycles have been completed
+# (or time is up), then stop the bridge by interrupting the main thread
+def sample(options, results, bridge_done):
+    deadline = time.monotonic() + options.max_duration
+    print("Warming up (%i cycles)" % options.warmup, flush=True)
+    try:
+        while completed_cycles() < options.warmup and time.monotonic() < deadline and not bridge_done.wait(0.5):
+            pass
+        if bridge_done.is_set() or time.monotonic() >= deadline:
+            return
+        results['baseline'] = take_snapshot()
+        results['baseline_threads'] = collections.Counter(t.name for t in threading.enumerate())
+        results['samples'] = []
+        while True:
+            snapshot = take_snapshot()
+            cycles = completed_cycles()
+            point = {
+                'cycles': cycles,
+                'traced_bytes': traced_size(snapshot),
+                'rss_bytes': process_usage(os.getpid())[1],
+                'threads': threading.active_count()
+            }
+            results['samples'].append(point)
+            results['final'] = snapshot
+            results['final_threads'] = collections.Counter(t.name for t in threading.enumerate())
+            print("Cycles %7i  traced %8.2f MiB  RSS %8.2f MiB  threads %3i" % (cycles, point['traced_bytes'] / 2**20, point['rss_bytes'] / 2**20, point['threads']), flush=True)
+            if cycles >= options.warmup + options.cycles or time.monotonic() >= deadline:
+                break
+            if bridge_done.wait(options.sample_interval):
+                return
+    finally:
+        if not bridge_done.is_set():
+            os.kill(os.getpid(), signal.SIGINT)
+
+# Compare the final sample with the baseline. Return the results to be
+# reported and whether the thresholds have been respected
+def evaluate(options, results):
+    samples = results.get('samples') or []
+    if not samples:
+        return {'error': "the bridge has not completed the warm-up"}, False
+    baseline_bytes = traced_size(results['baseline'])
+    final = samples[-1]
+    new_threads = results['final_threads'] - results['baseline_threads']
+    report = {
+        'cycles': final['cycles'] - options.warmup,
+        'traced_bytes_baseline': baseline_bytes,
+        'traced_bytes_final': final['traced_bytes'],
+        'traced_bytes_growth': final['traced_bytes'] - baseline_bytes,
+        'traced_bytes_per_1000_cycles': 1000 * slope([(s['cycles'], s['traced_bytes']) for s in samples]),
+        'rss_bytes_first': samples[0]['rss_bytes'],
+        'rss_bytes_final': final['rss_bytes'],
+        'threads_baseline': sum(results['baseline_threads'].values()),
+        'threads_final': final['threads'],
+        'new_threads': dict(new_threads),
+        'top_growth': [{
+            'location': "%s:%i" % (stat.traceback[0].filename, stat.traceback[0].lineno),
+            'size_diff': stat.size_diff,
+            'count_diff': stat.count_diff
+        } for stat in results['final'].compare_to(results['baseline'], 'lineno')[:options.top] if stat.size_diff > 0]
+    }
+    failures = []
+    if report['cycles'] < options.cycles:
+        failures.append("only %i of %i cycles completed within %.0f seconds" % (report['cycles'], options.cycles, options.max_duration))
+    if report['traced_bytes_growth'] > options.max_memory_growth * 1024:
+        failures.append("traced memory has grown by %.1f KiB (threshold %.1f KiB)" % (report['traced_bytes_growth'] / 1024, options.max_memory_growth))
+    if report['threads_final'] - report['threads_baseline'] > options.max_thread_growth:
+        failures.append("running threads have grown from %i to %i" % (report['threads_baseline'], report['threads_final']))
+    report['failures'] = failures
+    return report, not failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test of smarther2mqtt with memory and thread leak tracking")
+    parser.add_argument("--cycles", type=int, default=20000, help="number of polling cycles to run after the warm-up")
+    parser.add_argument("--warmup", type=int, default=500, help="number of polling cycles to run before taking the baseline")
+    parser.add_argument("--rooms", type=int, default=3, help="number of rooms")
+    parser.add_argument("--polling-interval", type=float, default=0.01, help="polling interval of the bridge, in seconds")
+    parser.add_argument("--idle-time", type=float, default=0.05, help="min_request_idle_time of the bridge, in seconds")
+    parser.add_argument("--command-interval", type=float, default=1, help="interval between bursts of commands, in seconds")
+    parser.add_argument("--burst-size", type=int, default=20, help="number of commands in each burst")
+    parser.add_argument("--token-lifetime", type=int, default=60, help="lifetime of access tokens issued by the fake API, in seconds")
+    parser.add_argument("--concurrency-error-rate", type=float, default=0.02, help="probability of HTTP 429 responses from the fake API")
+    parser.add_argument("--server-error-rate", type=float, default=0.02, help="probability of HTTP 503 responses from the fake API")
+    parser.add_argument("--disconnect-rate", type=float, default=0.02, help="probability of dropped connections by the fake API")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], help="execution engine of the bridge")
+    parser.add_argument("--sample-interval", type=float, default=10, help="interval between samples, in seconds")
+    parser.add_argument("--max-duration", type=float, default=3600, help="maximum duration of the test, in seconds")
+    parser.add_argument("--max-memory-growth", type=float, default=512, help="maximum growth of traced memory, in KiB")
+    parser.add_argument("--max-thread-growth", type=int, default=0, help="maximum growth of the number of running threads")
+    parser.add_argument("--traceback-frames", type=int, default=1, help="number of frames stored by tracemalloc for each allocation")
+    parser.add_argument("--top", type=int, default=10, help="number of allocation sites reported")
+    parser.add_argument("--broker", default="127.0.0.1:1883", help="address:port of an existing MQTT broker")
+    parser.add_argument("--start-broker", action="store_true", help="start a mosquitto instance on a free port")
+    parser.add_argument("--debug", action="store_true", help="enable debug logging in the bridge (debug messages are formatted, then discarded)")
+    parser.add_argument("--json", action="store_true", help="print results in JSON format")
+    options = parser.parse_args()
+
+    fake_api, api_url, refresh_token = start_fake_api(options)
+    broker = None
+    if options.start_broker:
+        broker_address, broker_port = "127.0.0.1", free_port()
+        broker = start_broker(broker_port)
+        time.sleep(0.5)
+    else:
+        broker_address, broker_port = options.broker.rsplit(":", 1)
+        broker_port = int(broker_port)
+
+    workdir = tempfile.mkdtemp(prefix="smarther2mqtt-soak-")
+    rooms = write_bridge_settings(workdir, api_url, refresh_token, broker_address, broker_port, options)
+    # The bridge logs to a file in the working directory. Debug messages
+    # are still built when enabled, as the bridge would do in production
+    log_path = os.path.join(workdir, "bridge.log")
+    logging.basicConfig(filename=log_path, format="[%(asctime)s] %(levelname)s:%(name)s:%(funcName)s:%(lineno)d - %(message)s", datefmt="%Y/%m/%d %H:%M:%S", level=logging.DEBUG if options.debug else logging.INFO)
+
+    mqttc = mqtt.Client()
+    mqttc.connect(broker_address, broker_port)
+    mqttc.loop_start()
+    stopped = threading.Event()
+    threading.Thread(target=publish_commands, args=(mqttc, rooms, options, stopped), name='soak-commands', daemon=True).start()
+
+    results = {}
+    bridge_done = threading.Event()
+    sampler = threading.Thread(target=sample, args=(options, results, bridge_done), name='soak-sampler', daemon=True)
+    tracemalloc.start(options.traceback_frames)
+    sampler.start()
+    started = time.monotonic()
+    # The bridge reads its settings from the current directory, and runs in
+    # the main thread, as it installs signal handlers
+    os.chdir(workdir)
+    sys.path.insert(0, REPOSITORY_DIR)
+    try:
+        runpy.run_path(os.path.join(REPOSITORY_DIR, 'smarther2mqtt.py'), run_name="__main__")
+    except KeyboardInterrupt:
+        pass
+    except BaseException as e:
+        print("The bridge has terminated unexpectedly: %s" % repr(e))
+    finally:
+        bridge_done.set()
+        stopped.set()
+        sampler.join()
+        tracemalloc.stop()
+        mqttc.loop_stop()
+        fake_api.terminate()
+        fake_api.wait()
+        if broker:
+            broker.terminate()
+
+    report, passed = evaluate(options, results)
+    report['duration'] = time.monotonic() - started
+    report['passed'] = passed
+    if options.json:
+        print(json.dumps(report, indent=2))
+    elif 'error' in report:
+        print("Soak test failed: %s" % report['error'])
+    else:
+        print("Cycles after warm-up:         %i in %.0f seconds" % (report['cycles'], report['duration']))
+        print("Traced memory:                %.1f KiB -> %.1f KiB (%+.1f KiB, %+.1f KiB per 1000 cycles)" % (report['traced_bytes_baseline'] / 1024, report['traced_bytes_final'] / 1024, report['traced_bytes_growth'] / 1024, report['traced_bytes_per_1000_cycles'] / 1024))
+        print("RSS:                          %.1f MiB -> %.1f MiB" % (report['rss_bytes_first'] / 2**20, report['rss_bytes_final'] / 2**20))
+        print("Threads:                      %i -> %i" % (report['threads_baseline'], report['threads_final']))
+        for name, count in report['new_threads'].items():
+            print("  new thread: %s (x%i)" % (name, count))
+        print("Top allocation growth:")
+        for stat in report['top_growth']:
+            print("  %+9.1f KiB %+7i blocks  %s" % (stat['size_diff'] / 1024, stat['count_diff'], stat['location']))
+        print("Bridge log:                   %s" % log_path)
+        print("Soak test %s" % ("passed" if passed else "failed: " + "; ".join(report['failures'])))
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__":
+    main()